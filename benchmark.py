@@ -0,0 +1,122 @@
+"""
+Measure per-turn latency of the chat run loop against an LLM backend.
+
+    python benchmark.py --backend stub --turns 20 --round-trip 0.3
+    python benchmark.py --backend stub --turns 20 --round-trip 0.3 --no-routing
+    python benchmark.py --backend chat --turns 5
+    python benchmark.py --backend assistants --turns 5
+
+Each turn queues a message and drives the /receive route's run loop directly,
+without an HTTP server, timing the first frame, the first streamed text and
+the end of the run. The stub backend never leaves the process, so it can be
+run offline; the others need OPENAI_API_KEY, and the Assistants API needs
+ASSISTANT_ID. Threads and turns go to a temporary thread store.
+
+Each backend counts the instruction and tool tokens it sends with every model
+request. With --no-routing every run is offered all tools and the whole
+database schema, so comparing a run with and without it shows what
+per-message tool routing saves in prompt tokens. The stub's timing does not
+depend on prompt size, so any effect on time to first token has to be
+measured against the chat or assistants backend.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from routers.chat import stream_response
+from utils.llm_backend import LLMBackend, StubBackend, get_backend
+from utils.metrics import metrics
+from utils.run_coordinator import run_coordinator
+from utils.thread_store import thread_store
+from utils.tool_router import tool_router
+
+QUESTIONS = [
+    "What did people say about tpot this year?",
+    "Find tweets similar to 'the archive is a commons'",
+    "Who talks most about community building?",
+]
+
+
+async def run_turn(backend: LLMBackend, assistant_id: str, thread_id: str, message: str) -> Dict[str, Optional[float]]:
+    """Run one turn and return the seconds to its first frame, its first text and its end."""
+    slot, _ = await run_coordinator.enqueue(thread_id, message)
+    started = time.perf_counter()
+    response = await stream_response(assistant_id, thread_id, slot=slot, backend=backend, last_event_id=None)
+    first_frame = first_text = None
+    async for frame in response.body_iterator:
+        elapsed = time.perf_counter() - started
+        if first_frame is None:
+            first_frame = elapsed
+        if first_text is None and "\nevent: textDelta" in frame:
+            first_text = elapsed
+    return {"first_frame": first_frame, "first_text": first_text, "total": time.perf_counter() - started}
+
+
+def summarize(name: str, samples: List[Optional[float]]) -> str:
+    values = sorted(sample for sample in samples if sample is not None)
+    if not values:
+        return f"{name:<12} no samples"
+    p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+    return (
+        f"{name:<12} p50 {statistics.median(values) * 1000:8.1f} ms"
+        f"   p95 {p95 * 1000:8.1f} ms   mean {statistics.mean(values) * 1000:8.1f} ms"
+    )
+
+
+async def benchmark(backend: LLMBackend, assistant_id: str, turns: int, threads: int) -> None:
+    thread_ids = [await backend.create_thread() for _ in range(threads)]
+    before = metrics.snapshot()
+    results = []
+    for turn in range(turns):
+        results.append(await run_turn(
+            backend,
+            assistant_id,
+            thread_ids[turn % threads],
+            f"System: benchmark turn {turn}\n{QUESTIONS[turn % len(QUESTIONS)]}"
+        ))
+    for thread_id in thread_ids:
+        try:
+            await backend.delete_thread(thread_id)
+        except Exception as e:
+            logging.warning(f"Could not delete thread {thread_id}: {e}")
+
+    after = metrics.snapshot()
+    print(f"{backend.name} backend, {turns} turns on {threads} thread(s), tool routing {'on' if tool_router.enabled else 'off'}")
+    for metric in ("first_frame", "first_text", "total"):
+        print(summarize(metric, [result[metric] for result in results]))
+    for counter, label in (("llm.requests", "model requests"), ("llm.prompt_tokens", "instruction and tool tokens")):
+        print(f"{label} per turn: {(after.get(counter, 0) - before.get(counter, 0)) / turns:.1f}")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Measure per-turn latency of the chat run loop.")
+    parser.add_argument("--backend", choices=["stub", "chat", "assistants"], default="stub")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=1, help="Spread the turns over this many threads")
+    parser.add_argument("--round-trip", type=float, default=0.0, help="Stub only: seconds before each model step")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Stub only: seconds between streamed chunks")
+    parser.add_argument("--no-routing", action="store_true", help="Offer every tool and the whole schema on every run")
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("uvicorn.error").setLevel(logging.WARNING)
+    scratch = tempfile.mkdtemp(prefix="benchmark-")
+    thread_store.path = os.path.join(scratch, "threads.sqlite3")
+    run_coordinator.lock.directory = os.path.join(scratch, "locks")
+    if options.no_routing:
+        tool_router.enabled = False
+
+    backend: LLMBackend
+    if options.backend == "stub":
+        backend = StubBackend(round_trip=options.round_trip, token_delay=options.token_delay)
+    else:
+        backend = get_backend(options.backend)
+    asyncio.run(benchmark(backend, os.getenv("ASSISTANT_ID", ""), options.turns, options.threads))
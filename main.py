@@ -1,29 +1,70 @@
 import os
 import logging
+import asyncio
 from dotenv import load_dotenv
 from contextlib import asynccontextmanager
+from typing import List, Optional
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import RedirectResponse
-from routers import chat, setup
-from utils.threads import create_thread
+from openai import AsyncOpenAI
+from routers import chat, metrics, setup, threads
+from utils.threads import NEW_THREAD, thread_pool
+from utils.llm_backend import LLM_BACKEND
+from utils.create_assistant import ASSISTANT_SYNC_ENABLED, AssistantConfigError, create_or_update_assistant, request
+from utils.thread_store import Turn, thread_store
+from utils.account_index import ACCOUNT_INDEX_ENABLED, account_index
+from utils.social_graph import SOCIAL_GRAPH_ENABLED, social_graph
+from utils.tool_executor import fetch_endpoint_pages, fetch_table_pages, similarity_index
 from fastapi.exceptions import HTTPException
 
 
 logger = logging.getLogger("uvicorn.error")
 
+async def sync_assistant() -> None:
+    """Push any local change to the assistant's tools or instructions; a no-op when the fingerprint matches."""
+    load_dotenv()
+    if not (os.getenv("OPENAI_API_KEY") and os.getenv("ASSISTANT_ID")):
+        return
+    try:
+        await create_or_update_assistant(AsyncOpenAI(), os.getenv("ASSISTANT_ID", ""), request, logger)
+    except AssistantConfigError as e:
+        logger.error(f"Not syncing the assistant. {e}")
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Optional startup logic
+    # Bring the assistant in line with the local config before serving runs against it
+    if LLM_BACKEND == "assistants" and ASSISTANT_SYNC_ENABLED:
+        await sync_assistant()
+    # Load the username index in the background and keep it fresh
+    background_tasks: List[asyncio.Task] = []
+    if ACCOUNT_INDEX_ENABLED:
+        background_tasks.append(asyncio.create_task(account_index.refresh_forever(fetch_table_pages)))
+    # Load the follow graph from its snapshot, or build it, in the background
+    if SOCIAL_GRAPH_ENABLED:
+        background_tasks.append(asyncio.create_task(social_graph.refresh_forever(fetch_endpoint_pages)))
+    # Keep a few Assistants API threads ready for new conversations
+    if LLM_BACKEND == "assistants":
+        background_tasks.append(asyncio.create_task(thread_pool.run_forever()))
+    # Load the offline-built similarity index, and keep the tweets added while running
+    background_tasks.append(asyncio.create_task(asyncio.to_thread(similarity_index.load)))
     yield
-    # Optional shutdown logic
+    for task in background_tasks:
+        task.cancel()
+    # Let the thread pool delete its unused threads
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    if similarity_index.unsaved:
+        await asyncio.to_thread(similarity_index.save)
 
 app = FastAPI(lifespan=lifespan)
 
 # Mount routers
 app.include_router(chat.router)
 app.include_router(setup.router)
+app.include_router(metrics.router)
+app.include_router(threads.router)
 
 # Mount static files (e.g., CSS, JS)
 app.mount("/static", StaticFiles(directory=os.path.join(os.getcwd(), "static")), name="static")
@@ -50,10 +91,8 @@ async def http_exception_handler(request: Request, exc: HTTPException):
     )
 
 
-# TODO: Implement some kind of thread id storage or management logic to allow
-# user to load an old thread, delete an old thread, etc. instead of start new
 @app.get("/")
-async def read_home(request: Request, thread_id: str = None, messages: list = []):
+async def read_home(request: Request, thread_id: Optional[str] = None):
     logger.info("Home page requested")
     
     # Check if environment variables are missing
@@ -61,17 +100,23 @@ async def read_home(request: Request, thread_id: str = None, messages: list = []
     if not os.getenv("OPENAI_API_KEY") or not os.getenv("ASSISTANT_ID"):
         return RedirectResponse(url=app.url_path_for("read_setup"))
     
-    # Create a new assistant chat thread if no thread ID is provided
+    # Reopen a past thread from the local store. A new conversation gets its thread when its first message is sent.
+    turns: List[Turn] = []
+    has_more = False
     if not thread_id or thread_id == "None" or thread_id == "null":
-        thread_id: str = await create_thread()
+        thread_id = NEW_THREAD
+    else:
+        turns, has_more = await asyncio.to_thread(thread_store.turns, thread_id)
     
     return templates.TemplateResponse(
         "index.html",
         {
             "request": request,
             "assistant_id": os.getenv("ASSISTANT_ID"),
-            "messages": messages,
-            "thread_id": thread_id
+            "thread_id": thread_id,
+            "turns": turns,
+            "has_more": has_more,
+            "threads": await asyncio.to_thread(thread_store.threads)
         }
     )
 
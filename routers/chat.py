@@ -1,33 +1,51 @@
+import asyncio
+import functools
+import html
 import logging
-import time
+import os
+from contextlib import aclosing
 from datetime import datetime
-from typing import Any, AsyncGenerator
+from typing import AsyncGenerator
 from fastapi.templating import Jinja2Templates
-from fastapi import APIRouter, Form, Depends, Request
+from fastapi import APIRouter, Depends, Form, Header, HTTPException, Request
 from fastapi.responses import StreamingResponse, HTMLResponse
-from openai import AsyncOpenAI
-from openai.resources.beta.threads.runs.runs import AsyncAssistantStreamManager
-from openai.types.beta.assistant_stream_event import (
-    ThreadMessageCreated, ThreadMessageDelta, ThreadRunCompleted,
-    ThreadRunRequiresAction, ThreadRunStepCreated, ThreadRunStepDelta
-)
-from openai.types.beta import AssistantStreamEvent
-from openai.lib.streaming._assistants import AsyncAssistantEventHandler
-from openai.types.beta.threads.run_submit_tool_outputs_params import ToolOutput
-from openai.types.beta.threads.run import RequiredAction
-from fastapi.responses import StreamingResponse
-from fastapi import APIRouter, Depends, Form, HTTPException
-from pydantic import BaseModel
 
 import json
 
-from utils.custom_functions import make_request
-from utils.tools import ENDPOINT_SCHEMAS
+from utils.tool_executor import (
+    ToolResult, account_prefetcher, batchable, execute_tool_call, get_endpoint, job_manager, working_sets
+)
+from utils.jobs import JOB_AFTER_SECONDS, JOB_MAX_WAIT_SECONDS, JOB_PROGRESS_SECONDS, Job, Outcomes, describe_calls
 from utils.sse import sse_format
+from utils.run_broadcast import run_broadcaster
+from utils.run_coordinator import run_coordinator
+from utils.tools import ENDPOINT_SCHEMAS
+from utils.output_packing import PackedOutput, pack_tool_output
+from utils.tokens import context_ledger
+from utils.metrics import metrics
+from utils.result_store import result_store
+from utils.export import EXPORT_FORMATS, MEDIA_TYPES, can_resume, export_stream, parquet_available
+from utils.speculation import ToolCallSpeculator
+from utils.thread_store import TurnRecorder, thread_store
+from utils.threads import NEW_THREAD
+from utils.tool_router import ToolSelection, tool_router
+from utils.llm_backend import (
+    BackendEvent, BackendEvents, LLMBackend, MessageStarted, RunCompleted, RunStarted, TextDelta, ToolCallDelta,
+    ToolCallsRequired, ToolStepOutput, ToolStepStarted, Usage, get_backend
+)
 
 logger: logging.Logger = logging.getLogger("uvicorn.error")
 logger.setLevel(logging.DEBUG)
 
+# Tool outputs sent to the model: "compact" (token-budgeted table) or "json"
+TOOL_OUTPUT_FORMAT: str = os.getenv("TOOL_OUTPUT_FORMAT", "compact")
+MAX_TOOL_OUTPUT_CHARS: int = 4000
+# Sent to the model in place of the output of tool calls left running in the background
+JOB_DETACHED_OUTPUT: str = (
+    "This query is still running in the background. Its result will be sent with the "
+    "user's next message; tell the user it will appear here when ready."
+)
+
 
 router: APIRouter = APIRouter(
     prefix="/assistants/{assistant_id}/messages/{thread_id}",
@@ -37,43 +55,158 @@ router: APIRouter = APIRouter(
 # Jinja2 templates
 templates = Jinja2Templates(directory="templates")
 
-# Utility function for submitting tool outputs to the assistant
-class ToolCallOutputs(BaseModel):
-    tool_outputs: Any
-    runId: str
+# Rows per page in tool output widgets
+WIDGET_PAGE_SIZE: int = 10
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+}
+
 
-async def post_tool_outputs(client: AsyncOpenAI, data: dict, thread_id: str):
+EXPIRED_WIDGET = "<div class='toolOutput'><p>This result has expired.</p></div>"
+
+
+def render_result_widget(
+    assistant_id: str,
+    thread_id: str,
+    tool_call_id: str,
+    page: int = 0,
+    sort: str | None = None,
+    desc: bool = False
+) -> str | None:
     """
-    data is expected to be something like
-    {
-      "tool_outputs": {
-        "output": [{"location": "City", "temperature": 70, "conditions": "Sunny"}],
-        "tool_call_id": "call_123"
-      },
-      "runId": "some-run-id",
-    }
+    Render one page of a stored tool result as an output widget, with controls
+    that fetch further pages or sorted views from the results route.
+    Returns None if the result has expired or belongs to another thread.
     """
-    try:
-        outputs_list = [
-            ToolOutput(
-                output=data["tool_outputs"]["output"],
-                tool_call_id=data["tool_outputs"]["tool_call_id"]
-            )
-        ]
+    result = result_store.get(tool_call_id, thread_id)
+    if result is None:
+        return None
+
+    page = min(max(page, 0), max(len(result.rows) - 1, 0) // WIDGET_PAGE_SIZE)
+    stored_page = result_store.page(
+        tool_call_id, page=page, page_size=WIDGET_PAGE_SIZE, sort=sort, descending=desc, thread_id=thread_id
+    )
+    if stored_page is None:
+        return None
+    rows, total_rows = stored_page
+    columns = list(dict.fromkeys(key for row in result.rows[:50] if isinstance(row, dict) for key in row))
+
+    results_url = f"/assistants/{assistant_id}/messages/{thread_id}/results/{tool_call_id}"
+    exportable = any(endpoint["name"] == result.function_name for endpoint in ENDPOINT_SCHEMAS)
+
+    return templates.get_template('components/output-widget.html').render(
+        reports=rows,
+        results_url=results_url,
+        export_url=f"{results_url}/export" if exportable else None,
+        parquet=parquet_available(),
+        total_rows=total_rows,
+        page=page,
+        page_size=WIDGET_PAGE_SIZE,
+        columns=columns,
+        sort=sort,
+        desc=desc
+    )
 
 
-        stream_manager = client.beta.threads.runs.submit_tool_outputs_stream(
-            thread_id=thread_id,
-            run_id=data["runId"],
-            tool_outputs=outputs_list,
+def render_tool_result(
+    assistant_id: str,
+    thread_id: str,
+    tool_call_id: str,
+    function_name: str,
+    args: dict,
+    tool_result: ToolResult
+) -> tuple[str, str]:
+    """
+    Store a tool call's result and render it.
+
+    Returns:
+        The widget HTML for the chat, and the serialized output for the model
+    """
+    function_response = tool_result.rows
+
+    logger.info(f"Function response: {function_response}")
+
+    # Keep the full result server-side so the widget can page through it
+    if isinstance(function_response, list):
+        result_store.put(tool_call_id, function_name, args, function_response, thread_id)
+        if function_response:
+            handle = working_sets.add(thread_id, tool_call_id, function_name, args, function_response)
+            tool_result.notes.append(
+                f"Stored as {handle}; use query_working_set to filter, join or sort it without refetching."
+            )
+        widget_html = render_result_widget(assistant_id, thread_id, tool_call_id) or EXPIRED_WIDGET
+    else:
+        widget_html = templates.get_template('components/output-widget.html').render(
+            reports=[function_response] if isinstance(function_response, dict) else []
+        )
+
+    # If function_response is a list, truncate it to 50 rows
+    original_length = len(function_response) if isinstance(function_response, list) else None
+    if isinstance(function_response, list) and len(function_response) > 50:
+        function_response = function_response[:50]
+        truncation_note = f"\n\nNote: Output truncated. Showing first 50 of {original_length} rows."
+    else:
+        truncation_note = ""
+
+    # Convert response to string and handle long responses
+    if tool_result.text is not None:
+        serialized_response = tool_result.text
+    elif TOOL_OUTPUT_FORMAT == "compact":
+        packed_output: PackedOutput = pack_tool_output(
+            function_response,
+            function_name,
+            total_rows=original_length,
+            thread_id=thread_id
         )
+        serialized_response = packed_output.text
+        metrics.increment("tool_output.tokens", packed_output.tokens)
+    else:
+        serialized_response = json.dumps(function_response)
+        if len(serialized_response) > MAX_TOOL_OUTPUT_CHARS:
+            prefix = f"Response truncated. First {MAX_TOOL_OUTPUT_CHARS} characters:{truncation_note}\n\n"
+            serialized_response = prefix + serialized_response[:MAX_TOOL_OUTPUT_CHARS] + "..."
+        elif truncation_note:
+            serialized_response = json.dumps(function_response) + truncation_note
+
+    # Tell the model about any rewrites the query cost model applied, and the result's handle
+    if tool_result.notes:
+        serialized_response += "\n\nNote: " + " ".join(tool_result.notes)
+
+    return widget_html, str(serialized_response)
 
-        return stream_manager
 
-    except Exception as e:
-        logger.error(f"Error submitting tool outputs: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+def render_job_result(assistant_id: str, job: Job, outcomes: Outcomes) -> tuple[str, str]:
+    """
+    Render the outcomes of a background job that finished after its run stopped waiting.
 
+    Returns:
+        The output for the thread's next run, and the widget HTML for the chat
+    """
+    outputs, widgets = [], []
+    for tool_call_id, function_name, args in job.calls:
+        outcome = outcomes.get(tool_call_id, RuntimeError("The tool call did not run"))
+        if isinstance(outcome, Exception):
+            output = f"Error executing function: {outcome}"
+            widget_html = f"<pre class='toolOutput error'>{html.escape(output)}</pre>"
+        else:
+            widget_html, output = render_tool_result(assistant_id, job.thread_id, tool_call_id, function_name, args, outcome)
+        outputs.append(f"{function_name}({json.dumps(args)}):\n{output}")
+        widgets.append(widget_html)
+    return "\n\n".join(outputs), "".join(widgets)
+
+
+def render_job_status(thread_id: str, job_id: str, description: str, progress: str = "", trigger: str = "load") -> str:
+    """A placeholder that fetches a background job's status, and keeps polling it until the job ends."""
+    return templates.get_template("components/job-status.html").render(
+        thread_id=thread_id,
+        job_id=job_id,
+        status="running",
+        description=description,
+        progress=progress,
+        trigger=trigger
+    )
 
 # Route to submit a new user message to a thread and mount a component that
 # will start an assistant run stream
@@ -83,27 +216,112 @@ async def send_message(
     assistant_id: str,
     thread_id: str,
     userInput: str = Form(...),
-    client: AsyncOpenAI = Depends(lambda: AsyncOpenAI())
+    backend: LLMBackend = Depends(lambda: get_backend())
 ) -> HTMLResponse:
-    # Create a new message in the thread
-    await client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role="user",
-        content=f"System: Today's date is {datetime.today().strftime('%Y-%m-%d')}\n{userInput}"
+    # A new conversation gets its thread on its first message (for the Assistants API, from the pre-created pool)
+    new_thread = thread_id == NEW_THREAD
+    if new_thread:
+        thread_id = await backend.create_thread()
+        if not thread_id:
+            raise HTTPException(status_code=502, detail="Could not create a conversation thread")
+
+    # Start looking up any @handles in the message while the run is being set up
+    account_prefetcher.start(thread_id, userInput)
+
+    # Queue the message for the thread's next run; it is posted when that run starts.
+    # A message sent before the previous one's run started joins that run instead of opening another.
+    slot, opened = await run_coordinator.enqueue(
+        thread_id,
+        f"System: Today's date is {datetime.today().strftime('%Y-%m-%d')}\n{userInput}"
     )
 
     # Render the component templates with the context
     user_message_html = templates.get_template("components/user-message.html").render(user_input=userInput)
+    await asyncio.to_thread(thread_store.add_turn, thread_id, assistant_id, "user", user_message_html, userInput)
     assistant_run_html = templates.get_template("components/assistant-run.html").render(
         assistant_id=assistant_id,
-        thread_id=thread_id
-    )
+        thread_id=thread_id,
+        slot=slot
+    ) if opened else ""
+
+    if not new_thread:
+        return HTMLResponse(content=user_message_html + assistant_run_html)
 
+    # Point the send button and the address bar at the thread that now exists
+    send_button_html = templates.get_template("components/send-button.html").render(
+        assistant_id=assistant_id,
+        thread_id=thread_id,
+        oob=True
+    )
     return HTMLResponse(
         content=(
             user_message_html +
-            assistant_run_html
-        )
+            assistant_run_html +
+            send_button_html
+        ),
+        headers={"HX-Replace-Url": f"/?thread_id={thread_id}"}
+    )
+
+
+# Route to fetch another page or a sorted view of a stored tool result
+@router.get("/results/{tool_call_id}")
+async def read_result_page(
+    assistant_id: str,
+    thread_id: str,
+    tool_call_id: str,
+    page: int = 0,
+    sort: str | None = None,
+    desc: bool = False
+) -> HTMLResponse:
+    # Results spilled to disk are read back in a worker thread
+    content = await asyncio.to_thread(
+        render_result_widget, assistant_id, thread_id, tool_call_id, page=page, sort=sort or None, desc=desc
+    )
+    if content is None:
+        raise HTTPException(status_code=404, detail="No such result on this thread, or it has expired")
+    return HTMLResponse(content=content)
+
+
+# Route to download the complete result of a recorded tool call, beyond the rows the chat saw
+@router.get("/results/{tool_call_id}/export")
+async def export_result(
+    assistant_id: str,
+    thread_id: str,
+    tool_call_id: str,
+    format: str = "ndjson",
+    cursor: str | None = None
+) -> StreamingResponse:
+    """
+    Streams every row matching a recorded tool call as NDJSON, CSV or Parquet.
+
+    Rows are paged from PostgREST by primary key, so an interrupted download can
+    be resumed by passing the primary key of the last row received as `cursor`.
+    The name of that column is sent in the X-Export-Cursor-Column header.
+    """
+    # A tool call's result is only served through the thread it was made on
+    result = await asyncio.to_thread(result_store.get, tool_call_id, thread_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="No such result on this thread, or it has expired")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown export format {format}; use one of {', '.join(EXPORT_FORMATS)}")
+    if format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=400, detail="Parquet export requires pyarrow to be installed")
+
+    try:
+        endpoint = get_endpoint(result.function_name)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Results of {result.function_name} cannot be exported")
+
+    headers = {"Content-Disposition": f'attachment; filename="{result.function_name}-{tool_call_id}.{format}"'}
+    if can_resume(endpoint, result.params):
+        headers["X-Export-Cursor-Column"] = endpoint["primary_key"]
+    elif cursor:
+        raise HTTPException(status_code=400, detail="This export cannot be resumed from a cursor")
+
+    return StreamingResponse(
+        export_stream(endpoint, result.params, format, cursor=cursor),
+        media_type=MEDIA_TYPES[format],
+        headers=headers
     )
 
 
@@ -112,34 +330,66 @@ async def send_message(
 async def stream_response(
     assistant_id: str,
     thread_id: str,
-    client: AsyncOpenAI = Depends(lambda: AsyncOpenAI())
+    slot: int | None = None,
+    resume: str | None = None,
+    backend: LLMBackend = Depends(lambda: get_backend()),
+    last_event_id: str | None = Header(None)
 ) -> StreamingResponse:
     """
     Streams the assistant response via Server-Sent Events (SSE). If the assistant requires
     a tool call, we capture that action, invoke the tool, and then re-run the stream
     until completion. This is done in a DRY way by extracting the streaming logic 
     into a helper function.
+
+    The run is driven in the background and its frames are buffered, so when the
+    browser reconnects with a Last-Event-ID it is sent only the frames it missed
+    instead of a new run being started. When sse.js gives up on a connection it opens
+    a new EventSource, which sends no Last-Event-ID, so the page passes the last ID it
+    saw as `resume` instead. Runs on a thread are serialized by the
+    run coordinator: a second connection for the same run slot attaches to the
+    run serving it, and a later slot's run waits for the current one to finish.
     """
+    last_event_id = last_event_id or resume
+    if last_event_id:
+        resumed = run_broadcaster.resume(thread_id, last_event_id)
+        if resumed is None:
+            # The run is no longer buffered; starting another would repeat it, so close the stream
+            return StreamingResponse(
+                iter([sse_format("endStream", "DONE")]),
+                media_type="text/event-stream",
+                headers=SSE_HEADERS
+            )
+        broadcast, after = resumed
+        return StreamingResponse(broadcast.subscribe(after), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    # Key lookups are left for the batch planner, which can merge them into one request
+    speculator = ToolCallSpeculator(functools.partial(execute_tool_call, thread_id=thread_id), batchable)
+    # What the run displays, kept so the thread can be reopened from the local store
+    recorder = TurnRecorder()
+    # The upstream run to cancel if every client goes away
+    run_state: dict = {"run_id": None}
 
-    async def handle_assistant_stream(
+    async def handle_backend_stream(
         templates: Jinja2Templates,
         logger: logging.Logger,
-        stream_manager: AsyncAssistantStreamManager,
-        step_id: int = 0
+        events: BackendEvents,
+        step_id: str = ""
     ) -> AsyncGenerator:
         """
-        Async generator to yield SSE events.
+        Async generator to yield SSE events for one stream of backend events.
         We yield a final 'metadata' dictionary event once we're done.
         """
-        required_action: RequiredAction | None = None
-        run_requires_action_event: ThreadRunRequiresAction | None = None
+        tool_calls_required: ToolCallsRequired | None = None
 
-        event_handler: AsyncAssistantEventHandler
-        async with stream_manager as event_handler:
-            event: AssistantStreamEvent
-            async for event in event_handler:
-                if isinstance(event, ThreadMessageCreated):
-                    step_id = event.data.id
+        event: BackendEvent
+        async with aclosing(events) as stream:
+            async for event in stream:
+                if isinstance(event, RunStarted):
+                    run_state["run_id"] = event.run_id
+
+                if isinstance(event, MessageStarted):
+                    step_id = event.step_id
+                    recorder.start_step("assistantMessage")
 
                     yield sse_format(
                         "messageCreated",
@@ -148,16 +398,18 @@ async def stream_response(
                             stream_name=f"textDelta{step_id}"
                         )
                     )
-                    time.sleep(0.25)  # Give the client time to render the message
+                    await asyncio.sleep(0.25)  # Give the client time to render the message
 
-                if isinstance(event, ThreadMessageDelta):
+                if isinstance(event, TextDelta):
+                    recorder.append(event.text)
                     yield sse_format(
                         f"textDelta{step_id}",
-                        event.data.delta.content[0].text.value
+                        event.text
                     )
 
-                if isinstance(event, ThreadRunStepCreated) and event.data.type == "tool_calls":
-                    step_id = event.data.id
+                if isinstance(event, ToolStepStarted):
+                    step_id = event.step_id
+                    recorder.start_step("toolCall")
 
                     yield sse_format(
                         f"toolCallCreated",
@@ -166,159 +418,159 @@ async def stream_response(
                             stream_name=f'toolDelta{step_id}'
                         )
                     )
-                    time.sleep(0.25)  # Give the client time to render the message
-
-                if isinstance(event, ThreadRunStepDelta) and event.data.delta.step_details.type == "tool_calls":
-                    tool_call = event.data.delta.step_details.tool_calls[0]
-                    
-                    # Handle function tool calls
-                    if tool_call.type == "function":
-                        if tool_call.function.name:
-                            yield sse_format(
-                                f"toolDelta{step_id}",
-                                tool_call.function.name + "<br>"
-                            )
-                        elif tool_call.function.arguments:
-                            yield sse_format(
-                                f"toolDelta{step_id}",
-                                tool_call.function.arguments
-                            )
-                    
-                    # Handle code interpreter tool calls
-                    elif tool_call.type == "code_interpreter":
-                        if tool_call.code_interpreter.input:
-                            yield sse_format(
-                                f"toolDelta{step_id}",
-                                f"{tool_call.code_interpreter.input}"
-                            )
-                        if tool_call.code_interpreter.outputs:
-                            for output in tool_call.code_interpreter.outputs:
-                                if output.type == "logs":
-                                    yield sse_format(
-                                        f"toolDelta{step_id}",
-                                        f"{output.logs}"
-                                    )
-                                elif output.type == "image":
-                                    yield sse_format(
-                                        f"toolDelta{step_id}",
-                                        f"{output.image.file_id}"
-                                    )
-
-                # If the assistant run requires an action (a tool call), break and handle it
-                if isinstance(event, ThreadRunRequiresAction):
-                    required_action = event.data.required_action
-                    run_requires_action_event = event
-                    if required_action.submit_tool_outputs:
-                        break
+                    await asyncio.sleep(0.25)  # Give the client time to render the message
+
+                if isinstance(event, ToolCallDelta):
+                    # Start each function call as soon as its arguments have fully streamed in
+                    speculator.feed(event.index, event.call_id, event.name, event.arguments)
 
-                if isinstance(event, ThreadRunCompleted):
+                    if event.name:
+                        recorder.append(event.name + "<br>")
+                        yield sse_format(
+                            f"toolDelta{step_id}",
+                            event.name + "<br>"
+                        )
+                    elif event.arguments:
+                        recorder.append(event.arguments)
+                        yield sse_format(
+                            f"toolDelta{step_id}",
+                            event.arguments
+                        )
+
+                # Code interpreter input and output
+                if isinstance(event, ToolStepOutput):
+                    yield sse_format(
+                        f"toolDelta{step_id}",
+                        event.text
+                    )
+
+                # Keep track of how full the thread's context is, to size tool outputs
+                if isinstance(event, Usage):
+                    context_ledger.record(thread_id, event.total_tokens)
+
+                # If the assistant run requires tool calls, break and handle them
+                if isinstance(event, ToolCallsRequired):
+                    tool_calls_required = event
+                    break
+
+                if isinstance(event, RunCompleted):
                     yield sse_format("endStream", "DONE")
 
         # At the end (or break) of this async generator, we yield a final "metadata" object
         yield {
             "type": "metadata",
-            "required_action": required_action,
-            "step_id": step_id,
-            "run_requires_action_event": run_requires_action_event
+            "tool_calls_required": tool_calls_required,
+            "step_id": step_id
         }
 
-    async def event_generator():
+    async def event_generator(selection: ToolSelection | None):
         """
-        Main generator for SSE events. We call our helper function to handle the assistant
-        stream, and if the assistant requests a tool call, we do it and then re-run the stream.
+        Main generator for SSE events. We call our helper function to handle the backend's
+        stream, and if the assistant requests tool calls, we do them and then re-run the stream.
         """
-        step_id = 0
-        initial_manager = client.beta.threads.runs.stream(
-            assistant_id=assistant_id,
-            thread_id=thread_id,
-            parallel_tool_calls=False
-        )
-
-        stream_manager = initial_manager
-        while True:  
-            async for event in handle_assistant_stream(templates, logger, stream_manager, step_id):
+        step_id = ""
+        events = backend.run(assistant_id, thread_id, selection)
+        while True:
+            async for event in handle_backend_stream(templates, logger, events, step_id):
                 if isinstance(event, dict) and event.get("type") == "metadata":
-                    required_action: RequiredAction | None = event["required_action"]
-                    step_id: int = event["step_id"]
-                    run_requires_action_event: ThreadRunRequiresAction | None = event["run_requires_action_event"]
-
-                    # If the assistant still needs a tool call, do it and then re-stream
-                    if required_action and required_action.submit_tool_outputs:
-                        for tool_call in required_action.submit_tool_outputs.tool_calls:
-                            if tool_call.type == "function":
-                                try:
-                                    args = json.loads(tool_call.function.arguments)
-                                    function_name: str = tool_call.function.name
-
-                                    endpoint = next((item for item in ENDPOINT_SCHEMAS if item["name"] == function_name), None)
-                                    if not endpoint:
-                                        logger.error(f"Endpoint {function_name} not found")
-                                        raise ValueError(f"Endpoint {function_name} not found")
-
-                                    function_response = make_request(
-                                        endpoint=endpoint,
-                                        params=args or {}
-                                    )
-
-                                    logger.info(f"Function response: {function_response}")
-
-                                    # If function_response is a list, truncate it to 50 rows
-                                    if isinstance(function_response, list) and len(function_response) > 50:
-                                        original_length = len(function_response)
-                                        function_response = function_response[:50]
-                                        truncation_note = f"\n\nNote: Output truncated. Showing first 50 of {original_length} rows."
-                                    else:
-                                        truncation_note = ""
-
-                                    # Render a widget here
-                                    widget_html = templates.get_template('components/output-widget.html').render(
-                                        reports=function_response
-                                    )
-
-                                    # Yield the widget
-                                    yield sse_format(
-                                        "toolOutput",
-                                        widget_html
-                                    )
-
-                                    # Convert response to string and handle long responses
-                                    serialized_response = json.dumps(function_response)
-                                    if len(serialized_response) > 4000:
-                                        prefix = f"Response truncated. First 4000 characters:{truncation_note}\n\n"
-                                        serialized_response = prefix + serialized_response[:4000] + "..."
-                                    elif truncation_note:
-                                        serialized_response = json.dumps(function_response) + truncation_note
-
-                                    data_for_tool = {
-                                        "tool_outputs": {
-                                            "output": str(serialized_response),
-                                            "tool_call_id": tool_call.id
-                                        },
-                                        "runId": run_requires_action_event.data.id,
-                                    }
-
-                                except Exception as err:
-                                    logger.error(f"Failed to execute function: {err}")
-                                    error_message = f"Error executing function: {str(err)}"
-                                    yield sse_format(
-                                        "toolOutput",
-                                        f"<pre class='toolOutput error'>{error_message}</pre>"
-                                    )
-                                    data_for_tool = {
-                                        "tool_outputs": {
-                                            "output": error_message,
-                                            "tool_call_id": tool_call.id
-                                        },
-                                        "runId": run_requires_action_event.data.id,
-                                    }
-
-                        # Afterwards, create a fresh stream_manager for the next iteration
-                        new_stream_manager: AsyncAssistantStreamManager = await post_tool_outputs(
-                            client,
-                            data_for_tool,
-                            thread_id
-                        )
-                        stream_manager = new_stream_manager
+                    tool_calls_required: ToolCallsRequired | None = event["tool_calls_required"]
+                    step_id = event["step_id"]
+
+                    # If the assistant still needs tool calls, do them and then re-stream
+                    if tool_calls_required:
+                        function_calls = tool_calls_required.calls
+
+                        # Hand the calls the speculator already started to the step's job, which
+                        # executes the rest together so same-endpoint key lookups share one request
+                        parsed_args: dict = {}
+                        outcomes: dict = {}
+                        started: dict = {}
+                        calls = []
+                        for tool_call in function_calls:
+                            try:
+                                parsed_args[tool_call.id] = json.loads(tool_call.arguments)
+                            except json.JSONDecodeError as err:
+                                outcomes[tool_call.id] = err
+                                continue
+                            speculative_call = speculator.claim(tool_call.id, parsed_args[tool_call.id])
+                            if speculative_call:
+                                started[tool_call.id] = speculative_call
+                            calls.append((tool_call.id, tool_call.name, parsed_args[tool_call.id]))
+                        job = None
+                        if calls:
+                            job = job_manager.submit(thread_id, calls, started)
+                            try:
+                                async for frame in wait_for_job(job):
+                                    yield frame
+                            except asyncio.CancelledError:
+                                if job.background:
+                                    # The client left while a slow job ran: let it finish for the thread's next run
+                                    job_manager.detach(job, functools.partial(render_job_result, assistant_id))
+                                    recorder.output(render_job_status(thread_id, job.job_id, describe_calls(job.calls)))
+                                else:
+                                    job.cancelled.set()
+                                    job.future.cancel()
+                                raise
+                            if job.detached:
+                                outcomes.update({tool_call_id: JOB_DETACHED_OUTPUT for tool_call_id, _, _ in calls})
+                            else:
+                                outcomes.update(job.future.result())
+
+                        tool_outputs = []
+                        for tool_call in function_calls:
+                            try:
+                                outcome = outcomes[tool_call.id]
+                                if isinstance(outcome, Exception):
+                                    raise outcome
+                                if outcome is JOB_DETACHED_OUTPUT:
+                                    tool_outputs.append({"output": outcome, "tool_call_id": tool_call.id})
+                                    continue
+                                # Storing the result may spill older ones to disk
+                                widget_html, serialized_response = await asyncio.to_thread(
+                                    render_tool_result,
+                                    assistant_id,
+                                    thread_id,
+                                    tool_call.id,
+                                    tool_call.name,
+                                    parsed_args[tool_call.id],
+                                    outcome
+                                )
+
+                                # Yield the widget
+                                recorder.output(widget_html)
+                                yield sse_format(
+                                    "toolOutput",
+                                    widget_html
+                                )
+
+                                tool_outputs.append({
+                                    "output": serialized_response,
+                                    "tool_call_id": tool_call.id
+                                })
+
+                            except Exception as err:
+                                logger.error(f"Failed to execute function: {err}")
+                                error_message = f"Error executing function: {str(err)}"
+                                error_html = f"<pre class='toolOutput error'>{html.escape(error_message)}</pre>"
+                                recorder.output(error_html)
+                                yield sse_format(
+                                    "toolOutput",
+                                    error_html
+                                )
+                                tool_outputs.append({
+                                    "output": error_message,
+                                    "tool_call_id": tool_call.id
+                                })
+
+                        if job is not None and job.background and not job.detached:
+                            await asyncio.to_thread(
+                                job_manager.finish,
+                                job,
+                                "\n\n".join(tool_output["output"] for tool_output in tool_outputs)
+                            )
+
+                        # Continue the run with the outputs, streaming its next step
+                        events = backend.submit_tool_outputs(thread_id, tool_calls_required.run_id, tool_outputs, selection)
                         # proceed to rerun the loop
                         break
                     else:
@@ -328,11 +580,82 @@ async def stream_response(
                     # Normal SSE events: yield them to the client
                     yield event
 
+    async def wait_for_job(job: Job) -> AsyncGenerator:
+        """
+        Waits for a run step's tool calls. If they are still running after JOB_AFTER_SECONDS,
+        they become a background job and their progress is streamed until they finish. Past
+        JOB_MAX_WAIT_SECONDS the job is detached and the run goes on without its result.
+        """
+        waiting = asyncio.wrap_future(job.future)
+        done, _ = await asyncio.wait({waiting}, timeout=JOB_AFTER_SECONDS)
+        if done:
+            return
+
+        await asyncio.to_thread(job_manager.promote, job)
+        yield sse_format("toolOutput", templates.get_template("components/job-progress.html").render(
+            job_id=job.job_id,
+            description=describe_calls(job.calls)
+        ))
+        while not done:
+            if job.elapsed > JOB_MAX_WAIT_SECONDS:
+                job_manager.detach(job, functools.partial(render_job_result, assistant_id))
+                # Leave a placeholder that polls for the result
+                placeholder = render_job_status(thread_id, job.job_id, describe_calls(job.calls), job.status)
+                recorder.output(placeholder)
+                yield sse_format("toolOutput", placeholder)
+                return
+            done, _ = await asyncio.wait({waiting}, timeout=JOB_PROGRESS_SECONDS)
+            yield sse_format(f"jobProgress{job.job_id}", html.escape(job.status))
+
+    async def guarded_event_generator(selection: ToolSelection | None):
+        """
+        Wraps event_generator so speculative tool calls never outlive the run.
+        """
+        try:
+            async for frame in event_generator(selection):
+                yield frame
+        except asyncio.CancelledError:
+            # No client came back for the run: stop it upstream. Tool calls are stopped by event_generator,
+            # and speculative ones below.
+            metrics.increment("runs.cancelled")
+            if run_state["run_id"]:
+                try:
+                    await backend.cancel_run(thread_id, run_state["run_id"])
+                except Exception as e:
+                    metrics.increment("runs.cancel_failed")
+                    logger.warning(f"Could not cancel run {run_state['run_id']}: {e}")
+            raise
+        finally:
+            speculator.cancel_all()
+            account_prefetcher.cancel(thread_id)
+            if recorder:
+                try:
+                    await asyncio.to_thread(
+                        thread_store.add_turn, thread_id, assistant_id, "assistant", recorder.html(), recorder.text()
+                    )
+                except Exception as e:
+                    logger.error(f"Could not store the assistant turn: {e}")
+
+    async def slot_stream(messages: list) -> AsyncGenerator:
+        """
+        Posts the results of background jobs that finished since the last run and the
+        messages queued for this run slot, then streams the run.
+        """
+        for finished_job in await asyncio.to_thread(thread_store.take_undelivered_jobs, thread_id):
+            await backend.add_message(
+                thread_id,
+                f"System: The background query ({finished_job.description}) has finished:\n{finished_job.output}"
+            )
+        for content in messages:
+            await backend.add_message(thread_id, content)
+        # Offer only the tools and schema sections these messages call for
+        selection = tool_router.select(thread_id, messages)
+        async for frame in guarded_event_generator(selection):
+            yield frame
+
+    broadcast = await run_coordinator.receive(thread_id, slot, slot_stream)
     return StreamingResponse(
-        event_generator(),
+        broadcast.subscribe(),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-        }
+        headers=SSE_HEADERS
     )
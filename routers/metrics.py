@@ -0,0 +1,22 @@
+from fastapi import APIRouter
+
+from utils.account_index import account_index
+from utils.metrics import metrics
+from utils.query_cost import describe_rules
+
+router = APIRouter(prefix="/metrics", tags=["Metrics"])
+
+
+@router.get("/")
+async def read_metrics() -> dict:
+    """
+    Report process-wide counters, derived rates and the query cost rules with their hit counts.
+    """
+    counters = metrics.snapshot()
+    prefetch_lookups = counters.get("prefetch.hit", 0) + counters.get("prefetch.miss", 0)
+    return {
+        "counters": counters,
+        "prefetch_hit_rate": counters.get("prefetch.hit", 0) / prefetch_lookups if prefetch_lookups else None,
+        "account_index": {"loaded": account_index.loaded, "accounts": len(account_index)},
+        "query_cost_rules": describe_rules()
+    }
@@ -6,7 +6,7 @@ from fastapi.responses import RedirectResponse
 from fastapi.templating import Jinja2Templates
 from openai import AsyncOpenAI
 
-from utils.create_assistant import create_or_update_assistant, request
+from utils.create_assistant import AssistantConfigError, create_or_update_assistant, request
 from utils.create_assistant import update_env_file
 
 # Configure logger
@@ -68,14 +68,17 @@ async def create_update_assistant(
     Create a new assistant or update an existing one.
     Returns the assistant ID and status of the operation.
     """
-    assistant_id = os.getenv("ASSISTANT_ID")
+    assistant_id = os.getenv("ASSISTANT_ID", "")
 
-    assistant_id: str = await create_or_update_assistant(
-        client=client,
-        assistant_id=assistant_id,
-        request=request,
-        logger=logger
-    )
+    try:
+        assistant_id = await create_or_update_assistant(
+            client=client,
+            assistant_id=assistant_id,
+            request=request,
+            logger=logger
+        )
+    except AssistantConfigError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     if not assistant_id:
         raise HTTPException(status_code=400, detail="Failed to create or update assistant")
 
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import time
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import HTMLResponse
+from fastapi.templating import Jinja2Templates
+
+from utils.jobs import JOB_MAX_SECONDS, JOB_PROGRESS_SECONDS
+from utils.llm_backend import LLMBackend, get_backend
+from utils.thread_store import thread_store
+from utils.tool_executor import job_manager
+
+logger: logging.Logger = logging.getLogger("uvicorn.error")
+
+router = APIRouter(prefix="/threads", tags=["Threads"])
+templates = Jinja2Templates(directory="templates")
+
+
+@router.get("/")
+async def list_threads(q: str = "") -> HTMLResponse:
+    """
+    Render the most recent conversations, or those whose messages match `q`.
+    """
+    if q.strip():
+        threads = await asyncio.to_thread(thread_store.search, q)
+    else:
+        threads = await asyncio.to_thread(thread_store.threads)
+    return HTMLResponse(content=templates.get_template("components/thread-list.html").render(threads=threads))
+
+
+@router.get("/{thread_id}/turns")
+async def read_turns(thread_id: str, before: int) -> HTMLResponse:
+    """
+    Render the page of cached turns preceding `before`, with a control to load the page before it.
+    """
+    turns, has_more = await asyncio.to_thread(thread_store.turns, thread_id, before)
+    return HTMLResponse(content=templates.get_template("components/thread-turns.html").render(
+        thread_id=thread_id,
+        turns=turns,
+        has_more=has_more
+    ))
+
+
+@router.get("/{thread_id}/jobs/{job_id}")
+async def read_job(thread_id: str, job_id: str) -> HTMLResponse:
+    """
+    Render a background job's result once it has finished, or its progress and a
+    trigger to check again while it is still running.
+    """
+    record = await asyncio.to_thread(thread_store.job, job_id)
+    if record is None or record.thread_id != thread_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    status, progress = record.status, ""
+    if status == "running":
+        job = job_manager.get(job_id)
+        if job is not None:
+            progress = job.status
+        elif time.time() - record.started_at > JOB_MAX_SECONDS:
+            # The process running it has gone
+            status = "interrupted"
+
+    return HTMLResponse(content=templates.get_template("components/job-status.html").render(
+        thread_id=thread_id,
+        job_id=job_id,
+        status=status,
+        description=record.description,
+        progress=progress,
+        html=record.html,
+        trigger=f"load delay:{int(JOB_PROGRESS_SECONDS)}s"
+    ))
+
+
+@router.delete("/{thread_id}")
+async def delete_thread(
+    thread_id: str,
+    backend: LLMBackend = Depends(lambda: get_backend())
+) -> HTMLResponse:
+    """
+    Forget a conversation locally and delete it from the backend.
+    """
+    await asyncio.to_thread(thread_store.delete, thread_id)
+    try:
+        await backend.delete_thread(thread_id)
+    except Exception as e:
+        logger.warning(f"Could not delete thread {thread_id}: {e}")
+    return HTMLResponse(content="")
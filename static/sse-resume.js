@@ -0,0 +1,22 @@
+/*
+Resume runs across sse.js reconnects
+====================================
+When a connection fails for good, sse.js opens a new EventSource on the element's
+sse-connect URL. A new EventSource sends no Last-Event-ID header, so the server would
+replay the run from its first frame and every message would appear twice. Keep the ID
+of the last frame received in the URL instead, as `resume`, so the reconnect picks up
+after it.
+*/
+
+(function() {
+  document.addEventListener('htmx:sseMessage', function(event) {
+    var lastEventId = event.detail && event.detail.lastEventId
+    var run = event.target.closest('[sse-connect]')
+    if (!lastEventId || !run) {
+      return
+    }
+    var url = new URL(run.getAttribute('sse-connect'), window.location.href)
+    url.searchParams.set('resume', lastEventId)
+    run.setAttribute('sse-connect', url.pathname + url.search)
+  })
+})()
@@ -0,0 +1,17 @@
+import os
+import tempfile
+
+# utils.tools builds the endpoint URLs at import time
+os.environ.setdefault("COMMUNITY_ARCHIVE_URL", "http://archive.test")
+
+# Keep the stores the modules create at import time out of the working copy's .cache
+_scratch = tempfile.mkdtemp(prefix="chat-with-archive-tests-")
+os.environ.setdefault("THREAD_STORE_PATH", os.path.join(_scratch, "threads.sqlite3"))
+for variable, name in (
+    ("RESULT_STORE_DIR", "results"),
+    ("RUN_LOCK_DIR", "locks"),
+    ("ROLLUP_DIR", "rollups"),
+    ("SIMILARITY_INDEX_DIR", "similarity"),
+    ("SOCIAL_GRAPH_SNAPSHOT_DIR", "graph"),
+):
+    os.environ.setdefault(variable, os.path.join(_scratch, name))
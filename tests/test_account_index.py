@@ -0,0 +1,72 @@
+from utils.account_index import AccountIndex, run_lookup_tool
+
+
+def account(account_id, username, followers=0, updated_at="2024-01-01"):
+    return {
+        "account_id": account_id, "username": username, "account_display_name": username.title(),
+        "num_tweets": 1, "num_followers": followers, "num_following": 0, "num_likes": 0, "updated_at": updated_at,
+    }
+
+
+class Tables:
+    """Serves fake account tables and records the params of every fetch."""
+
+    def __init__(self, **tables):
+        self.tables = tables
+        self.fetches = []
+
+    def __call__(self, table, params):
+        self.fetches.append((table, dict(params)))
+        if table not in self.tables:
+            raise ConnectionError(f"no table {table}")
+        rows = self.tables[table]
+        if "updated_at" in params:
+            since = params["updated_at"].removeprefix("gt.")
+            rows = [row for row in rows if row["updated_at"] > since]
+        yield rows
+
+
+def test_updated_at_refreshes_are_incremental():
+    tables = Tables(all_account=[account(1, "alice", 5), account(2, "bob", 1)])
+    index = AccountIndex()
+    index.refresh(tables)
+    tables.tables["all_account"] = [account(1, "alice", 50, updated_at="2024-02-01"), account(2, "bob", 1)]
+    assert index.refresh(tables) == 1
+    assert tables.fetches[-1][1]["updated_at"] == "gt.2024-01-01"
+    assert index.lookup("ALICE")["num_followers"] == 50
+    assert "picked up by updated_at" in index.freshness()
+
+
+def test_account_table_is_reloaded_in_full():
+    tables = Tables(account=[account(1, "alice", 5), account(2, "bob", 1)])
+    index = AccountIndex()
+    index.refresh(tables)
+    # Changed counts and removed accounts both show up, though no row is newer than before
+    tables.tables["account"] = [account(1, "alice", 50)]
+    assert index.refresh(tables) == 1
+    assert all("created_at" not in params and "updated_at" not in params for _, params in tables.fetches)
+    assert index.lookup("alice")["num_followers"] == 50
+    assert index.lookup("bob") is None
+    assert "reloaded in full" in index.freshness()
+
+
+def test_lookup_tool_reads_the_index_and_says_how_fresh_it_is():
+    index = AccountIndex()
+    index.refresh(Tables(all_account=[account(1, "visakanv", 100), account(2, "visa", 3)]))
+    rows, notes = run_lookup_tool({"usernames": ["@VisakanV", "nobody"], "prefix": "visa"}, index)
+    assert [row["username"] for row in rows] == ["visakanv", "visakanv", "visa"]
+    assert "Not in the archive: nobody" in notes
+    assert any("local account index" in note for note in notes)
+
+
+def test_lookup_tool_falls_back_to_the_api_without_an_index():
+    requests = []
+
+    def request_accounts(params):
+        requests.append(params)
+        return [account(1, "visakanv", 100)]
+
+    rows, notes = run_lookup_tool({"usernames": ["visakanv", "bad name!"]}, AccountIndex(), request_accounts)
+    assert requests[0]["or"] == "(username.ilike.visakanv,username.ilike.badname)"
+    assert [row["username"] for row in rows] == ["visakanv"]
+    assert "Not in the archive: bad name!" in notes
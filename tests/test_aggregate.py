@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from utils.aggregate import aggregate_rows, run_aggregate_tool, time_bucket
+
+ROWS = [
+    {"account": {"username": "alice"}, "created_at": "2024-01-05T10:00:00Z", "favorite_count": 3},
+    {"account": {"username": "bob"}, "created_at": "2024-01-20T10:00:00Z", "favorite_count": 12},
+    {"account": {"username": "alice"}, "created_at": "2024-02-01T10:00:00Z", "favorite_count": "7"},
+    {"account": {"username": "alice"}, "created_at": None, "favorite_count": None},
+]
+
+
+def test_count_by_embedded_column():
+    assert aggregate_rows(ROWS, "count", group_by="account.username") == [
+        {"account.username": "alice", "count": 3},
+        {"account.username": "bob", "count": 1},
+    ]
+
+
+def test_sum_skips_missing_values():
+    result = aggregate_rows(ROWS, "sum", group_by="account.username", value_column="favorite_count")
+    assert result == [
+        {"account.username": "bob", "sum_favorite_count": 12},
+        {"account.username": "alice", "sum_favorite_count": 10},
+    ]
+
+
+def test_histogram_is_chronological_and_drops_missing_timestamps():
+    assert aggregate_rows(ROWS, "histogram", group_by="created_at", bucket="month") == [
+        {"created_at_month": "2024-01", "count": 2},
+        {"created_at_month": "2024-02", "count": 1},
+    ]
+
+
+def test_top_k_ranks_rows():
+    result = aggregate_rows(ROWS, "top_k", group_by="account.username", value_column="favorite_count", k=2)
+    assert result == [
+        {"account.username": "bob", "favorite_count": 12},
+        {"account.username": "alice", "favorite_count": "7"},
+    ]
+
+
+def test_distinct_count():
+    assert aggregate_rows(ROWS, "distinct_count", value_column="account.username") == [{"distinct_account.username": 2}]
+
+
+def test_distinct_count_per_group_and_histogram_sums():
+    rows = ROWS + [{"account": {"username": "bob"}, "created_at": "2024-02-03T10:00:00Z", "favorite_count": 1}]
+    assert aggregate_rows(rows, "distinct_count", group_by="created_at", value_column="favorite_count", k=1) == [
+        {"created_at": "2024-01-05T10:00:00Z", "distinct_favorite_count": 1}
+    ]
+    assert aggregate_rows(rows, "histogram", group_by="created_at", value_column="favorite_count") == [
+        {"created_at_month": "2024-01", "sum_favorite_count": 15},
+        {"created_at_month": "2024-02", "sum_favorite_count": 8},
+    ]
+
+
+def test_mixed_type_and_missing_keys_are_grouped():
+    rows = [{"key": 1}, {"key": "1"}, {"key": None}, {"key": 1}, {}]
+    result = aggregate_rows(rows, "count", group_by="key")
+    assert result == [{"key": 1, "count": 2}, {"key": None, "count": 2}, {"key": "1", "count": 1}]
+    # Results hold plain Python numbers, ready to be sent to the model
+    json.dumps(result)
+
+
+def test_empty_rows():
+    assert aggregate_rows([], "count", group_by="key") == []
+    assert aggregate_rows([], "count") == []
+    assert aggregate_rows([], "top_k", value_column="n") == []
+
+
+def test_invalid_arguments_are_explained():
+    with pytest.raises(ValueError, match="value_column"):
+        aggregate_rows(ROWS, "sum")
+    with pytest.raises(ValueError, match="Unknown operation"):
+        aggregate_rows(ROWS, "median")
+
+
+def test_time_bucket_weeks():
+    assert time_bucket("2024-01-01T00:00:00Z", "week") == "2024-W01"
+    assert time_bucket(None, "day") is None
+
+
+def test_run_aggregate_tool_fetches_only_needed_columns():
+    requests = []
+
+    def fetch_rows(source, params, max_rows):
+        requests.append((source, params))
+        return ROWS, True
+
+    result, notes = run_aggregate_tool(
+        {"source": "get_tweets", "operation": "count", "group_by": "account.username", "filters": {"account_id": "eq.1"}},
+        fetch_rows
+    )
+    assert requests == [("get_tweets", {"account_id": "eq.1", "select": "account(username)"})]
+    assert result[0] == {"account.username": "alice", "count": 3}
+    assert any("narrow the filters" in note for note in notes)
@@ -0,0 +1,56 @@
+from utils.batching import PreparedCall, batch_key, merge_params, plan_batches, split_rows
+
+ACCOUNT = {"name": "get_account_info", "primary_key": "account_id"}
+TWEETS = {"name": "get_tweets", "primary_key": "tweet_id"}
+
+
+def call(tool_call_id, params, endpoint=ACCOUNT):
+    return PreparedCall(tool_call_id, endpoint["name"], endpoint, params)
+
+
+def test_batch_key_needs_a_single_eq_lookup_on_a_unique_column():
+    assert batch_key(call("a", {"account_id": "eq.1"})) is not None
+    assert batch_key(call("a", {"username": "eq.alice"})) is not None
+    assert batch_key(call("a", {"account_id": "gt.1"})) is None
+    assert batch_key(call("a", {"account_id": "eq.1", "username": "eq.alice"})) is None
+    assert batch_key(call("a", {"account_id": "eq.1", "offset": 10})) is None
+    assert batch_key(call("a", {"account_id": "eq.1", "select": "id:account_id"})) is None
+    assert batch_key(call("a", {"account_id": "eq.1,2"})) is None
+
+
+def test_plan_batches_groups_calls_with_the_same_other_params():
+    calls = [
+        call("a", {"account_id": "eq.1", "select": "username"}),
+        call("b", {"account_id": "eq.2", "select": "username", "limit": 5}),
+        call("c", {"account_id": "eq.3", "select": "account_id"}),
+        call("d", {"tweet_id": "eq.9"}, TWEETS),
+        call("e", {"account_id": "gt.3"}),
+    ]
+    batches, singles = plan_batches(calls)
+    assert [(column, [item.tool_call_id for item in batch]) for column, batch in batches] == [("account_id", ["a", "b"])]
+    assert sorted(item.tool_call_id for item in singles) == ["c", "d", "e"]
+
+
+def test_merge_and_split_round_trip():
+    calls = [
+        call("a", {"account_id": "eq.1", "select": "username"}),
+        call("b", {"account_id": "eq.2", "select": "username", "limit": 0}),
+        call("c", {"account_id": "eq.1", "select": "username"}),
+        call("d", {"account_id": "eq.4", "select": "username"}),
+    ]
+    params, added = merge_params(calls, "account_id")
+    assert params == {"select": "username,account_id", "account_id": "in.(1,2,4)", "limit": 3}
+    assert added
+
+    rows = [{"account_id": 1, "username": "alice"}, {"account_id": 2, "username": "bob"}]
+    assert split_rows(rows, calls, "account_id", added) == {
+        "a": [{"username": "alice"}],
+        "b": [],
+        "c": [{"username": "alice"}],
+        "d": [],
+    }
+
+
+def test_merge_keeps_a_select_that_already_has_the_key():
+    params, added = merge_params([call("a", {"account_id": "eq.1", "select": "*"})], "account_id")
+    assert params["select"] == "*" and not added
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import re
+import time
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from routers import chat
+from utils import run_coordinator, tool_executor
+from utils.llm_backend import (
+    LLMBackend, MessageStarted, RunCompleted, RunStarted, StubBackend, TextDelta, ToolCall, ToolCallDelta,
+    ToolCallsRequired, ToolStepStarted
+)
+from utils.metrics import metrics
+from utils.thread_store import thread_store
+
+
+class ScriptedBackend(LLMBackend):
+    """Streams one step of parallel tool calls, then a fixed reply once their outputs are submitted."""
+    name = "scripted"
+
+    def __init__(self, calls):
+        self.calls = [ToolCall(f"call_{index}", name, json.dumps(args)) for index, (name, args) in enumerate(calls)]
+        self.tool_outputs = []
+        self.messages = []
+
+    async def create_thread(self):
+        return "thread_scripted"
+
+    async def delete_thread(self, thread_id):
+        pass
+
+    async def add_message(self, thread_id, content):
+        self.messages.append(content)
+
+    async def run(self, assistant_id, thread_id, selection=None):
+        yield RunStarted("run_1")
+        yield ToolStepStarted("step_1")
+        for index, call in enumerate(self.calls):
+            yield ToolCallDelta(index, call.id, call.name, "")
+            yield ToolCallDelta(index, None, None, call.arguments)
+            # Leave time for anything started on complete arguments to run
+            await asyncio.sleep(0.05)
+        yield ToolCallsRequired("run_1", self.calls)
+
+    async def submit_tool_outputs(self, thread_id, run_id, tool_outputs, selection=None):
+        self.tool_outputs.extend(tool_outputs)
+        yield RunStarted(run_id)
+        yield MessageStarted("msg_1")
+        yield TextDelta("Done.")
+        yield RunCompleted()
+
+    async def cancel_run(self, thread_id, run_id):
+        pass
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    """Record the upstream requests tool calls make, answering each key lookup with one row per key."""
+    made = []
+
+    def make_request(endpoint, params):
+        made.append(dict(params))
+        operator, _, values = params["account_id"].partition(".")
+        keys = values.strip("()").split(",") if operator == "in" else [values]
+        return [{"account_id": key, "username": f"user{key}"} for key in keys]
+
+    monkeypatch.setattr(tool_executor, "make_request", make_request)
+    return made
+
+
+def chat_client(monkeypatch, backend):
+    monkeypatch.setattr(chat, "get_backend", lambda: backend)
+    app = FastAPI()
+    app.include_router(chat.router)
+    return TestClient(app)
+
+
+def send(client, thread_id, message="hello"):
+    """Send a message on a thread through the chat routes, returning the run slot it was queued for."""
+    sent = client.post(f"/assistants/asst/messages/{thread_id}/send", data={"userInput": message})
+    return re.search(r"slot=(\d+)", sent.text).group(1)
+
+
+def run_thread(monkeypatch, backend, thread_id, message="hello"):
+    """Send a message and read its run's SSE stream to the end."""
+    with chat_client(monkeypatch, backend) as client:
+        slot = send(client, thread_id, message)
+        return client.get(f"/assistants/asst/messages/{thread_id}/receive", params={"slot": slot}).text
+
+
+def test_parallel_key_lookups_share_one_request(monkeypatch, requests):
+    backend = ScriptedBackend([
+        ("get_account_info", {"account_id": f"eq.{account_id}", "select": "account_id,username"})
+        for account_id in (11, 12, 13)
+    ])
+    stream = run_thread(monkeypatch, backend, "thread_batched")
+
+    assert requests == [{"account_id": "in.(11,12,13)", "select": "account_id,username", "limit": 3}]
+    outputs = {output["tool_call_id"]: output["output"] for output in backend.tool_outputs}
+    assert [f"user{account_id}" in outputs[f"call_{index}"] for index, account_id in enumerate((11, 12, 13))] == [True] * 3
+    assert "endStream" in stream
+
+
+def test_tool_errors_are_escaped_and_the_turn_is_stored(monkeypatch, requests):
+    backend = ScriptedBackend([("get_<b>missing</b>", {})])
+    stream = run_thread(monkeypatch, backend, "thread_error")
+
+    assert "Endpoint get_&lt;b&gt;missing&lt;/b&gt; not found" in stream
+    assert "Endpoint get_<b>" not in stream
+    turns, _ = thread_store.turns("thread_error")
+    assert [turn.role for turn in turns] == ["user", "assistant"]
+    assert "get_&lt;b&gt;missing" in turns[-1].html
+
+
+def test_a_new_event_source_resumes_from_the_url(monkeypatch, requests):
+    backend = ScriptedBackend([("get_account_info", {"account_id": "eq.11"})])
+    with chat_client(monkeypatch, backend) as client:
+        slot = send(client, "thread_resumed")
+        url = "/assistants/asst/messages/thread_resumed/receive"
+        frames = client.get(url, params={"slot": slot}).text.strip().split("\n\n")
+        last_seen = frames[2].splitlines()[0].removeprefix("id: ")
+
+        # What sse.js opens after giving up on a connection: no Last-Event-ID header, the last ID in the URL
+        resumed = client.get(url, params={"slot": slot, "resume": last_seen}).text.strip().split("\n\n")
+        assert resumed == frames[3:]
+
+
+def test_a_message_after_an_unopened_run_gets_a_run_of_its_own(monkeypatch, requests):
+    monkeypatch.setattr(run_coordinator, "RUN_SLOT_JOIN_SECONDS", 0)
+    backend = ScriptedBackend([("get_account_info", {"account_id": "eq.11"})])
+    with chat_client(monkeypatch, backend) as client:
+        # The first message's run element never connects
+        first_slot = send(client, "thread_unopened", "first")
+        second_slot = send(client, "thread_unopened", "second")
+        assert int(second_slot) == int(first_slot) + 1
+
+        client.get("/assistants/asst/messages/thread_unopened/receive", params={"slot": second_slot})
+        assert [message.rsplit("\n", 1)[1] for message in backend.messages] == ["first", "second"]
+
+
+@pytest.fixture
+def slow_requests(monkeypatch):
+    """Upstream requests that each take 0.4 seconds."""
+    def make_request(endpoint, params):
+        time.sleep(0.4)
+        return [{"tweet_id": "1", "full_text": "slow"}]
+
+    monkeypatch.setattr(tool_executor, "make_request", make_request)
+
+
+def test_a_speculated_call_runs_as_a_job_with_progress(monkeypatch, slow_requests):
+    monkeypatch.setattr(chat, "JOB_AFTER_SECONDS", 0.1)
+    monkeypatch.setattr(chat, "JOB_PROGRESS_SECONDS", 0.05)
+    hits = metrics.get("speculation.hit")
+    backend = ScriptedBackend([("get_tweets", {"account_id": "eq.11", "limit": 5})])
+    stream = run_thread(monkeypatch, backend, "thread_slow")
+
+    assert metrics.get("speculation.hit") == hits + 1
+    assert "Running get_tweets in the background" in stream
+    assert "event: jobProgress" in stream
+    assert "slow" in backend.tool_outputs[0]["output"]
+
+
+def test_a_speculated_call_is_detached_after_the_maximum_wait(monkeypatch, slow_requests):
+    monkeypatch.setattr(chat, "JOB_AFTER_SECONDS", 0.05)
+    monkeypatch.setattr(chat, "JOB_PROGRESS_SECONDS", 0.05)
+    monkeypatch.setattr(chat, "JOB_MAX_WAIT_SECONDS", 0.1)
+    backend = ScriptedBackend([("get_tweets", {"account_id": "eq.11", "limit": 5})])
+    run_thread(monkeypatch, backend, "thread_detached")
+
+    assert backend.tool_outputs == [{"output": chat.JOB_DETACHED_OUTPUT, "tool_call_id": "call_0"}]
+
+
+def test_the_stub_backend_drives_a_full_run(monkeypatch, requests):
+    backend = StubBackend()
+    stream = run_thread(monkeypatch, backend, "thread_stub", "posts about tea")
+
+    assert "find_similar_tweets" in stream
+    assert backend.conversations["thread_stub"][-1]["content"].startswith("The tool returned")
+    assert "data: returned " in stream
+    assert stream.rstrip().endswith("data: DONE")
+    turns, _ = thread_store.turns("thread_stub")
+    assert [turn.role for turn in turns] == ["user", "assistant"]
@@ -0,0 +1,92 @@
+import pytest
+
+from utils.conversation import ConversationBuilder, format_tree, run_conversation_tool
+
+# tweet_id -> (parent, likes); 1 is the root of the conversation
+TWEETS = {
+    "1": (None, 50),
+    "2": ("1", 30), "3": ("1", 20), "4": ("1", 10),
+    "5": ("2", 5), "6": ("2", 4),
+    "7": ("5", 1),
+}
+
+
+class FakeArchive:
+    """Serves get_tweets from TWEETS, honouring the in.(...) filters, order and limit, and records each request."""
+
+    def __init__(self, tweets=TWEETS):
+        self.tweets = tweets
+        self.requests = []
+
+    def __call__(self, function_name, params):
+        assert function_name == "get_tweets"
+        self.requests.append(params)
+        column = "tweet_id" if "tweet_id" in params else "reply_to_tweet_id"
+        wanted = params[column][len("in.("):-1].split(",")
+        rows = [
+            {
+                "tweet_id": tweet_id, "reply_to_tweet_id": parent, "favorite_count": likes,
+                "full_text": f"tweet {tweet_id}", "created_at": "2024-01-02T00:00:00+00:00",
+                "account": {"username": f"user{tweet_id}"},
+            }
+            for tweet_id, (parent, likes) in self.tweets.items()
+            if (tweet_id if column == "tweet_id" else parent) in wanted
+        ]
+        if params.get("order") == "favorite_count.desc":
+            rows.sort(key=lambda row: -row["favorite_count"])
+        return rows[:params["limit"]]
+
+
+def test_build_makes_one_request_per_level():
+    archive = FakeArchive()
+    rows, notes = ConversationBuilder(archive).build("1")
+    assert [(row["tweet_id"], row["depth"]) for row in rows] == [
+        ("1", 0), ("2", 1), ("5", 2), ("7", 3), ("6", 2), ("3", 1), ("4", 1)
+    ]
+    assert notes == []
+    # The root, then one reply_to_tweet_id=in.(...) request for each of the four levels
+    assert len(archive.requests) == 5
+    assert archive.requests[2]["reply_to_tweet_id"] == "in.(2,3,4)"
+
+
+def test_build_reuses_the_reply_index():
+    archive = FakeArchive()
+    builder = ConversationBuilder(archive)
+    builder.build("1")
+    archive.requests.clear()
+    rows, _ = builder.build("2")
+    assert [row["tweet_id"] for row in rows] == ["2", "5", "7", "6"]
+    assert archive.requests == []
+
+
+def test_build_keeps_the_most_liked_replies_and_the_requested_path():
+    rows, _ = ConversationBuilder(FakeArchive()).build("1", max_breadth=1)
+    assert [row["tweet_id"] for row in rows] == ["1", "2", "5", "7"]
+    assert rows[0]["omitted_replies"] == 2
+
+    rows, _ = ConversationBuilder(FakeArchive()).build("1", max_breadth=1, keep=("4",))
+    assert [row["tweet_id"] for row in rows] == ["1", "4"]
+
+
+def test_build_notes_the_depth_limit():
+    rows, notes = ConversationBuilder(FakeArchive()).build("1", max_depth=1)
+    assert [row["tweet_id"] for row in rows] == ["1", "2", "3", "4"]
+    assert notes == ["Replies deeper than 1 levels are not shown."]
+
+
+def test_build_rejects_a_missing_root():
+    with pytest.raises(ValueError, match="not in the archive"):
+        ConversationBuilder(FakeArchive()).build("99")
+
+
+def test_conversation_tool_starts_from_the_root_and_marks_the_tweet():
+    rows, notes, text = run_conversation_tool({"tweet_id": "7"}, ConversationBuilder(FakeArchive()), lambda _: None)
+    assert rows[0]["tweet_id"] == "1"
+    lines = text.splitlines()
+    assert lines[0] == "1 @user1 2024-01-02 50L: tweet 1"
+    assert "      * 7 @user7 2024-01-02 1L: tweet 7" in lines
+
+
+def test_format_tree_counts_omitted_replies():
+    rows, _ = ConversationBuilder(FakeArchive()).build("1", max_breadth=2, max_depth=1)
+    assert format_tree(rows).splitlines()[0].endswith("[+1 replies not shown]")
@@ -0,0 +1,60 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+from utils.create_assistant import config_fingerprint, create_or_update_assistant, request
+
+logger = logging.getLogger(__name__)
+
+
+class FakeAssistants:
+    def __init__(self):
+        self.updates = []
+
+    async def update(self, assistant_id, **parts):
+        self.updates.append((assistant_id, sorted(parts)))
+
+    async def create(self, **config):
+        return SimpleNamespace(id="asst_new")
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # The fingerprint and ID are written to .env in the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("ASSISTANT_FINGERPRINT", raising=False)
+    return SimpleNamespace(beta=SimpleNamespace(assistants=FakeAssistants()))
+
+
+def sync(client, assistant_id, config=request):
+    return asyncio.run(create_or_update_assistant(client, assistant_id, config, logger))
+
+
+def test_an_unchanged_config_is_not_sent(client, monkeypatch):
+    monkeypatch.setenv("ASSISTANT_FINGERPRINT", config_fingerprint(request, "asst_a"))
+    assert sync(client, "asst_a") == "asst_a"
+    assert client.beta.assistants.updates == []
+
+
+def test_only_the_changed_parts_are_sent(client, monkeypatch):
+    monkeypatch.setenv("ASSISTANT_FINGERPRINT", config_fingerprint(request, "asst_a"))
+    assert sync(client, "asst_a", {**request, "instructions": request["instructions"] + "\nBe brief."}) == "asst_a"
+    assert client.beta.assistants.updates == [("asst_a", ["instructions"])]
+
+
+def test_a_fingerprint_for_another_assistant_sends_everything(client, monkeypatch):
+    monkeypatch.setenv("ASSISTANT_FINGERPRINT", config_fingerprint(request, "asst_a"))
+    assert sync(client, "asst_b") == "asst_b"
+    assert client.beta.assistants.updates == [("asst_b", ["instructions", "model", "name", "tools"])]
+    # The new assistant is now the one the fingerprint vouches for
+    assert sync(client, "asst_b") == "asst_b"
+    assert len(client.beta.assistants.updates) == 1
+
+
+def test_a_created_assistant_is_fingerprinted(client, tmp_path):
+    assert sync(client, "") == "asst_new"
+    env = (tmp_path / ".env").read_text()
+    assert "ASSISTANT_ID=asst_new\n" in env
+    assert f"ASSISTANT_FINGERPRINT={config_fingerprint(request, 'asst_new')}\n" in env
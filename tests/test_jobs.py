@@ -0,0 +1,93 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.jobs import JobManager, StartedCall, ToolCallCancelled, check_cancelled, report_progress, run_cancellable
+from utils.thread_store import ThreadStore
+
+_pool = ThreadPoolExecutor(max_workers=2)
+
+
+def make_manager(tmp_path, execute):
+    return JobManager(ThreadStore(path=str(tmp_path / "threads.sqlite3")), execute, workers=2)
+
+
+def test_a_job_executes_new_calls_and_waits_for_started_ones(tmp_path):
+    executed = []
+
+    def execute(calls, thread_id, cancelled):
+        executed.extend(calls)
+        report_progress("halfway")
+        return {tool_call_id: f"ran {name}" for tool_call_id, name, _ in calls}
+
+    started = StartedCall(_pool.submit(lambda: "speculated"), threading.Event())
+    manager = make_manager(tmp_path, execute)
+    job = manager.submit("thread_a", [("call_1", "get_tweets", {}), ("call_2", "get_likes", {})], {"call_1": started})
+
+    assert job.future.result(timeout=2) == {"call_1": "speculated", "call_2": "ran get_likes"}
+    assert executed == [("call_2", "get_likes", {})]
+    assert job.progress == "halfway"
+    time.sleep(0.05)
+    # Finished jobs that were never promoted are forgotten
+    assert manager.get(job.job_id) is None
+
+
+def test_cancelling_a_job_stops_the_calls_it_adopted(tmp_path):
+    cancelled = threading.Event()
+
+    def paging():
+        for _ in range(200):
+            check_cancelled()
+            time.sleep(0.01)
+        return "finished"
+
+    # Started the way the speculator starts calls
+    started = StartedCall(_pool.submit(contextvars.copy_context().run, run_cancellable, cancelled, paging), cancelled)
+    manager = make_manager(tmp_path, lambda calls, thread_id, cancelled: {})
+    job = manager.submit("thread_a", [("call_1", "get_tweets", {})], {"call_1": started})
+    time.sleep(0.05)
+    job.cancelled.set()
+
+    outcome = job.future.result(timeout=2)["call_1"]
+    assert isinstance(outcome, ToolCallCancelled)
+
+
+def test_a_detached_job_stores_its_result(tmp_path):
+    release = threading.Event()
+
+    def execute(calls, thread_id, cancelled):
+        release.wait(2)
+        return {"call_1": "rows"}
+
+    manager = make_manager(tmp_path, execute)
+    job = manager.submit("thread_a", [("call_1", "get_tweets", {})])
+    manager.promote(job)
+    manager.detach(job, lambda job, outcomes: (f"output {outcomes['call_1']}", "<p>rows</p>"))
+    assert manager.get(job.job_id) is job
+    release.set()
+    job.future.result(timeout=2)
+    time.sleep(0.05)
+
+    record = manager.store.job(job.job_id)
+    assert (record.status, record.output) == ("done", "output rows")
+    assert [finished.job_id for finished in manager.store.take_undelivered_jobs("thread_a")] == [job.job_id]
+
+
+def test_a_failed_detached_job_stores_its_error_escaped(tmp_path):
+    def execute(calls, thread_id, cancelled):
+        raise RuntimeError("upstream said <script>alert(1)</script>")
+
+    manager = make_manager(tmp_path, execute)
+    job = manager.submit("thread_a", [("call_1", "get_tweets", {})])
+    manager.promote(job)
+    manager.detach(job, lambda job, outcomes: ("unused", "unused"))
+    try:
+        job.future.result(timeout=2)
+    except RuntimeError:
+        pass
+    time.sleep(0.05)
+
+    record = manager.store.job(job.job_id)
+    assert record.status == "failed"
+    assert "&lt;script&gt;" in record.html and "<script>" not in record.html
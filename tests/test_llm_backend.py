@@ -0,0 +1,194 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from utils import llm_backend
+from utils.llm_backend import (
+    COMPACT_PROMPT_TOKENS, AssistantsBackend, ChatCompletionsBackend, LLMBackend, MessageStarted, RunCompleted,
+    RunStarted, StubBackend, TextDelta, ToolCallDelta, ToolCallsRequired, ToolStepStarted, Usage, answered_messages
+)
+from utils.metrics import metrics
+from utils.thread_store import ThreadStore
+from utils.tool_router import ToolRouter, ToolSelection, prompt_tokens
+
+
+async def collect(events):
+    return [event async for event in events]
+
+
+def test_backends_must_implement_every_operation():
+    with pytest.raises(TypeError):
+        LLMBackend()
+
+    class Partial(LLMBackend):
+        async def create_thread(self):
+            return "thread"
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_stub_run_loop():
+    async def scenario():
+        backend = StubBackend()
+        thread_id = await backend.create_thread()
+        await backend.add_message(thread_id, "System: Today's date is 2024-01-01\nposts about tea")
+
+        events = await collect(backend.run("asst", thread_id))
+        assert isinstance(events[0], RunStarted)
+        assert isinstance(events[1], ToolStepStarted)
+        required = events[-1]
+        assert isinstance(required, ToolCallsRequired)
+        assert [(call.name, call.arguments) for call in required.calls] == [("find_similar_tweets", '{"text": "posts about tea"}')]
+        # The arguments arrive in fragments after the fragment that names the call
+        deltas = [event for event in events if isinstance(event, ToolCallDelta)]
+        assert deltas[0].name == "find_similar_tweets"
+        assert "".join(delta.arguments for delta in deltas) == required.calls[0].arguments
+
+        events = await collect(backend.submit_tool_outputs(
+            thread_id, required.run_id, [{"tool_call_id": required.calls[0].id, "output": "x" * 42}]
+        ))
+        assert [type(event) for event in events[:2]] == [RunStarted, MessageStarted]
+        assert "".join(event.text for event in events if isinstance(event, TextDelta)).strip() == (
+            "The tool returned 42 characters of output."
+        )
+        assert isinstance(events[-2], Usage) and isinstance(events[-1], RunCompleted)
+
+        await backend.delete_thread(thread_id)
+        assert thread_id not in backend.conversations
+
+    asyncio.run(scenario())
+
+
+def test_stub_answers_without_a_tool_the_run_does_not_offer():
+    async def scenario():
+        backend = StubBackend()
+        thread_id = await backend.create_thread()
+        await backend.add_message(thread_id, "hello")
+        selection = ToolSelection(["get_tweets"], [], [], "", 0)
+        events = await collect(backend.run("asst", thread_id, selection))
+        assert "".join(event.text for event in events if isinstance(event, TextDelta)).strip() == "No tool was called."
+        assert isinstance(events[-1], RunCompleted)
+
+    asyncio.run(scenario())
+
+
+def test_chat_backend_deletes_its_conversation(tmp_path):
+    store = ThreadStore(path=os.path.join(tmp_path, "threads.sqlite3"))
+    backend = ChatCompletionsBackend(client=None, store=store)
+
+    async def scenario():
+        thread_id = await backend.create_thread()
+        await backend.add_message(thread_id, "hello")
+        assert store.conversation(thread_id) == [{"role": "user", "content": "hello"}]
+        await backend.delete_thread(thread_id)
+        assert store.conversation(thread_id) == []
+
+    asyncio.run(scenario())
+
+
+def test_answered_messages_drops_tool_calls_without_outputs():
+    messages = [
+        {"role": "user", "content": "one"},
+        {"role": "assistant", "tool_calls": [{"id": "a"}, {"id": "b"}]},
+        {"role": "tool", "tool_call_id": "a", "content": "rows"},
+        {"role": "user", "content": "two"},
+        {"role": "assistant", "tool_calls": [{"id": "c"}]},
+        {"role": "tool", "tool_call_id": "c", "content": "rows"},
+    ]
+    assert answered_messages(messages) == [messages[0], messages[3], messages[4], messages[5]]
+
+
+class FakeStream:
+    """An async stream that is its own context manager, like the OpenAI client's."""
+
+    def __init__(self, items):
+        self.items = items
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        for item in self.items:
+            yield item
+
+
+def test_chat_backend_counts_the_prompt_it_sends(tmp_path):
+    requests = []
+
+    async def create(**kwargs):
+        requests.append(kwargs)
+        delta = SimpleNamespace(content="hi", tool_calls=None)
+        return FakeStream([SimpleNamespace(id="chunk", usage=None, choices=[SimpleNamespace(delta=delta)])])
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    backend = ChatCompletionsBackend(client, store=ThreadStore(path=os.path.join(tmp_path, "threads.sqlite3")))
+    selection = ToolRouter(enabled=True).select("thread_a", ["who follows whom"])
+
+    async def scenario():
+        thread_id = await backend.create_thread()
+        await backend.add_message(thread_id, "hello")
+        for run_selection in (None, selection):
+            before = metrics.get("llm.prompt_tokens")
+            await collect(backend.run("asst", thread_id, run_selection))
+            sent = requests[-1]
+            assert metrics.get("llm.prompt_tokens") - before == prompt_tokens(sent["messages"][0]["content"], sent["tools"])
+
+    asyncio.run(scenario())
+    assert len(requests[1]["tools"]) < len(requests[0]["tools"])
+
+
+def test_assistants_backend_counts_the_assistants_own_configuration(monkeypatch):
+    monkeypatch.setattr(llm_backend, "_assistant_prompt_tokens", {})
+    retrieved = []
+    tool = SimpleNamespace(model_dump=lambda exclude_none: {"type": "function", "function": {"name": "get_tweets"}})
+
+    async def retrieve(assistant_id):
+        retrieved.append(assistant_id)
+        return SimpleNamespace(instructions="Answer from the archive.", tools=[tool])
+
+    client = SimpleNamespace(beta=SimpleNamespace(
+        assistants=SimpleNamespace(retrieve=retrieve),
+        threads=SimpleNamespace(runs=SimpleNamespace(
+            stream=lambda **kwargs: FakeStream([]),
+            submit_tool_outputs_stream=lambda **kwargs: FakeStream([])
+        ))
+    ))
+    backend = AssistantsBackend(client)
+    expected = prompt_tokens("Answer from the archive.", [{"type": "function", "function": {"name": "get_tweets"}}])
+
+    async def scenario():
+        before = metrics.get("llm.prompt_tokens")
+        await collect(backend.run("asst", "thread_a"))
+        await collect(backend.run("asst", "thread_b"))
+        # Steps after tool outputs resend the run's instructions and tools
+        await collect(backend.submit_tool_outputs("thread_a", "run_1", []))
+        assert metrics.get("llm.prompt_tokens") - before == 3 * expected
+
+    asyncio.run(scenario())
+    assert retrieved == ["asst"]
+
+
+def test_stub_counts_the_prompt_each_step_would_send():
+    async def scenario():
+        backend = StubBackend()
+        thread_id = await backend.create_thread()
+        await backend.add_message(thread_id, "posts about tea")
+        selection = ToolSelection(["get_tweets"], [], [], "", 7)
+        before = metrics.get("llm.prompt_tokens")
+        await collect(backend.run("asst", thread_id))
+        await collect(backend.run("asst", thread_id, selection))
+        assert metrics.get("llm.prompt_tokens") - before == COMPACT_PROMPT_TOKENS + 7
+
+    asyncio.run(scenario())
+
+
+def test_a_disabled_router_counts_nothing():
+    before = metrics.get("tool_router.prompt_tokens")
+    assert ToolRouter(enabled=False).select("thread_a", ["posts about tea"]) is None
+    assert metrics.get("tool_router.prompt_tokens") == before
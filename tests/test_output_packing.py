@@ -0,0 +1,55 @@
+from utils.output_packing import MIN_OUTPUT_TOKENS, pack_tool_output, resolve_budget
+from utils.tokens import context_ledger, count_tokens
+
+
+def tweet(index, text="short"):
+    return {
+        "tweet_id": str(index),
+        "created_at": "2024-01-01T00:00:00Z",
+        "full_text": text,
+        "favorite_count": index,
+        "avatar_media_url": f"https://pbs.twimg.com/profile_images/{index}/a_very_long_avatar_file_name.jpg",
+        "archive_upload_id": None,
+    }
+
+
+def test_small_result_is_sent_whole():
+    packed = pack_tool_output([tweet(1), tweet(2)], "get_tweets")
+    assert packed.rows_included == 2
+    assert "omitted" not in packed.text
+    assert packed.text.splitlines()[0].split("\t")[0] == "tweet_id"
+
+
+def test_large_result_fits_budget_and_says_what_was_left_out():
+    rows = [tweet(index, "word " * 40) for index in range(200)]
+    packed = pack_tool_output(rows, "get_tweets", total_rows=500)
+    assert packed.tokens <= packed.budget
+    assert 0 < packed.rows_included < 200
+    assert f"{packed.rows_included} of 500 rows shown" in packed.text
+    assert f"rows {packed.rows_included + 1}-500 omitted" in packed.text
+
+
+def test_empty_and_bulky_columns_go_first():
+    rows = [tweet(index, "word " * 40) for index in range(200)]
+    packed = pack_tool_output(rows, "get_tweets")
+    header = packed.text.splitlines()[0].split("\t")
+    assert "archive_upload_id" in packed.columns_omitted and "archive_upload_id" not in header
+    assert "full_text" in header and "tweet_id" in header
+
+
+def test_non_tabular_result_is_cut_to_budget():
+    packed = pack_tool_output({"message": "x" * 100000}, "get_tweets")
+    assert packed.rows_included == 0
+    assert len(packed.text) <= packed.budget * 4 + 200
+
+
+def test_budget_shrinks_with_remaining_context():
+    context_ledger.record("nearly-full", context_ledger.context_window - 1000)
+    assert resolve_budget("get_tweets", "nearly-full") == max(250, MIN_OUTPUT_TOKENS)
+    context_ledger.record("full", context_ledger.context_window)
+    assert resolve_budget("get_tweets", "full") == MIN_OUTPUT_TOKENS
+
+
+def test_count_tokens():
+    assert count_tokens("") == 0
+    assert count_tokens("hello world") >= 2
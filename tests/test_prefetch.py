@@ -0,0 +1,62 @@
+import threading
+import time
+
+from utils.prefetch import AccountPrefetcher, extract_handles
+
+ACCOUNT = {"account_id": "42", "username": "AmyB"}
+PROFILE = {"account_id": "42", "bio": "tea"}
+
+
+def archive(release=None):
+    def request(function_name, params):
+        if release is not None:
+            release.wait(2)
+        if function_name == "get_account_info":
+            return [ACCOUNT]
+        return [PROFILE]
+    return request
+
+
+def test_extract_handles():
+    assert extract_handles("ask @amy_b and @Bob, not me@example.com or @amy_b again") == ["amy_b", "Bob"]
+
+
+def test_a_thread_waits_for_its_own_prefetch():
+    release = threading.Event()
+    prefetcher = AccountPrefetcher(archive(release))
+    prefetcher.start("thread_a", "what does @amyb post?")
+    threading.Timer(0.05, release.set).start()
+
+    assert prefetcher.answer("get_account_info", {"username": "ilike.amyb", "select": "account_id"}, "thread_a") == [
+        {"account_id": "42"}
+    ]
+    # The account ID is known once the prefetch finished
+    assert prefetcher.answer("get_user_profiles", {"account_id": "eq.42", "limit": 1}, "thread_a") == [PROFILE]
+    assert prefetcher.answer("get_user_profiles", {"account_id": "eq.7"}, "thread_a") is None
+
+
+def test_other_threads_in_flight_prefetches_are_not_waited_for():
+    release = threading.Event()
+    prefetcher = AccountPrefetcher(archive(release))
+    prefetcher.start("thread_a", "@amyb")
+    prefetcher.start("thread_a", "@someone_else")
+
+    started = time.monotonic()
+    assert prefetcher.answer("get_account_info", {"username": "ilike.amyb"}, "thread_b") is None
+    assert prefetcher.answer("get_user_profiles", {"account_id": "eq.42"}, "thread_b") is None
+    assert time.monotonic() - started < 0.5
+
+    release.set()
+    prefetcher.answer("get_account_info", {"username": "ilike.amyb"}, "thread_a")
+    # Finished prefetches answer any thread
+    assert prefetcher.answer("get_account_info", {"username": "eq.AmyB"}, "thread_b") == [ACCOUNT]
+    assert prefetcher.answer("get_user_profiles", {"account_id": "eq.42"}, "thread_b") == [PROFILE]
+
+
+def test_lookups_with_other_filters_go_upstream():
+    prefetcher = AccountPrefetcher(archive())
+    prefetcher.start("thread_a", "@amyb")
+    assert prefetcher.answer("get_account_info", {"username": "ilike.amy*"}, "thread_a") is None
+    assert prefetcher.answer("get_account_info", {"username": "eq.amyb", "offset": 5}, "thread_a") is None
+    # eq is case-sensitive
+    assert prefetcher.answer("get_account_info", {"username": "eq.amyb"}, "thread_a") is None
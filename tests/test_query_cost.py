@@ -0,0 +1,52 @@
+import pytest
+
+from utils.query_cost import QueryRejected, apply_cost_rules, format_select, parse_select
+from utils.tools import ENDPOINT_SCHEMAS
+
+ENDPOINTS = {endpoint["name"]: endpoint for endpoint in ENDPOINT_SCHEMAS}
+
+
+def test_parse_select_round_trips():
+    select = "tweet_id,author:account!fk(username,profile(bio))"
+    assert format_select(parse_select(select)) == select
+
+
+def test_missing_and_large_limits_are_clamped():
+    params = {"select": "tweet_id"}
+    notes = apply_cost_rules(ENDPOINTS["get_tweets"], params)
+    assert params["limit"] == 50 and notes
+
+    params = {"select": "tweet_id", "limit": 500}
+    apply_cost_rules(ENDPOINTS["get_tweets"], params)
+    assert params["limit"] == 50
+
+
+def test_deep_offset_is_rejected():
+    with pytest.raises(QueryRejected, match="keyset|ordered column"):
+        apply_cost_rules(ENDPOINTS["get_tweets"], {"select": "tweet_id", "limit": 10, "offset": 10000})
+
+
+def test_unanchored_pattern_is_rejected_not_rewritten():
+    params = {"select": "tweet_id", "limit": 10, "full_text": "ilike.*@visakanv*"}
+    with pytest.raises(QueryRejected, match="phfts"):
+        apply_cost_rules(ENDPOINTS["get_tweets"], params)
+    assert params["full_text"] == "ilike.*@visakanv*"
+
+
+def test_unanchored_pattern_with_selective_filter_is_sent_as_is():
+    params = {"select": "tweet_id", "limit": 10, "account_id": "eq.1", "full_text": "ilike.*tpot*"}
+    assert apply_cost_rules(ENDPOINTS["get_tweets"], params) == []
+    assert params["full_text"] == "ilike.*tpot*"
+
+
+def test_select_star_on_tweets_is_projected_next_to_embeddings():
+    params = {"select": "*,account(*)", "limit": 10}
+    apply_cost_rules(ENDPOINTS["get_tweets"], params)
+    columns = parse_select(params["select"])
+    assert "*" not in columns and "full_text" in columns
+    assert "archive_upload_id" not in columns
+
+
+def test_deep_embedding_is_rejected():
+    with pytest.raises(QueryRejected):
+        apply_cost_rules(ENDPOINTS["get_tweets"], {"select": "account(profile(archive_upload(id)))", "limit": 1})
@@ -0,0 +1,79 @@
+import asyncio
+import io
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from routers import chat
+from utils.export import encode_parquet
+from utils.result_store import ResultStore, result_store
+
+
+def test_results_are_only_returned_for_their_thread(tmp_path):
+    store = ResultStore(directory=str(tmp_path), max_memory_rows=1)
+    store.put("call_a", "get_tweets", {}, [{"tweet_id": "1"}], "thread_a")
+    # Spills call_a to disk
+    store.put("call_b", "get_tweets", {}, [{"tweet_id": "2"}], "thread_b")
+
+    assert store.get("call_a", "thread_b") is None
+    assert store.page("call_a", thread_id="thread_b") is None
+    assert store.get("call_a", "thread_a").rows == [{"tweet_id": "1"}]
+    assert store.page("call_b", thread_id="thread_b") == ([{"tweet_id": "2"}], 1)
+
+
+def test_export_checks_the_thread_in_the_path():
+    result_store.put("call_export", "lookup_accounts", {}, [{"account_id": "1"}], "thread_a")
+    app = FastAPI()
+    app.include_router(chat.router)
+    client = TestClient(app)
+
+    response = client.get("/assistants/asst/messages/thread_b/results/call_export/export")
+    assert response.status_code == 404
+    # The right thread gets past the check, to the error for a tool that has no endpoint
+    response = client.get("/assistants/asst/messages/thread_a/results/call_export/export")
+    assert response.status_code == 400
+
+
+def test_the_parquet_link_needs_pyarrow(monkeypatch):
+    result_store.put("call_links", "get_tweets", {}, [{"tweet_id": "1"}], "thread_a")
+    monkeypatch.setattr(chat, "parquet_available", lambda: False)
+    widget = chat.render_result_widget("asst", "thread_a", "call_links")
+    assert "format=csv" in widget and "format=parquet" not in widget
+    monkeypatch.setattr(chat, "parquet_available", lambda: True)
+    assert "format=parquet" in chat.render_result_widget("asst", "thread_a", "call_links")
+
+
+def test_parquet_pages_are_encoded_off_the_event_loop():
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    async def pages():
+        yield [{"tweet_id": "1", "user": {"name": "amy"}, "note": None}]
+        yield [{"tweet_id": "2", "user": {"name": "bob"}, "note": "hi"}]
+
+    async def encode():
+        return b"".join([chunk async for chunk in encode_parquet(pages())])
+
+    table = pq.read_table(io.BytesIO(asyncio.run(encode())))
+    assert table.to_pylist() == [
+        {"tweet_id": "1", "user.name": "amy", "note": None},
+        {"tweet_id": "2", "user.name": "bob", "note": "hi"},
+    ]
+
+
+def test_spilled_results_are_loaded_back_and_gone_ones_are_404(tmp_path, monkeypatch):
+    store = ResultStore(directory=str(tmp_path), max_memory_rows=2)
+    store.put("call_a", "get_tweets", {}, [{"tweet_id": "1"}, {"tweet_id": "2"}], "thread_a")
+    store.put("call_b", "get_tweets", {}, [{"tweet_id": "3"}], "thread_a")
+    assert (tmp_path / "call_a.json").exists()
+    assert store.page("call_a", page_size=1, page=1, thread_id="thread_a") == ([{"tweet_id": "2"}], 2)
+    # Loading call_a back spilled call_b
+    assert not (tmp_path / "call_a.json").exists() and (tmp_path / "call_b.json").exists()
+
+    monkeypatch.setattr(chat, "result_store", store)
+    app = FastAPI()
+    app.include_router(chat.router)
+    client = TestClient(app)
+    assert client.get("/assistants/asst/messages/thread_a/results/call_b?page=0").status_code == 200
+    assert client.get("/assistants/asst/messages/thread_b/results/call_b").status_code == 404
+    assert client.get("/assistants/asst/messages/thread_a/results/call_gone").status_code == 404
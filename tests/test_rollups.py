@@ -0,0 +1,112 @@
+import pytest
+
+from utils.rollups import AccountRollup, RollupBuilder, format_rollup, run_rollup_tool
+
+TOP = [{"tweet_id": "7", "created_at": "2024-02-02T00:00:00Z", "full_text": "big\n  news", "favorite_count": 50, "retweet_count": 5}]
+
+
+class FakeArchive:
+    def __init__(self):
+        self.tweets = [
+            {"tweet_id": "1", "created_at": "2024-01-05T00:00:00Z", "favorite_count": 3, "retweet_count": 1, "reply_to_username": "bob"},
+            {"tweet_id": "2", "created_at": "2024-01-20T00:00:00Z", "favorite_count": None, "retweet_count": 2, "reply_to_username": None},
+            {"tweet_id": "3", "created_at": "2024-02-01T00:00:00Z", "favorite_count": 10, "retweet_count": 0, "reply_to_username": "bob"},
+        ]
+        self.mentions = [{"mentioned_users": {"screen_name": "carol"}}]
+        self.media = [{"media_type": "photo"}, {"media_type": "photo"}, {"media_type": "video"}]
+        self.requests = []
+
+    def fetch_pages(self, function_name, params, max_rows):
+        self.requests.append((function_name, params))
+        since = params.get("created_at") or params.get("tweets.created_at")
+        if function_name == "get_tweets":
+            rows = [row for row in self.tweets if not since or row["created_at"] > since[len("gt."):]]
+        else:
+            # Mentions and media are only returned on the first build
+            rows = [] if since else {"get_user_mentions": self.mentions, "get_tweet_media": self.media}[function_name]
+        yield rows
+
+    def fetch_rows(self, function_name, params):
+        return [dict(row) for row in TOP]
+
+
+@pytest.fixture
+def archive():
+    return FakeArchive()
+
+
+@pytest.fixture
+def builder(archive, tmp_path):
+    return RollupBuilder(archive.fetch_pages, archive.fetch_rows, directory=str(tmp_path))
+
+
+def test_refresh_builds_the_counts(builder):
+    rollup = builder.refresh("42", "amy")
+    assert rollup.tweet_count == 3
+    assert rollup.monthly == {"2024-01": [2, 3, 3], "2024-02": [1, 10, 0]}
+    assert rollup.reply_targets == {"bob": 2}
+    assert rollup.mentions == {"carol": 1}
+    assert rollup.media == {"photo": 2, "video": 1}
+    assert rollup.watermark == "2024-02-01T00:00:00Z"
+    assert builder.load("42") == rollup
+
+
+def test_a_fresh_rollup_is_served_without_fetching(builder, archive):
+    builder.refresh("42", "amy")
+    archive.requests.clear()
+    assert builder.get("42", "amy").tweet_count == 3
+    assert archive.requests == []
+
+
+def test_a_stale_rollup_only_folds_in_new_tweets(builder, archive):
+    rollup = builder.refresh("42", "amy")
+    rollup.built_at = 0
+    builder.save(rollup)
+    archive.tweets.append(
+        {"tweet_id": "4", "created_at": "2024-02-10T00:00:00Z", "favorite_count": 1, "retweet_count": 1, "reply_to_username": "dan"}
+    )
+    archive.requests.clear()
+
+    refreshed = builder.get("42", "amy")
+    assert archive.requests[0] == ("get_tweets", {
+        "select": "tweet_id,created_at,favorite_count,retweet_count,reply_to_username",
+        "account_id": "eq.42",
+        "created_at": "gt.2024-02-01T00:00:00Z",
+    })
+    assert refreshed.tweet_count == 4
+    assert refreshed.monthly["2024-02"] == [2, 11, 1]
+    assert refreshed.reply_targets == {"bob": 2, "dan": 1}
+    assert refreshed.media == {"photo": 2, "video": 1}
+    assert refreshed.watermark == "2024-02-10T00:00:00Z"
+    assert refreshed.built_at > 0
+
+
+def test_format_rollup_sections():
+    rollup = AccountRollup(
+        account_id="42",
+        username="amy",
+        tweet_count=3,
+        monthly={"2023-12": [1, 0, 0], "2024-01": [2, 3, 3]},
+        top_liked=TOP,
+        reply_targets={"bob": 2, "dan": 1},
+    )
+    assert format_rollup(rollup, ["monthly", "top_tweets", "reply_targets", "media"], months=1, top=1).splitlines() == [
+        "@amy (account_id 42): 3 archived tweets",
+        "Monthly (last 1 months with tweets): month tweets likes_received retweets_received",
+        "2024-01 2 3 3",
+        "Most liked:",
+        "7 2024-02-02 50L 5RT: big news",
+        "Most retweeted:",
+        "Most replied to: bob 2",
+        "Media posted: none",
+    ]
+
+
+def test_run_rollup_tool(builder):
+    accounts = {"amy": ("42", "amy")}
+    rows, notes, summary = run_rollup_tool({"account": "@amy", "sections": ["monthly"]}, builder, accounts.get)
+    assert rows[0] == {"month": "2024-01", "tweets": 2, "likes_received": 3, "retweets_received": 3}
+    assert notes[0].startswith("Precomputed summary, updated ")
+    assert summary.splitlines()[-1] == "2024-02 1 10 0"
+    with pytest.raises(ValueError, match="not an archived account"):
+        run_rollup_tool({"account": "nobody"}, builder, accounts.get)
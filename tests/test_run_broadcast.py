@@ -0,0 +1,60 @@
+import asyncio
+
+from utils.run_broadcast import RunBroadcaster
+from utils.sse import sse_format
+
+
+async def frames(count):
+    for index in range(1, count + 1):
+        yield sse_format("textDelta", f"frame {index}")
+
+
+async def collect(subscription):
+    return [frame async for frame in subscription]
+
+
+def test_replay_after_a_sequence_number():
+    async def scenario():
+        broadcaster = RunBroadcaster()
+        broadcast = broadcaster.start("thread_a", frames(5), slot=1)
+        everything = await collect(broadcast.subscribe())
+        assert len(everything) == 5
+        assert everything[0].startswith(f"id: {broadcast.key}:1\n")
+
+        resumed, after = broadcaster.resume("thread_a", f"{broadcast.key}:3")
+        assert resumed is broadcast and after == 3
+        assert await collect(resumed.subscribe(after)) == everything[3:]
+        assert broadcaster.for_slot("thread_a", 1) is broadcast
+
+    asyncio.run(scenario())
+
+
+def test_resume_rejects_other_threads_and_unknown_runs():
+    async def scenario():
+        broadcaster = RunBroadcaster()
+        broadcast = broadcaster.start("thread_a", frames(1))
+        await collect(broadcast.subscribe())
+        assert broadcaster.resume("thread_b", f"{broadcast.key}:1") is None
+        assert broadcaster.resume("thread_a", "unknown:1") is None
+        assert broadcaster.resume("thread_a", f"{broadcast.key}:x") is None
+
+    asyncio.run(scenario())
+
+
+def test_a_subscriber_follows_the_run_as_it_streams():
+    async def scenario():
+        release = asyncio.Event()
+
+        async def source():
+            yield sse_format("textDelta", "first")
+            await release.wait()
+            yield sse_format("textDelta", "second")
+
+        broadcast = RunBroadcaster().start("thread_a", source())
+        reader = asyncio.create_task(collect(broadcast.subscribe()))
+        await asyncio.sleep(0.01)
+        release.set()
+        received = await reader
+        assert [frame.rsplit("data: ", 1)[1].strip() for frame in received] == ["first", "second"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,77 @@
+import asyncio
+import os
+
+from utils import run_coordinator as coordinator_module
+from utils.run_broadcast import RunBroadcaster
+from utils.run_coordinator import RunCoordinator, ThreadRunLock
+from utils.sse import sse_format
+from utils.thread_store import ThreadStore
+
+
+def make_coordinator(tmp_path):
+    store = ThreadStore(path=os.path.join(tmp_path, "threads.sqlite3"))
+    return RunCoordinator(store, RunBroadcaster(), ThreadRunLock(os.path.join(tmp_path, "locks")))
+
+
+def test_messages_join_a_slot_only_while_it_is_fresh(tmp_path):
+    store = ThreadStore(path=os.path.join(tmp_path, "threads.sqlite3"))
+    assert store.enqueue_message("thread_a", "one", max_wait=60) == (1, True)
+    assert store.enqueue_message("thread_a", "two", max_wait=60) == (1, False)
+    # Slot 1's run never started: the next message opens slot 2, which takes slot 1's messages too
+    assert store.enqueue_message("thread_a", "three", max_wait=0) == (2, True)
+    assert store.open_slot("thread_a") == 2
+    assert store.claim_slot("thread_a", 2) == ["one", "two", "three"]
+    # A late connection for slot 1 finds nothing left to run
+    assert store.claim_slot("thread_a", 1) is None
+    assert store.enqueue_message("thread_a", "four", max_wait=0) == (3, True)
+
+
+def test_a_message_joins_a_slot_whose_run_is_waiting(tmp_path, monkeypatch):
+    monkeypatch.setattr(coordinator_module, "RUN_SLOT_JOIN_SECONDS", 0)
+    coordinator = make_coordinator(tmp_path)
+    received = []
+
+    async def start_stream(messages):
+        received.append(messages)
+        yield sse_format("endStream", "DONE")
+
+    async def scenario():
+        assert await coordinator.enqueue("thread_a", "one") == (1, True)
+        async with coordinator.lock.hold("thread_a"):
+            # The slot's run is connected but waits for the previous run's lock
+            broadcast = await coordinator.receive("thread_a", 1, start_stream)
+            await asyncio.sleep(0.01)
+            assert await coordinator.enqueue("thread_a", "two") == (1, False)
+            assert await coordinator.receive("thread_a", 1, start_stream) is broadcast
+        await broadcast.task
+        # Without a run serving it, a stale slot is not joined
+        assert await coordinator.enqueue("thread_a", "three") == (2, True)
+        assert await coordinator.enqueue("thread_a", "four") == (3, True)
+
+    asyncio.run(scenario())
+    assert received == [["one", "two"]]
+
+
+def test_runs_on_a_thread_take_turns(tmp_path):
+    coordinator = make_coordinator(tmp_path)
+    events = []
+
+    def start_stream(name):
+        async def stream(messages):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.05)
+            events.append(f"{name} end")
+            yield sse_format("endStream", "DONE")
+        return stream
+
+    async def scenario():
+        await coordinator.enqueue("thread_a", "one")
+        first = await coordinator.receive("thread_a", 1, start_stream("first"))
+        await asyncio.sleep(0.01)
+        slot, opened = await coordinator.enqueue("thread_a", "two")
+        assert (slot, opened) == (2, True)
+        second = await coordinator.receive("thread_a", slot, start_stream("second"))
+        await asyncio.gather(first.task, second.task)
+
+    asyncio.run(scenario())
+    assert events == ["first start", "first end", "second start", "second end"]
@@ -0,0 +1,106 @@
+import json
+
+from utils.schema_compaction import (
+    COMPACT_REQUEST_SCHEMAS, COMPACT_SYSTEM_PROMPT, OPERATOR_NOTE, compact_description, compact_instructions,
+    compact_schema, compact_tool, relationships, shared_definitions, shared_parameters
+)
+from utils.tokens import count_tokens
+from utils.tools import REQUEST_SCHEMAS, SYSTEM_PROMPT
+
+
+def tool(name, properties, optional=None):
+    parameters = {"type": "object", "properties": properties}
+    if optional is not None:
+        parameters["optional"] = optional
+    return {"type": "function", "function": {"name": name, "description": f"Calls {name}.", "parameters": parameters}}
+
+
+def test_compact_description_strips_operator_and_key_notes():
+    assert compact_description(
+        "Filter tweets by a specific account ID. Use with 'eq' operator. Example: account_id=eq.abc123. "
+        "Note: This is a Foreign Key to `account.account_id`.<fk table='account' column='account_id'/>"
+    ) == "account ID"
+    assert compact_description(
+        "Filter tweets by retweet count. Use 'eq', 'gt', 'gte', 'lt', 'lte' for comparison. Example: retweet_count=gte.100"
+    ) == "retweet count. e.g. gte.100"
+    assert compact_description(
+        "Retrieves tweets from the 'tweets' PostgREST endpoint of the Twitter Community Archive API. "
+        "It supports filtering, pagination, and ordering using PostgREST operators (e.g., eq, neq)."
+    ) == "Retrieves tweets from the 'tweets' endpoint"
+
+
+def test_shared_parameters_need_the_same_description_on_enough_tools():
+    schemas = [
+        tool("get_a", {"limit": {"description": "Maximum rows."}, "id": {"description": "The A."}}),
+        tool("get_b", {"limit": {"description": "Maximum rows."}, "id": {"description": "The B."}}),
+        tool("get_c", {"limit": {"description": "Maximum rows."}, "id": {"description": "The B."}}),
+    ]
+    assert shared_parameters(schemas) == {"limit": "Maximum rows."}
+    assert shared_parameters(schemas[:2]) == {}
+
+
+def test_compact_tool_drops_optional_and_descriptions_said_elsewhere():
+    schema = tool("get_tweets", {
+        "limit": {"type": "integer", "description": "Maximum rows."},
+        "tweet_id": {"type": "string", "description": "Filter tweets by a specific tweet ID. Note: This is a Primary Key.<pk/>"},
+        "retweet_count": {"type": "integer", "description": "Filter tweets by retweet count. Example: retweet_count=gte.100"},
+    }, optional=["limit", "tweet_id"])
+    compacted = compact_tool(schema, {"limit": "Maximum rows."})
+
+    parameters = compacted["function"]["parameters"]
+    assert "optional" not in parameters
+    assert parameters["properties"] == {
+        "limit": {"type": "integer"},
+        # "tweet ID" only restates the parameter name
+        "tweet_id": {"type": "string"},
+        "retweet_count": {"type": "integer", "description": "retweet count. e.g. gte.100"},
+    }
+    # The source schema is left as it was
+    assert schema["function"]["parameters"]["optional"] == ["limit", "tweet_id"]
+
+
+def test_relationships_come_from_key_tags_and_the_schema():
+    assert relationships(["get_tweets"], []) == [
+        ("tweets.account_id", "account.account_id"), ("tweets.archive_upload_id", "archive_upload.id")
+    ]
+    assert relationships([], ["all_profile"]) == [
+        ("all_profile.account_id", "account.account_id"), ("all_profile.archive_upload_id", "archive_upload.id")
+    ]
+
+
+def test_compact_schema_lists_each_table_on_one_line_with_its_keys():
+    lines = compact_schema(["account", "all_profile"], []).splitlines()
+    assert len(lines) == 2
+    assert lines[0].startswith("account: account_id*, created_via, username")
+    assert lines[1] == (
+        "all_profile: account_id*>account, bio, website, location, avatar_media_url, header_media_url, "
+        "archive_upload_id>archive_upload, updated_at"
+    )
+    # A key to a column other than the referenced table's primary key names the column
+    assert "conversation_id>conversations.conversation_id" in compact_schema(["enriched_tweets"], [])
+    # Keys from the tools' parameters on tables the schema does not list
+    assert compact_schema(["account"], ["get_tweets"]).splitlines()[-1] == (
+        "also: tweets.account_id>account, tweets.archive_upload_id>archive_upload"
+    )
+
+
+def test_shared_definitions_cover_only_the_offered_endpoint_tools():
+    assert shared_definitions(["lookup_accounts"]) == ""
+    definitions = shared_definitions(["get_tweets"])
+    assert definitions.startswith(OPERATOR_NOTE)
+    assert "limit (rows to return)" in definitions
+    assert OPERATOR_NOTE not in compact_instructions(["account"], ["lookup_accounts"])
+
+
+def test_the_published_configuration_is_smaller_and_complete():
+    assert [schema["function"]["name"] for schema in COMPACT_REQUEST_SCHEMAS] == [
+        schema["function"]["name"] for schema in REQUEST_SCHEMAS
+    ]
+    for verbose, compact in zip(REQUEST_SCHEMAS, COMPACT_REQUEST_SCHEMAS):
+        # Compaction removes descriptions, never parameters
+        assert set(compact["function"]["parameters"].get("properties", {})) == set(
+            verbose["function"]["parameters"].get("properties", {})
+        )
+    assert OPERATOR_NOTE in COMPACT_SYSTEM_PROMPT
+    assert count_tokens(COMPACT_SYSTEM_PROMPT) < count_tokens(SYSTEM_PROMPT)
+    assert count_tokens(json.dumps(COMPACT_REQUEST_SCHEMAS)) < count_tokens(json.dumps(REQUEST_SCHEMAS))
@@ -0,0 +1,65 @@
+import pytest
+
+from utils import similarity as similarity_module
+from utils.similarity import SimilarityIndex
+
+TWEETS = [
+    {"tweet_id": "1", "account_id": "10", "created_at": "2023-03-01T12:00:00Z", "full_text": "Sourdough starter needs daily feeding with rye flour"},
+    {"tweet_id": "2", "account_id": "20", "created_at": "2024-06-01T12:00:00Z", "full_text": "My sourdough starter loves rye flour and warm water"},
+    {"tweet_id": "3", "account_id": "10", "created_at": "2024-07-01T12:00:00Z", "full_text": "Sourdough starter needs daily feeding with rye flour today"},
+    {"tweet_id": "4", "account_id": "20", "created_at": "2024-08-01T12:00:00Z", "full_text": "Compilers lower typed syntax trees into bytecode"},
+]
+
+
+@pytest.fixture
+def index():
+    index = SimilarityIndex()
+    assert index.add(TWEETS) == 4
+    return index
+
+
+def ids(rows):
+    return [row["tweet_id"] for row in rows]
+
+
+def test_text_search_ranks_similar_tweets(index):
+    rows = index.search(text="feeding a sourdough starter rye flour")
+    assert set(ids(rows)) == {"1", "2", "3"}
+    assert rows[0]["similarity"] >= rows[-1]["similarity"]
+    assert rows[0]["created_at"] in ("2023-03-01", "2024-07-01")
+    with pytest.raises(ValueError, match="no searchable words"):
+        index.search(text="the and")
+
+
+def test_searching_by_tweet_excludes_the_tweet_itself(index):
+    assert "3" not in ids(index.search(tweet_id="3"))
+    assert ids(index.search(tweet_id="3"))[0] == "1"
+    with pytest.raises(ValueError, match="not in the similarity index"):
+        index.search(tweet_id="99")
+
+
+def test_account_and_date_filters(index):
+    assert ids(index.search(text="sourdough starter rye flour", account_id="10")) in (["1", "3"], ["3", "1"])
+    assert ids(index.search(text="sourdough starter rye flour", since="2024-01-01", until="2024-06-30")) == ["2"]
+
+
+def test_candidates_with_the_most_overlap_are_scored_first(monkeypatch):
+    index = SimilarityIndex()
+    # An earlier tweet shares one query word; the later match shares every word and pair
+    index.add([{"tweet_id": "1", "full_text": "sourdough bread"}, {"tweet_id": "2", "full_text": "sourdough starter"}])
+    monkeypatch.setattr(similarity_module, "MAX_CANDIDATES", 1)
+    assert ids(index.search(text="sourdough starter")) == ["2"]
+
+
+def test_a_saved_index_loads_with_the_same_results(index, tmp_path):
+    index.save(str(tmp_path))
+    assert index.unsaved == 0
+
+    loaded = SimilarityIndex()
+    assert loaded.load(str(tmp_path))
+    assert len(loaded) == 4
+    assert loaded.search(tweet_id="3") == index.search(tweet_id="3")
+    assert loaded.search(text="bytecode compilers", account_id="20") == index.search(text="bytecode compilers", account_id="20")
+    # Tweets already in the loaded index are not added twice
+    assert loaded.add(TWEETS[:1]) == 0
+    assert not SimilarityIndex().load(str(tmp_path / "missing"))
@@ -0,0 +1,152 @@
+import asyncio
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from utils import social_graph as social_graph_module
+from utils.social_graph import SocialGraph, run_graph_tool
+
+# Who follows whom in the small test graph
+FOLLOWS = [
+    (1, 2), (2, 1), (1, 3), (3, 1), (4, 1), (4, 2), (5, 2), (5, 3), (2, 3), (3, 4),
+]
+
+
+def fake_pages(edges, page_size=3):
+    """A fetch_pages that serves the edges from get_followers and nothing from get_following_accounts."""
+    def fetch_pages(function_name, params, limit):
+        if function_name != "get_followers":
+            return
+        rows = [{"follower_account_id": str(source), "account_id": target} for source, target in edges]
+        for start in range(0, len(rows), page_size):
+            yield rows[start:start + page_size]
+    return fetch_pages
+
+
+def built(edges):
+    graph = SocialGraph()
+    graph.build(fake_pages(edges))
+    return graph
+
+
+def ids(graph, nodes):
+    return sorted(int(graph.ids[node]) for node in nodes)
+
+
+def test_build_deduplicates_edges_seen_in_both_tables():
+    def fetch_pages(function_name, params, limit):
+        if function_name == "get_followers":
+            yield [{"follower_account_id": 1, "account_id": 2}, {"follower_account_id": None, "account_id": 2}]
+        else:
+            yield [{"account_id": 1, "following_account_id": 2}, {"account_id": 2, "following_account_id": 3}]
+
+    graph = SocialGraph()
+    graph.build(fetch_pages)
+    assert graph.ids.tolist() == [1, 2, 3]
+    assert len(graph.out) == len(graph.inn) == 2
+    assert ids(graph, graph.following(graph.node(1))) == [2]
+    assert ids(graph, graph.followers(graph.node(3))) == [2]
+
+
+def test_queries():
+    graph = built(FOLLOWS)
+    one, two, three = graph.node(1), graph.node(2), graph.node(3)
+    assert graph.node(99) is None and graph.node("x") is None
+    assert ids(graph, graph.mutuals(one)) == [2, 3]
+    assert ids(graph, graph.common_followers(one, two)) == [4]
+    assert ids(graph, graph.common_following(one, two)) == [3]
+    assert {int(graph.ids[node]): count for node, count in graph.followers_follow(three).items()} == {2: 2, 1: 1}
+    assert {int(graph.ids[node]): hop for node, hop in graph.k_hop(graph.node(5), 2).items()} == {2: 1, 3: 1, 1: 2, 4: 2}
+    assert ids(graph, graph.top_by_degree(3)) == [1, 2, 3]
+    assert graph.similarity(one, one) == {"followers_jaccard": 1.0, "following_jaccard": 1.0}
+
+
+def test_snapshot_round_trip(tmp_path):
+    graph = built(FOLLOWS)
+    graph.save(str(tmp_path))
+    loaded = SocialGraph()
+    assert loaded.load_snapshot(str(tmp_path))
+    assert loaded.ids.tolist() == graph.ids.tolist()
+    assert ids(loaded, loaded.mutuals(loaded.node(1))) == [2, 3]
+    assert not SocialGraph().load_snapshot(str(tmp_path / "missing"))
+
+
+def test_memory_bound():
+    # A random graph: 200k follow edges between 20k accounts with sparse, large IDs
+    rng = np.random.default_rng(0)
+    accounts = rng.choice(10**15, size=20_000, replace=False)
+    edges = list(zip(rng.choice(accounts, 200_000).tolist(), rng.choice(accounts, 200_000).tolist()))
+    # Materialise the pages first so the downloaded rows are not counted against the build
+    pages = list(fake_pages(edges, page_size=1000)("get_followers", {}, 0))
+
+    def fetch_pages(function_name, params, limit):
+        return iter(pages if function_name == "get_followers" else [])
+
+    graph = SocialGraph()
+    tracemalloc.start()
+    graph.build(fetch_pages)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    num_edges, num_accounts = len(graph.out), len(graph.ids)
+    # The steady state the docstring promises: 8 bytes per edge and 24 per account
+    assert graph.memory_bytes() <= 8 * num_edges + 24 * num_accounts + 64
+    # The build peak: about 32 bytes per downloaded edge, and no Python object per edge
+    assert peak <= 40 * len(edges) + 24 * num_accounts + 2_000_000
+
+
+def test_run_graph_tool_reports_a_disabled_graph():
+    with pytest.raises(ValueError, match="not enabled"):
+        run_graph_tool({"operation": "mutuals", "account": "1"}, SocialGraph(), lambda name: None, lambda account_id: None)
+    loading = SocialGraph()
+    loading.loading = True
+    with pytest.raises(ValueError, match="still loading"):
+        run_graph_tool({"operation": "mutuals", "account": "1"}, loading, lambda name: None, lambda account_id: None)
+
+
+def test_run_graph_tool_labels_rows():
+    graph = built(FOLLOWS)
+    rows, notes = run_graph_tool(
+        {"operation": "mutuals", "account": "@alice"}, graph,
+        lambda name: "1" if name == "alice" else None, lambda account_id: f"user{account_id}"
+    )
+    assert {row["username"] for row in rows} == {"user2", "user3"}
+    assert notes == ["2 accounts in total; showing the 2 most followed."]
+
+
+def test_a_failed_build_is_retried_with_backoff(monkeypatch):
+    monkeypatch.setattr(social_graph_module, "SOCIAL_GRAPH_RETRY_SECONDS", 0.01)
+    waits = []
+    sleep = asyncio.sleep
+
+    async def record_sleep(seconds):
+        waits.append(seconds)
+        await sleep(0)
+
+    monkeypatch.setattr(social_graph_module.asyncio, "sleep", record_sleep)
+    attempts = []
+    pages = fake_pages(FOLLOWS)
+
+    def flaky_pages(function_name, params, limit):
+        if function_name == "get_followers":
+            attempts.append(function_name)
+            if len(attempts) < 3:
+                raise ConnectionError("archive unavailable")
+        return pages(function_name, params, limit)
+
+    async def scenario():
+        graph = SocialGraph()
+        # Start without a snapshot and keep the built graph out of the snapshot directory
+        graph.load_snapshot = lambda: False
+        graph.save = lambda: None
+        task = asyncio.create_task(graph.refresh_forever(flaky_pages, interval=3600))
+        while graph.built_at is None:
+            await sleep(0.01)
+        task.cancel()
+        return graph
+
+    graph = asyncio.run(scenario())
+    assert len(attempts) == 3 and graph.node(1) is not None
+    # Two quick retries, then the normal interval
+    assert waits[:3] == [0.01, 0.02, 3600]
@@ -0,0 +1,105 @@
+import json
+import threading
+import time
+
+import pytest
+
+from utils.jobs import ToolCallCancelled, check_cancelled, run_cancellable
+from utils.metrics import metrics
+from utils.speculation import ToolCallAssembler, ToolCallSpeculator
+
+
+def feed_call(speculator, index, name, args):
+    arguments = json.dumps(args)
+    speculator.feed(index, f"call_{index}", name, "")
+    for start in range(0, len(arguments), 5):
+        speculator.feed(index, None, None, arguments[start:start + 5])
+
+
+def test_assembler_completes_on_the_closing_brace_outside_strings():
+    assembler = ToolCallAssembler()
+    assert assembler.feed(0, "call_0", "get_tweets", '{"full_text": "a } b') is None
+    assert assembler.feed(0, None, None, ' {"') is None
+    call = assembler.feed(0, None, None, '}')
+    assert call.arguments == '{"full_text": "a } b {"}'
+    assert assembler.feed(0, None, None, " ") is None
+
+
+def test_claim_returns_the_call_only_for_the_final_arguments():
+    speculator = ToolCallSpeculator(lambda name, args: (name, args))
+    feed_call(speculator, 0, "get_tweets", {"limit": 1})
+    feed_call(speculator, 1, "get_tweets", {"limit": 2})
+    assert speculator.claim("call_0", {"limit": 1}).future.result() == ("get_tweets", {"limit": 1})
+    assert speculator.claim("call_1", {"limit": 3}) is None
+    assert speculator.claim("call_2", {}) is None
+
+
+def test_each_tool_step_of_a_run_is_speculated():
+    speculator = ToolCallSpeculator(lambda name, args: (name, args))
+    feed_call(speculator, 0, "get_tweets", {"limit": 1})
+    # The next tool step numbers its calls from 0 again
+    speculator.feed(0, "call_next", "get_likes", "")
+    speculator.feed(0, None, None, '{"limit": 2}')
+    assert speculator.claim("call_0", {"limit": 1}).future.result() == ("get_tweets", {"limit": 1})
+    assert speculator.claim("call_next", {"limit": 2}).future.result() == ("get_likes", {"limit": 2})
+
+
+def test_batchable_calls_are_left_for_the_planner():
+    started = []
+    speculator = ToolCallSpeculator(lambda name, args: started.append(name), lambda name, args: name == "get_account_info")
+    feed_call(speculator, 0, "get_account_info", {"account_id": "eq.1"})
+    feed_call(speculator, 1, "get_tweets", {"limit": 1})
+    assert speculator.claim("call_0", {"account_id": "eq.1"}) is None
+    speculator.claim("call_1", {"limit": 1}).future.result()
+    assert started == ["get_tweets"]
+
+
+def paging_tool(pages, finished):
+    """Stands in for a paging tool: each page starts with the check make_request does."""
+    def fetch_pages(name, args):
+        try:
+            for page in range(100):
+                check_cancelled()
+                pages.append(page)
+                time.sleep(0.01)
+            return pages
+        finally:
+            finished.release()
+    return fetch_pages
+
+
+def test_cancel_all_stops_the_worker_between_requests():
+    pages = []
+    finished = threading.Semaphore(0)
+    speculator = ToolCallSpeculator(paging_tool(pages, finished))
+    feed_call(speculator, 0, "aggregate_archive", {})
+    feed_call(speculator, 1, "get_tweets", {})
+    time.sleep(0.05)
+    before = metrics.get("runs.cancelled_tool_calls")
+    speculator.cancel_all()
+    assert finished.acquire(timeout=2) and finished.acquire(timeout=2)
+    time.sleep(0.05)
+
+    # Both calls were stopped part way
+    assert metrics.get("runs.cancelled_tool_calls") - before == 2
+    stopped_at = len(pages)
+    time.sleep(0.05)
+    assert len(pages) == stopped_at < 200
+
+
+def test_calls_that_already_finished_are_not_counted():
+    speculator = ToolCallSpeculator(lambda name, args: "done")
+    feed_call(speculator, 0, "get_tweets", {})
+    time.sleep(0.05)
+    before = metrics.get("runs.cancelled_tool_calls")
+    speculator.cancel_all()
+    time.sleep(0.05)
+    assert metrics.get("runs.cancelled_tool_calls") - before == 0
+
+
+def test_check_cancelled_is_a_no_op_outside_a_tool_call():
+    check_cancelled()
+    cancelled = threading.Event()
+    cancelled.set()
+    with pytest.raises(ToolCallCancelled):
+        run_cancellable(cancelled, check_cancelled)
@@ -0,0 +1,90 @@
+import pytest
+
+from utils import working_set as working_set_module
+from utils.result_store import ResultStore
+from utils.working_set import WorkingSets, join_rows, parse_filter, run_working_set_tool
+
+
+def matches(column, expression, rows):
+    predicate = parse_filter(column, expression)
+    return [row[column] for row in rows if predicate(row)]
+
+
+def test_comparisons_treat_ints_and_floats_as_numbers():
+    rows = [{"n": 2}, {"n": 10}, {"n": 20.5}, {"n": None}]
+    assert matches("n", "gt.5", rows) == [10, 20.5]
+    assert matches("n", "lt.100", rows) == [2, 10, 20.5]
+    assert matches("n", "lte.10", rows) == [2, 10]
+    assert matches("n", "eq.10.0", rows) == [10]
+    assert matches("n", "neq.10", rows) == [2, 20.5]
+
+
+def test_comparisons_fall_back_to_strings():
+    rows = [{"at": "2024-01-05T00:00:00"}, {"at": "2023-12-31T23:59:59"}]
+    assert matches("at", "gte.2024-01-01", rows) == ["2024-01-05T00:00:00"]
+    assert matches("name", "eq.amy", [{"name": "amy"}, {"name": "bob"}]) == ["amy"]
+
+
+def test_patterns_lists_nulls_and_negation():
+    rows = [{"text": "Tea time"}, {"text": "coffee"}, {"text": None}]
+    assert matches("text", "like.*time", rows) == ["Tea time"]
+    assert matches("text", "like.tea*", rows) == []
+    assert matches("text", "ilike.tea*", rows) == ["Tea time"]
+    assert matches("text", "is.null", rows) == [None]
+    assert matches("text", "not.is.null", rows) == ["Tea time", "coffee"]
+    assert matches("id", "in.(1,3)", [{"id": 1}, {"id": "2"}, {"id": "3"}]) == [1, "3"]
+    assert matches("id", "not.in.(1,3)", [{"id": 1}, {"id": "2"}]) == ["2"]
+    assert matches("flag", "is.true", [{"flag": True}, {"flag": False}]) == [True]
+    with pytest.raises(ValueError):
+        parse_filter("id", "near.1")
+
+
+def test_join_prefixes_colliding_right_columns():
+    tweets = [{"tweet_id": "1", "account_id": "a", "created_at": "t1"}, {"tweet_id": "2", "account_id": "z", "created_at": "t2"}]
+    accounts = [{"id": "a", "username": "amy", "created_at": "t0"}]
+    assert join_rows(tweets, accounts, "account_id=id", "r2") == [
+        {"tweet_id": "1", "account_id": "a", "created_at": "t1", "username": "amy", "r2.created_at": "t0"}
+    ]
+
+
+def make_sets(tmp_path):
+    store = ResultStore(directory=str(tmp_path))
+    return store, WorkingSets(store)
+
+
+def add(store, working_sets, tool_call_id, rows):
+    store.put(tool_call_id, "get_tweets", {}, rows, "thread_a")
+    return working_sets.add("thread_a", tool_call_id, "get_tweets", {}, rows)
+
+
+def test_oldest_handles_are_dropped_past_the_handle_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(working_set_module, "WORKING_SET_MAX_HANDLES", 2)
+    store, working_sets = make_sets(tmp_path)
+    names = [add(store, working_sets, f"call_{number}", [{"n": number}]) for number in range(3)]
+    assert names == ["r1", "r2", "r3"]
+    assert [handle.name for handle in working_sets.handles("thread_a")] == ["r2", "r3"]
+    with pytest.raises(ValueError, match="Unknown handle r1"):
+        working_sets.rows("thread_a", "r1")
+
+
+def test_oldest_handles_are_dropped_past_the_row_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(working_set_module, "WORKING_SET_MAX_ROWS", 5)
+    store, working_sets = make_sets(tmp_path)
+    add(store, working_sets, "call_1", [{"n": 1}] * 3)
+    add(store, working_sets, "call_2", [{"n": 2}] * 3)
+    assert [handle.name for handle in working_sets.handles("thread_a")] == ["r2"]
+    # A single result over the limit is still kept
+    add(store, working_sets, "call_3", [{"n": 3}] * 8)
+    assert [handle.name for handle in working_sets.handles("thread_a")] == ["r3"]
+
+
+def test_the_tool_filters_orders_and_pages(tmp_path):
+    store, working_sets = make_sets(tmp_path)
+    add(store, working_sets, "call_1", [{"n": number, "user": {"name": f"u{number}"}} for number in range(10)])
+    rows, notes = run_working_set_tool(
+        {"from": "r1", "filters": {"n": "gte.4"}, "order": "n.desc", "limit": 2, "offset": 1, "select": "n,user.name"},
+        working_sets,
+        "thread_a"
+    )
+    assert rows == [{"n": 8, "user.name": "u8"}, {"n": 7, "user.name": "u7"}]
+    assert notes == ["6 rows matched; returned 2 starting at offset 1."]
@@ -0,0 +1,296 @@
+import asyncio
+import bisect
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+# Loading the index pages through the whole account table, so it is opt-in: turn it on against your own mirror
+ACCOUNT_INDEX_ENABLED: bool = os.getenv("ACCOUNT_INDEX_ENABLED", "false").lower() == "true"
+ACCOUNT_INDEX_REFRESH_SECONDS: float = float(os.getenv("ACCOUNT_INDEX_REFRESH_SECONDS", "600"))
+
+COUNT_COLUMNS = ("num_tweets", "num_followers", "num_following", "num_likes")
+INDEX_COLUMNS = ("account_id", "username", "account_display_name") + COUNT_COLUMNS
+
+# Tables to load from, with the column that marks changed rows for incremental refreshes.
+# all_account carries updated_at, so changed counts are picked up. account has no such
+# column (created_at would miss every change to an existing account), so it is reloaded
+# in full on every refresh.
+SOURCES: Tuple[Tuple[str, Optional[str]], ...] = (("all_account", "updated_at"), ("account", None))
+
+FetchPages = Callable[[str, Dict[str, Any]], Iterator[List[Dict[str, Any]]]]
+RequestAccounts = Callable[[Dict[str, Any]], Any]
+
+
+@dataclass
+class IndexSnapshot:
+    """
+    An immutable generation of the index. Refreshes build a new snapshot and swap it in,
+    so lookups never see a half-updated index.
+    """
+    ids: array = field(default_factory=lambda: array("q"))
+    usernames: List[str] = field(default_factory=list)
+    display_names: List[str] = field(default_factory=list)
+    counts: Dict[str, array] = field(default_factory=lambda: {column: array("q") for column in COUNT_COLUMNS})
+    by_lower: Dict[str, int] = field(default_factory=dict)
+    by_id: Dict[int, int] = field(default_factory=dict)
+    sorted_lower: List[str] = field(default_factory=list)
+    sorted_positions: array = field(default_factory=lambda: array("I"))
+
+    def row(self, position: int) -> Dict[str, Any]:
+        row = {
+            "account_id": str(self.ids[position]),
+            "username": self.usernames[position],
+            "account_display_name": self.display_names[position],
+        }
+        row.update({column: self.counts[column][position] for column in COUNT_COLUMNS})
+        return row
+
+
+def _int(value: Any) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class AccountIndex:
+    """
+    Compact in-memory index of archived accounts.
+
+    Account IDs and counts are stored in typed arrays, usernames and display
+    names as interned strings, and a sorted list of lowercased usernames backs
+    prefix search with bisect. Supports exact and case-insensitive lookup.
+    """
+
+    def __init__(self):
+        self._snapshot = IndexSnapshot()
+        self._refresh_lock = threading.Lock()
+        self._source: Optional[Tuple[str, Optional[str]]] = None
+        self._watermark: Optional[str] = None
+        self.refreshed_at: Optional[float] = None
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._snapshot.ids)
+
+    def build(self, rows: List[Dict[str, Any]], base: Optional[IndexSnapshot] = None) -> IndexSnapshot:
+        """Return a new snapshot with `rows` upserted into `base` (or into an empty index)."""
+        base = base or IndexSnapshot()
+        snapshot = IndexSnapshot(
+            ids=array("q", base.ids),
+            usernames=list(base.usernames),
+            display_names=list(base.display_names),
+            counts={column: array("q", values) for column, values in base.counts.items()},
+        )
+        positions = {account_id: position for position, account_id in enumerate(snapshot.ids)}
+
+        for row in rows:
+            account_id = _int(row.get("account_id"))
+            username = sys.intern(str(row.get("username") or ""))
+            display_name = sys.intern(str(row.get("account_display_name") or ""))
+            position = positions.get(account_id)
+            if position is None:
+                position = positions[account_id] = len(snapshot.ids)
+                snapshot.ids.append(account_id)
+                snapshot.usernames.append(username)
+                snapshot.display_names.append(display_name)
+                for column in COUNT_COLUMNS:
+                    snapshot.counts[column].append(_int(row.get(column)))
+            else:
+                snapshot.usernames[position] = username
+                snapshot.display_names[position] = display_name
+                for column in COUNT_COLUMNS:
+                    snapshot.counts[column][position] = _int(row.get(column))
+
+        snapshot.by_id = positions
+        snapshot.by_lower = {username.lower(): position for position, username in enumerate(snapshot.usernames)}
+        order = sorted(range(len(snapshot.usernames)), key=lambda position: snapshot.usernames[position].lower())
+        snapshot.sorted_lower = [snapshot.usernames[position].lower() for position in order]
+        snapshot.sorted_positions = array("I", order)
+        return snapshot
+
+    def refresh(self, fetch_pages: FetchPages) -> int:
+        """
+        Load the index. Once loaded from a table with an updated_at column, only rows
+        changed since the last refresh are fetched; otherwise the index is rebuilt in full.
+
+        Args:
+            fetch_pages: Pages through a table by name with the given params
+
+        Returns:
+            The number of rows fetched
+        """
+        with self._refresh_lock:
+            sources = [self._source] if self._source else SOURCES
+            for table, timestamp_column in sources:
+                incremental = bool(self.loaded and timestamp_column and self._watermark)
+                params = {"select": ",".join(INDEX_COLUMNS + ((timestamp_column,) if timestamp_column else ()))}
+                if incremental and timestamp_column:
+                    params[timestamp_column] = f"gt.{self._watermark}"
+                try:
+                    rows = [row for page in fetch_pages(table, params) for row in page]
+                except Exception as e:
+                    logger.warning(f"Could not load account index from {table}: {e}")
+                    continue
+
+                watermark = None
+                if timestamp_column:
+                    watermark = max((str(row[timestamp_column]) for row in rows if row.get(timestamp_column)), default=None)
+                self._snapshot = self.build(rows, base=self._snapshot if incremental else None)
+                self._source = (table, timestamp_column)
+                self._watermark = max(filter(None, [self._watermark if incremental else None, watermark]), default=None)
+                self.refreshed_at = time.time()
+                self.loaded = True
+                metrics.increment("account_index.rows_fetched", len(rows))
+                metrics.increment("account_index.full_reloads" if not incremental else "account_index.incremental_refreshes")
+                logger.info(f"Account index refreshed from {table}: {len(rows)} rows, {len(self)} accounts")
+                return len(rows)
+            return 0
+
+    def freshness(self) -> str:
+        """Say how current the index is, for the notes of the tools that read it."""
+        if not self.loaded or self._source is None:
+            return "The local account index is not loaded."
+        table, timestamp_column = self._source
+        age = int((time.time() - (self.refreshed_at or time.time())) / 60)
+        how = (
+            f"changed rows are picked up by {timestamp_column}" if timestamp_column
+            else "it has no updated_at column, so it is reloaded in full on every refresh"
+        )
+        return f"Counts are from the local account index, refreshed from {table} {age} min ago ({how})."
+
+    async def refresh_forever(self, fetch_pages: FetchPages, interval: float = ACCOUNT_INDEX_REFRESH_SECONDS) -> None:
+        """Refresh the index in a worker thread every `interval` seconds until cancelled."""
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh, fetch_pages)
+            except Exception as e:
+                logger.error(f"Account index refresh failed: {e}")
+            await asyncio.sleep(interval)
+
+    def lookup(self, username: str, case_sensitive: bool = False) -> Optional[Dict[str, Any]]:
+        """Find an account by username."""
+        snapshot = self._snapshot
+        position = snapshot.by_lower.get(username.lstrip("@").lower())
+        if position is None or (case_sensitive and snapshot.usernames[position] != username):
+            return None
+        return snapshot.row(position)
+
+    def resolve(self, username: str) -> Optional[str]:
+        """Return the account_id for an exact (case-sensitive) username, as PostgREST eq would match it."""
+        account = self.lookup(username, case_sensitive=True)
+        return account["account_id"] if account else None
+
+    def resolve_any(self, username: str) -> Optional[str]:
+        """Return the account_id for a username, ignoring case."""
+        account = self.lookup(username)
+        return account["account_id"] if account else None
+
+    def username_for(self, account_id: Any) -> Optional[str]:
+        """Return the username for an account_id, if it is in the index."""
+        snapshot = self._snapshot
+        position = snapshot.by_id.get(_int(account_id))
+        return snapshot.usernames[position] if position is not None else None
+
+    def prefix_search(self, prefix: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Return accounts whose username starts with `prefix` (case-insensitive), most followed first."""
+        snapshot = self._snapshot
+        prefix = prefix.lstrip("@").lower()
+        start = bisect.bisect_left(snapshot.sorted_lower, prefix)
+        end = bisect.bisect_left(snapshot.sorted_lower, prefix + "￿", lo=start)
+        positions = snapshot.sorted_positions[start:end]
+        followers = snapshot.counts["num_followers"]
+        best = sorted(positions, key=lambda position: followers[position], reverse=True)[:limit]
+        return [snapshot.row(position) for position in best]
+
+
+def lookup_upstream(
+    usernames: List[str],
+    prefix: Optional[str],
+    limit: int,
+    request_accounts: RequestAccounts
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Answer a lookup from the account endpoint, for when the local index is off or still loading."""
+    select = ",".join(INDEX_COLUMNS)
+    # Usernames are letters, digits and underscores; anything else would break the PostgREST filter
+    names = [re.sub(r"\W", "", name.lstrip("@")) for name in usernames]
+    rows: List[Dict[str, Any]] = []
+    missing = []
+    if any(names):
+        filters = ",".join(f"username.ilike.{name}" for name in names if name)
+        found = request_accounts({"select": select, "or": f"({filters})", "limit": 2 * len(names)})
+        found = found if isinstance(found, list) else []
+        by_lower = {str(row.get("username", "")).lower(): row for row in found if isinstance(row, dict)}
+        for username, name in zip(usernames, names):
+            if name.lower() in by_lower:
+                rows.append(by_lower[name.lower()])
+            else:
+                missing.append(username)
+    prefix = re.sub(r"\W", "", (prefix or "").lstrip("@"))
+    if prefix:
+        found = request_accounts({
+            "select": select,
+            "username": f"ilike.{prefix}*",
+            "order": "num_followers.desc",
+            "limit": limit
+        })
+        rows.extend(found if isinstance(found, list) else [])
+
+    notes = ["Looked up from the archive API; the local account index is not loaded."]
+    if missing:
+        notes.append(f"Not in the archive: {', '.join(missing)}")
+    return rows[:max(limit, len(usernames))], notes
+
+
+def run_lookup_tool(
+    args: Dict[str, Any],
+    index: AccountIndex,
+    request_accounts: Optional[RequestAccounts] = None
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Handle a `lookup_accounts` tool call.
+
+    Args:
+        args: The tool call arguments
+        index: The local account index
+        request_accounts: Queries the account endpoint with PostgREST params, used while the index is not loaded
+    """
+    limit = min(int(args.get("limit") or 10), 50)
+    usernames = args.get("usernames") or []
+    if isinstance(usernames, str):
+        usernames = [name.strip() for name in usernames.split(",")]
+
+    if not index.loaded:
+        if request_accounts is None:
+            raise ValueError("The account index is not loaded. Use get_account_info instead.")
+        return lookup_upstream(usernames, args.get("prefix"), limit, request_accounts)
+
+    rows: List[Dict[str, Any]] = []
+    notes: List[str] = []
+    missing = []
+    for username in usernames:
+        account = index.lookup(username)
+        if account:
+            rows.append(account)
+        else:
+            missing.append(username)
+    if args.get("prefix"):
+        rows.extend(index.prefix_search(args["prefix"], limit=limit))
+
+    if missing:
+        notes.append(f"Not in the archive: {', '.join(missing)}")
+    notes.append(index.freshness())
+    return rows[:max(limit, len(usernames))], notes
+
+
+account_index = AccountIndex()
@@ -0,0 +1,212 @@
+import os
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Upper bound on the rows a single aggregation may pull from upstream
+AGGREGATE_MAX_ROWS: int = int(os.getenv("AGGREGATE_MAX_ROWS", "20000"))
+
+OPERATIONS = ("count", "sum", "top_k", "histogram", "distinct_count")
+BUCKETS = ("day", "week", "month", "year")
+
+
+class Column:
+    """
+    A dictionary-encoded column: one integer code per row plus the list of distinct labels.
+
+    Labels are sorted, with None (missing) last. Grouping on the codes lets
+    numpy's bincount do the per-group work instead of a Python loop over rows.
+    """
+
+    def __init__(self, values: List[Any]):
+        present = [value for value in values if value is not None]
+        try:
+            labels, inverse = np.unique(np.fromiter(present, dtype=object, count=len(present)), return_inverse=True)
+            self.labels: List[Any] = labels.tolist()
+        except TypeError:
+            # Labels of mixed types do not sort; keep them in first-seen order
+            self.labels = list(dict.fromkeys(present))
+            index = {label: code for code, label in enumerate(self.labels)}
+            inverse = np.fromiter((index[value] for value in present), dtype=np.intp, count=len(present))
+        self.codes = np.full(len(values), len(self.labels), dtype=np.intp)
+        if len(present) < len(values):
+            self.labels.append(None)
+        self.codes[np.fromiter((value is not None for value in values), dtype=bool, count=len(values))] = inverse
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+
+def _to_float(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def numeric_column(values: List[Any]) -> np.ndarray:
+    """Pack values into a float array, with NaN for anything missing or non-numeric."""
+    return np.fromiter((_to_float(value) for value in values), dtype=np.float64, count=len(values))
+
+
+def time_bucket(value: Any, bucket: str) -> Optional[str]:
+    """Truncate an ISO timestamp to the start of its day, ISO week, month or year."""
+    if not isinstance(value, str) or len(value) < 10:
+        return None
+    if bucket == "year":
+        return value[:4]
+    if bucket == "month":
+        return value[:7]
+    if bucket == "day":
+        return value[:10]
+    year, week, _ = datetime.fromisoformat(value[:10]).isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def get_path(row: Dict[str, Any], column: str) -> Any:
+    """Read a possibly dotted column (e.g. "account.username") from a row with embeddings."""
+    value: Any = row
+    for part in column.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def group_counts(keys: Column) -> np.ndarray:
+    """Count rows per distinct key, indexed by code."""
+    return np.bincount(keys.codes, minlength=len(keys.labels))
+
+
+def group_sums(keys: Column, values: np.ndarray) -> np.ndarray:
+    """Sum `values` per distinct key, indexed by code, skipping NaNs."""
+    present = ~np.isnan(values)
+    return np.bincount(keys.codes[present], weights=values[present], minlength=len(keys.labels))
+
+
+def group_distinct(keys: Column, values: Column) -> np.ndarray:
+    """Count distinct values per key, indexed by code."""
+    pairs = np.unique(keys.codes * len(values.labels) + values.codes)
+    return np.bincount(pairs // max(len(values.labels), 1), minlength=len(keys.labels))
+
+
+def largest(values: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the `k` largest non-NaN values, largest first, ties in index order."""
+    present = np.flatnonzero(~np.isnan(values))
+    return present[np.argsort(-values[present], kind="stable")[:k]]
+
+
+def aggregate_rows(
+    rows: List[Dict[str, Any]],
+    operation: str,
+    group_by: Optional[str] = None,
+    value_column: Optional[str] = None,
+    bucket: str = "month",
+    k: int = 10
+) -> List[Dict[str, Any]]:
+    """
+    Aggregate rows locally and return a compact result table.
+
+    Args:
+        rows: Rows fetched from upstream
+        operation: One of OPERATIONS
+        group_by: Column to group by (for "histogram", the timestamp column to bucket)
+        value_column: Column to sum, rank by (top_k) or count distinct values of
+        bucket: Time bucket size for "histogram"
+        k: Maximum number of groups or rows to return
+
+    Returns:
+        A list of result rows, largest first (chronological for histograms)
+    """
+    if operation not in OPERATIONS:
+        raise ValueError(f"Unknown operation {operation!r}; expected one of {', '.join(OPERATIONS)}")
+    if operation in ("sum", "top_k", "distinct_count") and not value_column:
+        raise ValueError(f"Operation {operation!r} requires value_column")
+    if operation == "histogram" and not group_by:
+        raise ValueError("Operation 'histogram' requires group_by to name a timestamp column, e.g. created_at")
+    if operation == "histogram" and bucket not in BUCKETS:
+        raise ValueError(f"Unknown bucket {bucket!r}; expected one of {', '.join(BUCKETS)}")
+
+    # The checks above guarantee the columns each branch reads
+    if operation == "top_k" and value_column:
+        values = numeric_column([get_path(row, value_column) for row in rows])
+        label = group_by or "row"
+        return [
+            {label: get_path(rows[index], group_by) if group_by else int(index) + 1, value_column: get_path(rows[index], value_column)}
+            for index in largest(values, k)
+        ]
+
+    if operation == "histogram" and group_by:
+        keys = Column([time_bucket(get_path(row, group_by), bucket) for row in rows])
+        label = f"{group_by}_{bucket}"
+    else:
+        keys = Column([get_path(row, group_by) for row in rows] if group_by else [None] * len(rows))
+        label = group_by or "group"
+
+    if operation in ("sum", "histogram") and value_column:
+        totals = group_sums(keys, numeric_column([get_path(row, value_column) for row in rows]))
+        metric = f"sum_{value_column}"
+    elif operation == "distinct_count" and value_column:
+        totals = group_distinct(keys, Column([get_path(row, value_column) for row in rows]))
+        metric = f"distinct_{value_column}"
+    else:
+        totals = group_counts(keys)
+        metric = "count"
+
+    if operation == "histogram":
+        # Labels are sorted, so code order is chronological; drop the missing-timestamp group
+        codes = [code for code, bucket_label in enumerate(keys.labels) if bucket_label is not None]
+    else:
+        codes = largest(totals.astype(np.float64), k).tolist()
+
+    result = []
+    for code in codes:
+        value = float(totals[code])
+        value = int(value) if value.is_integer() else round(value, 4)
+        result.append({label: keys.labels[code], metric: value} if group_by else {metric: value})
+    return result
+
+
+def run_aggregate_tool(
+    args: Dict[str, Any],
+    fetch_rows: Callable[[str, Dict[str, Any], int], Tuple[List[Dict[str, Any]], bool]]
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Handle an `aggregate_archive` tool call.
+
+    Only the columns the aggregation needs are fetched, in bulk, through
+    `fetch_rows(source, params, max_rows)`, which returns the rows and whether
+    the row cap was hit.
+
+    Returns:
+        The aggregate rows and notes for the model
+    """
+    source = args.get("source")
+    operation = str(args.get("operation") or "")
+    group_by = args.get("group_by")
+    value_column = args.get("value_column")
+    bucket = args.get("bucket") or "month"
+    k = min(int(args.get("k") or 10), 100)
+    if not source:
+        raise ValueError("aggregate_archive requires `source`, the name of the tool to read rows from, e.g. get_tweets")
+
+    # Fetch just the columns we aggregate over; embedded columns like account.username are fetched as account(username)
+    columns = [column for column in dict.fromkeys([group_by, value_column]) if column]
+    select = []
+    for column in columns:
+        if "." in column:
+            relation, field = column.split(".", 1)
+            select.append(f"{relation}({field})")
+        else:
+            select.append(column)
+
+    params = dict(args.get("filters") or {})
+    params["select"] = ",".join(select) or "*"
+    rows, capped = fetch_rows(source, params, AGGREGATE_MAX_ROWS)
+
+    result = aggregate_rows(rows, operation, group_by=group_by, value_column=value_column, bucket=bucket, k=k)
+    notes = [f"Aggregated {len(rows)} rows from {source} locally."]
+    if capped:
+        notes.append(f"Only the first {AGGREGATE_MAX_ROWS} matching rows were aggregated; narrow the filters for exact totals.")
+    return result, notes
@@ -0,0 +1,122 @@
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.query_cost import MAX_LIMIT, parse_select
+
+# Columns, besides each endpoint's primary key, that identify at most one row
+UNIQUE_COLUMNS = {
+    "get_account_info": ("username",),
+}
+
+# Keys per merged request; each key matches at most one row, so this is also the merged limit
+MAX_BATCH_SIZE = MAX_LIMIT
+
+# Values that can go into in.(...) unquoted
+_VALUE_PATTERN = re.compile(r"[\w\-]+")
+
+BatchKey = Tuple[str, str, str]
+
+
+@dataclass
+class PreparedCall:
+    """An endpoint tool call whose params have been through the resolvers and cost rules."""
+    tool_call_id: str
+    function_name: str
+    endpoint: Dict[str, Any]
+    params: Dict[str, Any]
+    notes: List[str] = field(default_factory=list)
+
+
+def key_value(call: PreparedCall, column: str) -> str:
+    return str(call.params[column]).partition(".")[2]
+
+
+def batch_key(call: PreparedCall) -> Optional[BatchKey]:
+    """
+    Return what a call must share with others to be merged into one request, or None if it cannot be.
+
+    A call can be batched when it looks up a single value of a unique column with
+    `eq.` and has no offset. Calls batch together when they hit the same endpoint
+    with the same key column and identical remaining params apart from `limit`.
+    """
+    params = call.params
+    unique = {call.endpoint.get("primary_key"), *UNIQUE_COLUMNS.get(call.function_name, ())} - {None}
+    columns = [column for column in unique if column in params]
+    if len(columns) != 1:
+        return None
+    column = columns[0]
+    operator, _, value = str(params[column]).partition(".")
+    if operator != "eq" or not _VALUE_PATTERN.fullmatch(value):
+        return None
+    if str(params.get("offset", 0)) not in ("0", "None"):
+        return None
+    # Aliased or cast columns would hide the key from the split
+    if ":" in str(params.get("select", "")):
+        return None
+    others = {key: value for key, value in params.items() if key not in (column, "limit", "offset")}
+    return call.function_name, column, json.dumps(others, sort_keys=True, default=str)
+
+
+def merge_params(calls: List[PreparedCall], column: str) -> Tuple[Dict[str, Any], bool]:
+    """
+    Build one request covering every call's key value with `in.(...)`.
+
+    Returns:
+        The merged params, and whether the key column had to be added to the select
+    """
+    params = {key: value for key, value in calls[0].params.items() if key not in (column, "limit", "offset")}
+    values = list(dict.fromkeys(key_value(call, column) for call in calls))
+    params[column] = f"in.({','.join(values)})"
+    params["limit"] = len(values)
+
+    select = params.get("select")
+    added = bool(select and select != "*" and column not in parse_select(select))
+    if added:
+        params["select"] = f"{select},{column}"
+    return params, added
+
+
+def split_rows(rows: List[Dict[str, Any]], calls: List[PreparedCall], column: str, added: bool) -> Dict[str, List[Dict[str, Any]]]:
+    """Hand each call the rows matching its key value, honouring its own limit."""
+    by_value: Dict[str, List[Dict[str, Any]]] = {}
+    for row in rows:
+        by_value.setdefault(str(row.get(column)), []).append(row)
+
+    split: Dict[str, List[Dict[str, Any]]] = {}
+    for call in calls:
+        matched = by_value.get(key_value(call, column), [])
+        limit = call.params.get("limit")
+        if limit not in (None, ""):
+            matched = matched[:max(int(limit), 0)]
+        if added:
+            matched = [{key: value for key, value in row.items() if key != column} for row in matched]
+        split[call.tool_call_id] = matched
+    return split
+
+
+def plan_batches(calls: List[PreparedCall]) -> Tuple[List[Tuple[str, List[PreparedCall]]], List[PreparedCall]]:
+    """
+    Group calls that can share a request.
+
+    Returns:
+        (key column, calls) for every group of two or more, and the calls left to run alone
+    """
+    groups: Dict[BatchKey, List[PreparedCall]] = {}
+    singles: List[PreparedCall] = []
+    for call in calls:
+        key = batch_key(call)
+        if key is None:
+            singles.append(call)
+        else:
+            groups.setdefault(key, []).append(call)
+
+    batches: List[Tuple[str, List[PreparedCall]]] = []
+    for (_, column, _), group in groups.items():
+        if len(group) == 1:
+            singles.extend(group)
+            continue
+        for start in range(0, len(group), MAX_BATCH_SIZE):
+            batches.append((column, group[start:start + MAX_BATCH_SIZE]))
+    return batches, singles
@@ -0,0 +1,300 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+# Replies only appear when a new archive is uploaded, so cached children stay valid for a while
+CONVERSATION_CACHE_TTL: float = float(os.getenv("CONVERSATION_CACHE_TTL", "3600"))
+CONVERSATION_CACHE_MAX_TWEETS: int = int(os.getenv("CONVERSATION_CACHE_MAX_TWEETS", "50000"))
+
+DEFAULT_MAX_DEPTH = 10
+DEFAULT_MAX_BREADTH = 10
+MAX_DEPTH = 50
+MAX_BREADTH = 50
+MAX_TREE_TWEETS = 100
+MAX_ANCESTORS = 20
+
+# Tweet IDs per `in.(...)` filter, and rows per upstream request
+IN_BATCH_SIZE = 100
+ROWS_PER_REQUEST = 1000
+
+TWEET_TEXT_CHARS = 160
+TWEET_SELECT = "tweet_id,created_at,full_text,favorite_count,retweet_count,reply_to_tweet_id,account(username)"
+
+FetchRows = Callable[[str, Dict[str, Any]], List[Dict[str, Any]]]
+
+
+@dataclass
+class CachedTweet:
+    row: Dict[str, Any]
+    children: Optional[List[str]] = None  # None until every child has been fetched
+    fetched_at: float = field(default_factory=time.time)
+
+
+def compact_tweet(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Flatten the embedded account and keep only the columns the tree needs."""
+    account = row.get("account")
+    return {
+        "tweet_id": str(row.get("tweet_id")),
+        "username": account.get("username") if isinstance(account, dict) else None,
+        "created_at": row.get("created_at"),
+        "full_text": row.get("full_text"),
+        "favorite_count": row.get("favorite_count") or 0,
+        "retweet_count": row.get("retweet_count") or 0,
+        "reply_to_tweet_id": str(row["reply_to_tweet_id"]) if row.get("reply_to_tweet_id") else None,
+    }
+
+
+def chunks(items: List[str], size: int) -> List[List[str]]:
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+class ReplyIndex:
+    """
+    Local parent -> children index over the tweets seen by conversation lookups.
+
+    A tweet's children are recorded only once all of them have been fetched,
+    so a cached tweet either answers "what are its replies" completely or
+    not at all. Least recently used tweets are evicted past
+    CONVERSATION_CACHE_MAX_TWEETS.
+    """
+
+    def __init__(self, max_tweets: int = CONVERSATION_CACHE_MAX_TWEETS, ttl: float = CONVERSATION_CACHE_TTL):
+        self.max_tweets = max_tweets
+        self.ttl = ttl
+        self._tweets: "OrderedDict[str, CachedTweet]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tweet_id: str) -> Optional[CachedTweet]:
+        with self._lock:
+            cached = self._tweets.get(tweet_id)
+            if cached is None:
+                return None
+            if time.time() - cached.fetched_at > self.ttl:
+                del self._tweets[tweet_id]
+                return None
+            self._tweets.move_to_end(tweet_id)
+            return cached
+
+    def add(self, row: Dict[str, Any]) -> None:
+        with self._lock:
+            cached = self._tweets.get(row["tweet_id"])
+            if cached:
+                cached.row = row
+            else:
+                self._tweets[row["tweet_id"]] = CachedTweet(row=row)
+            self._tweets.move_to_end(row["tweet_id"])
+            while len(self._tweets) > self.max_tweets:
+                self._tweets.popitem(last=False)
+
+    def set_children(self, tweet_id: str, children: List[str]) -> None:
+        with self._lock:
+            cached = self._tweets.get(tweet_id)
+            if cached:
+                cached.children = children
+
+
+class ConversationBuilder:
+    """Reconstructs reply trees with one batched upstream request per tree level."""
+
+    def __init__(self, fetch_rows: FetchRows, index: Optional[ReplyIndex] = None):
+        self._fetch_rows = fetch_rows
+        self.index = index or ReplyIndex()
+
+    def _request(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        rows = self._fetch_rows("get_tweets", params)
+        if not isinstance(rows, list):
+            raise ValueError(f"Could not fetch tweets: {rows}")
+        return rows
+
+    def fetch_tweets(self, tweet_ids: List[str]) -> None:
+        """Fetch tweets that are not in the index yet."""
+        missing = [tweet_id for tweet_id in tweet_ids if self.index.get(tweet_id) is None]
+        for batch in chunks(missing, IN_BATCH_SIZE):
+            rows = self._request({
+                "select": TWEET_SELECT, "tweet_id": f"in.({','.join(batch)})", "limit": len(batch)
+            })
+            for row in rows:
+                self.index.add(compact_tweet(row))
+
+    def _expand(self, parents: List[str], partial: Dict[str, List[str]]) -> None:
+        """
+        Fetch the replies to every parent whose children are not cached, batched with in.(...).
+
+        Children from a page that may have been cut off are kept in `partial` for this
+        build only, so they never enter the index as a complete list.
+        """
+        unknown = [parent for parent in parents if (self.index.get(parent) or CachedTweet({})).children is None]
+        metrics.increment("conversation.cached_expansions", len(parents) - len(unknown))
+        for batch in chunks(unknown, IN_BATCH_SIZE):
+            rows = self._request({
+                "select": TWEET_SELECT,
+                "reply_to_tweet_id": f"in.({','.join(batch)})",
+                "order": "favorite_count.desc",
+                "limit": ROWS_PER_REQUEST,
+            })
+            metrics.increment("conversation.upstream_requests")
+            children: Dict[str, List[str]] = {parent: [] for parent in batch}
+            for row in map(compact_tweet, rows):
+                self.index.add(row)
+                children.setdefault(row["reply_to_tweet_id"], []).append(row["tweet_id"])
+            if len(rows) < ROWS_PER_REQUEST:
+                for parent, child_ids in children.items():
+                    self.index.set_children(parent, child_ids)
+            else:
+                partial.update(children)
+
+    def _children(self, parent: str, partial: Dict[str, List[str]]) -> List[str]:
+        cached = self.index.get(parent)
+        if cached is not None and cached.children is not None:
+            return cached.children
+        return partial.get(parent, [])
+
+    def ancestors(self, tweet_id: str) -> List[str]:
+        """Walk reply_to_tweet_id up from a tweet, returning IDs from the root down to its parent."""
+        chain: List[str] = []
+        current = self.index.get(tweet_id)
+        while current and current.row.get("reply_to_tweet_id") and len(chain) < MAX_ANCESTORS:
+            parent_id = current.row["reply_to_tweet_id"]
+            self.fetch_tweets([parent_id])
+            current = self.index.get(parent_id)
+            if current is None:
+                break
+            chain.append(parent_id)
+        return list(reversed(chain))
+
+    def build(
+        self,
+        root_id: str,
+        max_depth: int = DEFAULT_MAX_DEPTH,
+        max_breadth: int = DEFAULT_MAX_BREADTH,
+        keep: Tuple[str, ...] = ()
+    ) -> Tuple[List[Dict[str, Any]], List[str]]:
+        """
+        Build the reply tree below `root_id`.
+
+        Replies are expanded level by level, so a tree costs one batched upstream
+        request per depth rather than one per tweet, and none for levels already
+        in the reply index. The most liked `max_breadth` replies to each tweet are
+        kept, plus any tweet in `keep` (the path to the tweet the user asked about).
+
+        Returns:
+            The tweets in depth-first order with `depth` and `omitted_replies` columns,
+            and notes on what was cut
+        """
+        self.fetch_tweets([root_id])
+        if self.index.get(root_id) is None:
+            raise ValueError(f"Tweet {root_id} is not in the archive")
+
+        frontier = [root_id]
+        partial: Dict[str, List[str]] = {}
+        kept_children: Dict[str, List[str]] = {}
+        omitted: Dict[str, int] = {}
+        total = 1
+        depth = 0
+        while frontier and depth < max_depth and total < MAX_TREE_TWEETS:
+            self._expand(frontier, partial)
+            next_frontier = []
+            for parent in frontier:
+                children = self._children(parent, partial)
+                pinned = [child for child in children if child in keep]
+                kept = (pinned + [child for child in children if child not in keep][:max_breadth - len(pinned)])
+                kept = kept[:max(MAX_TREE_TWEETS - total, len(pinned))]
+                kept_children[parent] = kept
+                if len(children) > len(kept):
+                    omitted[parent] = len(children) - len(kept)
+                total += len(kept)
+                next_frontier.extend(kept)
+            frontier = next_frontier
+            depth += 1
+
+        notes: List[str] = []
+        if frontier and depth >= max_depth:
+            notes.append(f"Replies deeper than {max_depth} levels are not shown.")
+        if total >= MAX_TREE_TWEETS:
+            notes.append(f"The tree was cut off at {MAX_TREE_TWEETS} tweets.")
+
+        rows: List[Dict[str, Any]] = []
+
+        def visit(node: str, level: int) -> None:
+            cached = self.index.get(node)
+            if cached is None:
+                return
+            rows.append({**cached.row, "depth": level, "omitted_replies": omitted.get(node, 0)})
+            for child in kept_children.get(node, []):
+                visit(child, level + 1)
+
+        visit(root_id, 0)
+        metrics.increment("conversation.trees")
+        return rows, notes
+
+
+def format_tree(rows: List[Dict[str, Any]], focus_id: Optional[str] = None) -> str:
+    """
+    Serialize a reply tree as an indented outline, one line per tweet:
+    `<id> @user YYYY-MM-DD <likes>L: text`, with `*` marking the requested tweet and
+    a count of any replies cut by the breadth limit.
+    """
+    lines = []
+    for row in rows:
+        text = " ".join(str(row.get("full_text") or "").split())
+        if len(text) > TWEET_TEXT_CHARS:
+            text = text[:TWEET_TEXT_CHARS - 3] + "..."
+        marker = "* " if row["tweet_id"] == focus_id else ""
+        date = str(row.get("created_at") or "")[:10]
+        line = f"{'  ' * row['depth']}{marker}{row['tweet_id']} @{row.get('username') or '?'} {date} {row['favorite_count']}L: {text}"
+        if row.get("omitted_replies"):
+            line += f" [+{row['omitted_replies']} replies not shown]"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def run_conversation_tool(
+    args: Dict[str, Any],
+    builder: ConversationBuilder,
+    fetch_conversation_root: Callable[[str], Optional[str]]
+) -> Tuple[List[Dict[str, Any]], List[str], str]:
+    """
+    Handle a `get_conversation_tree` tool call.
+
+    Args:
+        args: The tool call arguments
+        builder: Builds trees against the archive and the local reply index
+        fetch_conversation_root: Maps a conversation_id to its root tweet_id, if known
+
+    Returns:
+        The tree rows, notes, and the tree serialized for the model
+    """
+    tweet_id = str(args.get("tweet_id") or "").strip()
+    conversation_id = str(args.get("conversation_id") or "").strip()
+    if not tweet_id and not conversation_id:
+        raise ValueError("Pass either tweet_id or conversation_id")
+
+    max_depth = max(1, min(int(args.get("max_depth") or DEFAULT_MAX_DEPTH), MAX_DEPTH))
+    max_breadth = max(1, min(int(args.get("max_breadth") or DEFAULT_MAX_BREADTH), MAX_BREADTH))
+
+    notes: List[str] = []
+    path: List[str] = []
+    if tweet_id:
+        root_id = tweet_id
+        if args.get("whole_thread", True) is not False:
+            builder.fetch_tweets([tweet_id])
+            path = builder.ancestors(tweet_id)
+            if len(path) >= MAX_ANCESTORS:
+                notes.append(f"The thread was started from the tweet {MAX_ANCESTORS} replies above the one requested.")
+            root_id = path[0] if path else tweet_id
+    else:
+        # On Twitter a conversation's ID is the ID of the tweet that started it
+        root_id = fetch_conversation_root(conversation_id) or conversation_id
+
+    rows, tree_notes = builder.build(root_id, max_depth, max_breadth, keep=tuple(path + [tweet_id]))
+    notes.extend(tree_notes)
+    text = format_tree(rows, focus_id=tweet_id if tweet_id != root_id else None)
+    return rows, notes, text
@@ -1,11 +1,31 @@
 import os
+import re
+import json
+import hashlib
 import logging
 import asyncio
+from typing import Any, Dict, List, cast
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
 from openai.types.beta.assistant_update_params import AssistantUpdateParams
 from openai.types.beta.assistant import Assistant
-from utils.tools import SYSTEM_PROMPT, REQUEST_SCHEMAS
+from openai.types.beta.function_tool_param import FunctionToolParam
+from utils.schema_compaction import COMPACT_SYSTEM_PROMPT, COMPACT_REQUEST_SCHEMAS
+from utils.tools import ENDPOINT_SCHEMAS, LOCAL_TOOLS
+
+# Sync the assistant with the local config when the app starts, if it has changed
+ASSISTANT_SYNC_ENABLED: bool = os.getenv("ASSISTANT_SYNC_ENABLED", "true").lower() == "true"
+# Limits of the Assistants API, checked before anything is sent
+MAX_INSTRUCTIONS_CHARS: int = 256000
+MAX_TOOLS: int = 128
+JSON_SCHEMA_TYPES = {"string", "integer", "number", "boolean", "array", "object", "null"}
+_FUNCTION_NAME_PATTERN = re.compile(r"^[a-zA-Z0-9_-]{1,64}$")
+# The parts of the config that are fingerprinted, and sent on their own when they change
+CONFIG_PARTS = ("name", "model", "instructions", "tools")
+
+
+class AssistantConfigError(ValueError):
+    """Raised when the assistant config is invalid. The message lists every problem found."""
 
 
 def update_env_file(var_name: str, var_value: str, logger: logging.Logger):
@@ -29,6 +49,9 @@ def update_env_file(var_name: str, var_value: str, logger: logging.Logger):
 
         # Remove any existing line with this variable
         lines = [line for line in lines if not line.startswith(f"{var_name}=")]
+        # Keep the new variable off the end of a last line that has no newline
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
     else:
         # Log when we're creating a new .env file
         logger.info("Creating new .env file")
@@ -41,61 +64,228 @@ def update_env_file(var_name: str, var_value: str, logger: logging.Logger):
     logger.debug(f"Environment variable {var_name} written to .env: {var_value}")
 
 
+def content_hash(value) -> str:
+    """A short hash of a JSON-serializable value that does not depend on key order."""
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:12]
+
+
+def request_tools(request: AssistantUpdateParams) -> List[Dict]:
+    """The config's tool schemas, which this app always writes as function tool dicts."""
+    return cast(List[Dict], list(request.get("tools", [])))
+
+
+def tool_versions(tools: List[Dict]) -> Dict[str, str]:
+    """The version of each tool schema, by function name: a hash of its content."""
+    return {tool["function"]["name"]: content_hash(tool) for tool in tools}
+
+
+def validate_tool_schema(tool: Dict) -> List[str]:
+    """
+    Check one tool schema against what the Assistants API and this app accept.
+
+    Args:
+        tool: A tool definition as sent to the API
+
+    Returns:
+        A list of problems, empty if the schema is valid
+    """
+    function = tool.get("function") or {}
+    name = function.get("name", "")
+    problems = []
+    if tool.get("type") != "function":
+        problems.append(f"{name or tool}: type must be 'function'")
+    if not _FUNCTION_NAME_PATTERN.match(name):
+        problems.append(f"{name!r}: name must be 1-64 letters, digits, underscores or dashes")
+    if not isinstance(function.get("description", ""), str):
+        problems.append(f"{name}: description must be a string")
+
+    parameters = function.get("parameters") or {}
+    if parameters.get("type") != "object":
+        problems.append(f"{name}: parameters must be a JSON schema of type 'object'")
+    properties = parameters.get("properties", {})
+    for parameter, schema in properties.items():
+        types = schema.get("type")
+        types = types if isinstance(types, list) else [types]
+        if not set(types) <= JSON_SCHEMA_TYPES and not {"anyOf", "oneOf", "enum", "$ref"} & set(schema):
+            problems.append(f"{name}.{parameter}: unknown type {schema.get('type')!r}")
+        if "array" in types and "items" not in schema:
+            problems.append(f"{name}.{parameter}: array parameters need 'items'")
+        if not isinstance(schema.get("description", ""), str):
+            problems.append(f"{name}.{parameter}: description must be a string")
+    for parameter in parameters.get("required", []):
+        if parameter not in properties:
+            problems.append(f"{name}: required parameter {parameter!r} is not defined")
+    return problems
+
+
+def validate_request(request: AssistantUpdateParams) -> None:
+    """
+    Check the whole assistant config before it is sent.
+
+    Every tool must have a valid schema, a unique name and a handler in this
+    app: an endpoint in ENDPOINT_SCHEMAS or a function in LOCAL_TOOLS.
+
+    Raises:
+        AssistantConfigError: Listing every problem found
+    """
+    problems = []
+    if not request.get("model"):
+        problems.append("model is missing")
+    instructions = request.get("instructions")
+    if not instructions:
+        problems.append("instructions are missing")
+    elif len(instructions) > MAX_INSTRUCTIONS_CHARS:
+        problems.append(f"instructions are {len(instructions)} characters, over {MAX_INSTRUCTIONS_CHARS}")
+
+    tools = request_tools(request)
+    if len(tools) > MAX_TOOLS:
+        problems.append(f"{len(tools)} tools, over {MAX_TOOLS}")
+    handled = {endpoint["name"] for endpoint in ENDPOINT_SCHEMAS} | {tool["name"] for tool in LOCAL_TOOLS}
+    seen = set()
+    for tool in tools:
+        problems.extend(validate_tool_schema(tool))
+        name = (tool.get("function") or {}).get("name")
+        if name in seen:
+            problems.append(f"{name}: defined more than once")
+        elif name and name not in handled:
+            problems.append(f"{name}: no endpoint or local handler answers this tool")
+        seen.add(name)
+
+    if problems:
+        raise AssistantConfigError("Invalid assistant config:\n- " + "\n- ".join(problems))
+
+
+def config_fingerprint(request: AssistantUpdateParams, assistant_id: str = "") -> str:
+    """
+    The content hash of each part of the assistant config, as stored in .env.
+
+    The tools are hashed by their versions, so any change to one schema
+    changes the fingerprint. The assistant the config was sent to leads, so a
+    fingerprint only vouches for that assistant.
+    Example: `assistant:asst_...,name:1a2b...,model:3c4d...,instructions:...,tools:...`
+    """
+    hashes = {part: content_hash(request.get(part)) for part in CONFIG_PARTS}
+    hashes["tools"] = content_hash(tool_versions(request_tools(request)))
+    return ",".join([f"assistant:{assistant_id}"] + [f"{part}:{value}" for part, value in hashes.items()])
+
+
+def parse_fingerprint(fingerprint: str) -> Dict[str, str]:
+    return dict(item.split(":", 1) for item in (fingerprint or "").split(",") if ":" in item)
+
+
+def save_fingerprint(fingerprint: str, logger: logging.Logger) -> None:
+    update_env_file("ASSISTANT_FINGERPRINT", fingerprint, logger)
+    os.environ["ASSISTANT_FINGERPRINT"] = fingerprint
+
+
 async def create_or_update_assistant(
         client: AsyncOpenAI,
         assistant_id: str,
         request: AssistantUpdateParams,
-        logger: logging.Logger
+        logger: logging.Logger,
+        force: bool = False
 ) -> str:
     """
     Create or update the assistant based on the presence of an assistant_id.
+
+    The config is validated first, so a broken tool schema fails here rather
+    than at the API. An existing assistant is only updated with the parts of
+    the config whose hash differs from ASSISTANT_FINGERPRINT in .env, and not
+    at all if none do. A fingerprint saved for a different assistant counts as
+    every part having changed.
+
+    Args:
+        client: OpenAI client
+        assistant_id: The assistant to update, or a false value to create one
+        request: The assistant config
+        logger: Logger instance for output
+        force: Send the whole config even if the fingerprint matches, e.g. after editing the assistant elsewhere
+
+    Returns:
+        The assistant ID, or an empty string if the API call failed
+
+    Raises:
+        AssistantConfigError: If the config is invalid; nothing is sent
     """
+    validate_request(request)
     try:
         if assistant_id:
-            # Update the existing assistant
-            assistant: Assistant = await client.beta.assistants.update(
+            fingerprint = config_fingerprint(request, assistant_id)
+            stored = parse_fingerprint(os.getenv("ASSISTANT_FINGERPRINT", ""))
+            current = parse_fingerprint(fingerprint)
+            force = force or stored.get("assistant") != assistant_id
+            changed = [part for part in CONFIG_PARTS if force or stored.get(part) != current[part]]
+            if not changed:
+                logger.info(f"Assistant {assistant_id} is up to date ({fingerprint})")
+                return assistant_id
+
+            # Update only the parts of the existing assistant that changed
+            await client.beta.assistants.update(
                 assistant_id,
-                **request
+                **{part: cast(Dict[str, Any], request)[part] for part in changed}
             )
-            logger.info(f"Updated assistant with ID: {assistant_id}")
+            logger.info(f"Updated {', '.join(changed)} of assistant with ID: {assistant_id}")
         else:
             # Create a new assistant
             assistant: Assistant = await client.beta.assistants.create(**request)
-            logger.info(f"Created new assistant: {assistant.id}")
+            assistant_id = assistant.id
+            fingerprint = config_fingerprint(request, assistant_id)
+            logger.info(f"Created new assistant: {assistant_id}")
 
             # Update the .env file with the new assistant ID
-            update_env_file("ASSISTANT_ID", assistant.id, logger)
+            update_env_file("ASSISTANT_ID", assistant_id, logger)
 
     except Exception as e:
         action = "update" if assistant_id else "create"
         logger.error(f"Failed to {action} assistant: {e}")
+        return ""
 
-    return assistant.id
+    save_fingerprint(fingerprint, logger)
+    return assistant_id
 
 
 request: AssistantUpdateParams = AssistantUpdateParams(
-    instructions=SYSTEM_PROMPT,
+    instructions=COMPACT_SYSTEM_PROMPT,
     name="Community Archive Assistant",
     model="gpt-4o",
-    tools=REQUEST_SCHEMAS
+    tools=cast(List[FunctionToolParam], COMPACT_REQUEST_SCHEMAS)
 )
 
 
 # Run the assistant creation in an asyncio event loop
 if __name__ == "__main__":
     import sys
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Create the assistant, or sync it with the local config.")
+    parser.add_argument("--check", action="store_true", help="Validate the config and list tool versions without calling the API")
+    parser.add_argument("--force", action="store_true", help="Send the whole config even if its fingerprint is unchanged")
+    options = parser.parse_args()
 
     # Configure logger to stream to console
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
     logger: logging.Logger = logging.getLogger(__name__)
     
     load_dotenv()
-    assistant_id = os.getenv("ASSISTANT_ID")
+    assistant_id = os.getenv("ASSISTANT_ID", "")
+
+    try:
+        validate_request(request)
+    except AssistantConfigError as e:
+        logger.error(e)
+        sys.exit(1)
+    if options.check:
+        for name, version in tool_versions(request_tools(request)).items():
+            print(f"{name:<24}{version}")
+        print(f"fingerprint  {config_fingerprint(request, assistant_id)}")
+        print(f"stored       {os.getenv('ASSISTANT_FINGERPRINT', '') or '(none)'}")
+        sys.exit(0)
 
     # Initialize the OpenAI client
     openai: AsyncOpenAI = AsyncOpenAI()
 
     # Run the main function in an asyncio event loop
     asyncio.run(
-        create_or_update_assistant(openai, assistant_id, request, logger)
+        create_or_update_assistant(openai, assistant_id, request, logger, force=options.force)
     )
@@ -2,7 +2,9 @@ import logging
 import requests
 import os
 import re
-from typing import Dict, Any, Tuple, Union, List
+from typing import Dict, Any, Iterator, Tuple, Union, List
+
+from utils.jobs import check_cancelled
 
 logger = logging.getLogger("uvicorn.error")
 
@@ -42,6 +44,9 @@ def make_request(endpoint: Dict[str, Any], params: Dict[str, Any]) -> List[Any]:
     :return: The JSON response from the API as a list. If the response is a dictionary, it will be wrapped in a list
     """    
 
+    # A tool call whose run was cancelled stops here rather than making another request
+    check_cancelled()
+
     raw_url: Any = endpoint.get("url")
     if not (raw_url and isinstance(raw_url, str)):
         raise ValueError("URL missing from tool schema")
@@ -136,4 +141,60 @@ def make_request(endpoint: Dict[str, Any], params: Dict[str, Any]) -> List[Any]:
             error_message += " You may have run a slow query. Try to optimize your query or break it into multiple steps."
 
         logger.error(error_message)
-        raise requests.exceptions.HTTPError(error_message, response=response)
\ No newline at end of file
+        raise requests.exceptions.HTTPError(error_message, response=response)
+
+
+def fetch_all(
+    endpoint: Dict[str, Any],
+    params: Dict[str, Any],
+    page_size: int = 1000,
+    max_rows: int = 20000,
+    after: Any = None
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Page through every row matching `params`, yielding one page at a time.
+
+    Pages are fetched with keyset pagination on the endpoint's primary key
+    (order=<pk>.asc with <pk> greater than the last key seen), so deep pages
+    cost the same as the first one. Endpoints without a known primary key, or
+    requests that already filter on it, fall back to offset pagination.
+
+    :param endpoint: The endpoint dictionary containing the URL, headers and primary key
+    :param params: Filters and select for the request; limit, offset and order are managed here
+    :param page_size: Rows requested per page
+    :param max_rows: Stop after yielding this many rows in total
+    :param after: Resume after this primary key value
+    :return: An iterator of pages (lists of rows)
+    """
+    primary_key = endpoint.get("primary_key")
+    use_keyset = bool(primary_key) and primary_key not in params and "and" not in params
+    base_params = {key: value for key, value in params.items() if key not in ("limit", "offset", "order")}
+
+    select = base_params.get("select")
+    if use_keyset and select and select != "*" and primary_key not in select.split(","):
+        base_params["select"] = f"{select},{primary_key}"
+
+    fetched = 0
+    while fetched < max_rows:
+        page_params = dict(base_params)
+        page_params["limit"] = min(page_size, max_rows - fetched)
+        if use_keyset:
+            page_params["order"] = f"{primary_key}.asc"
+            if after is not None:
+                page_params["and"] = f'({primary_key}.gt."{after}")'
+        else:
+            page_params["offset"] = fetched
+
+        page = make_request(endpoint=endpoint, params=page_params)
+        if isinstance(page, str):
+            raise ValueError(page)
+        if not page:
+            return
+
+        fetched += len(page)
+        yield page
+
+        if len(page) < page_params["limit"]:
+            return
+        if use_keyset:
+            after = page[-1].get(primary_key)
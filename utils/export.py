@@ -0,0 +1,203 @@
+import asyncio
+import csv
+import functools
+import io
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from utils.custom_functions import fetch_all
+from utils.metrics import metrics
+from utils.query_cost import PAGING_RULES, apply_cost_rules
+from utils.serialization import flatten_row
+
+logger = logging.getLogger("uvicorn.error")
+
+EXPORT_FORMATS = ("ndjson", "csv", "parquet")
+EXPORT_PAGE_SIZE: int = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+EXPORT_MAX_ROWS: int = int(os.getenv("EXPORT_MAX_ROWS", "1000000"))
+
+# Pages fetched ahead of what has been written to the client
+EXPORT_PREFETCH_PAGES = 2
+
+# Exports get their own small pool so they never starve the chat streams of threads
+_export_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("EXPORT_CONCURRENCY", "2")),
+    thread_name_prefix="export"
+)
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def can_resume(endpoint: Dict[str, Any], params: Dict[str, Any]) -> bool:
+    """Whether an export of this request is keyset-paged and so can resume from a cursor."""
+    primary_key = endpoint.get("primary_key")
+    return bool(primary_key) and primary_key not in params and "and" not in params
+
+
+async def fetch_pages(
+    endpoint: Dict[str, Any],
+    params: Dict[str, Any],
+    cursor: Optional[str] = None
+) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Yield every page of a request, fetched in the export thread pool.
+
+    A background task keeps up to EXPORT_PREFETCH_PAGES pages ready, so the
+    next PostgREST request overlaps with writing the current page to the
+    client, while memory stays bounded to a few pages.
+    """
+    params = dict(params)
+    apply_cost_rules(endpoint, params, exclude=PAGING_RULES)
+    pages: Iterator[List[Dict[str, Any]]] = fetch_all(
+        endpoint, params, page_size=EXPORT_PAGE_SIZE, max_rows=EXPORT_MAX_ROWS, after=cursor
+    )
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=EXPORT_PREFETCH_PAGES)
+    done = object()
+
+    async def produce():
+        try:
+            while True:
+                page = await loop.run_in_executor(_export_executor, next, pages, None)
+                if page is None:
+                    break
+                await queue.put(page)
+            await queue.put(done)
+        except Exception as e:
+            await queue.put(e)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            metrics.increment("export.rows", len(item))
+            yield item
+    finally:
+        producer.cancel()
+
+
+async def encode_ndjson(pages: AsyncIterator[List[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+    """One JSON object per line."""
+    async for page in pages:
+        yield "".join(json.dumps(row) + "\n" for row in page).encode()
+
+
+async def encode_csv(pages: AsyncIterator[List[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+    """CSV with embeddings flattened to dotted columns; the header comes from the first page."""
+    columns: Optional[List[str]] = None
+    async for page in pages:
+        rows = [flatten_row(row) for row in page]
+        buffer = io.StringIO()
+        if columns is None:
+            columns = list(dict.fromkeys(column for row in rows for column in row))
+            writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+            writer.writeheader()
+        else:
+            writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+
+
+def _parquet_writer(sink: io.BytesIO, rows: List[Dict[str, Any]]) -> Tuple[Any, Any]:
+    """A ParquetWriter into `sink` with the schema inferred from `rows`, and that schema."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    inferred = pa.Table.from_pylist(rows).schema
+    # Columns that were null throughout the first page are typed as strings
+    schema = pa.schema([
+        pa.field(field.name, pa.string() if pa.types.is_null(field.type) else field.type)
+        for field in inferred
+    ])
+    return pq.ParquetWriter(sink, schema), schema
+
+
+def _write_parquet_page(
+    sink: io.BytesIO,
+    writer: Any,
+    schema: Any,
+    page: List[Dict[str, Any]]
+) -> Tuple[bytes, Any, Any]:
+    """Write one page as a row group, opening the writer on the first, and take the bytes written out of `sink`."""
+    import pyarrow as pa
+
+    rows = [flatten_row(row) for row in page]
+    if writer is None:
+        writer, schema = _parquet_writer(sink, rows)
+    writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+    return _drain(sink), writer, schema
+
+
+def _close_parquet_writer(sink: io.BytesIO, writer: Any) -> bytes:
+    writer.close()
+    return _drain(sink)
+
+
+def _drain(sink: io.BytesIO) -> bytes:
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+async def encode_parquet(pages: AsyncIterator[List[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+    """
+    Parquet with one row group per page; the schema is inferred from the first page.
+    Building and writing the Arrow tables runs in the export pool, off the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    sink = io.BytesIO()
+    writer = None
+    schema = None
+    async for page in pages:
+        data, writer, schema = await loop.run_in_executor(_export_executor, _write_parquet_page, sink, writer, schema, page)
+        yield data
+
+    if writer is not None:
+        yield await loop.run_in_executor(_export_executor, _close_parquet_writer, sink, writer)
+
+
+@functools.lru_cache(maxsize=1)
+def parquet_available() -> bool:
+    """Parquet export needs pyarrow, which is optional."""
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def export_stream(
+    endpoint: Dict[str, Any],
+    params: Dict[str, Any],
+    fmt: str,
+    cursor: Optional[str] = None
+) -> AsyncIterator[bytes]:
+    """
+    Stream the complete result of a request in the given format.
+
+    Args:
+        endpoint: The endpoint schema of the recorded tool call
+        params: The recorded tool call arguments
+        fmt: One of EXPORT_FORMATS
+        cursor: Primary key of the last row already received, to resume an interrupted download
+    """
+    metrics.increment(f"export.started.{fmt}")
+    pages = fetch_pages(endpoint, params, cursor=cursor)
+    if fmt == "csv":
+        return encode_csv(pages)
+    if fmt == "parquet":
+        return encode_parquet(pages)
+    return encode_ndjson(pages)
@@ -0,0 +1,201 @@
+import contextvars
+import html
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils.metrics import metrics
+from utils.thread_store import ThreadStore
+
+logger = logging.getLogger("uvicorn.error")
+
+JOB_WORKERS: int = int(os.getenv("JOB_WORKERS", "4"))
+# Tool calls still running after this long become background jobs with progress updates
+JOB_AFTER_SECONDS: float = float(os.getenv("JOB_AFTER_SECONDS", "5"))
+JOB_PROGRESS_SECONDS: float = 2.0
+# How long a run waits for a job before answering without it. OpenAI expires runs in requires_action after 10 minutes.
+JOB_MAX_WAIT_SECONDS: float = float(os.getenv("JOB_MAX_WAIT_SECONDS", "480"))
+# A job still marked running after this long was lost with the process that ran it
+JOB_MAX_SECONDS: float = float(os.getenv("JOB_MAX_SECONDS", "900"))
+# How often a job waiting on calls started before it checks whether it was cancelled
+JOB_CANCEL_POLL_SECONDS = 0.25
+
+Calls = List[Tuple[str, str, Dict[str, Any]]]
+Outcomes = Dict[str, Any]
+Execute = Callable[[Calls, Optional[str], Optional[threading.Event]], Outcomes]
+
+_current_job: contextvars.ContextVar[Optional["Job"]] = contextvars.ContextVar("current_job", default=None)
+# Set once the run the current tool call belongs to was cancelled
+_cancelled: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar("cancelled", default=None)
+
+
+class ToolCallCancelled(RuntimeError):
+    """Raised in a tool call's worker thread when its run was cancelled."""
+
+
+def report_progress(message: str) -> None:
+    """Record progress for the job running the current tool call, if any."""
+    job = _current_job.get()
+    if job is not None:
+        job.progress = message
+
+
+def check_cancelled() -> None:
+    """
+    Stop the current tool call if its run was cancelled. Called before every upstream
+    request, so a cancelled call stops between pages rather than running to the end.
+
+    Raises:
+        ToolCallCancelled: If the call's cancellation event is set
+    """
+    cancelled = _cancelled.get()
+    if cancelled is not None and cancelled.is_set():
+        raise ToolCallCancelled("The run was cancelled")
+
+
+def run_cancellable(cancelled: threading.Event, function: Callable[..., Any], *args: Any) -> Any:
+    """Call `function` so that the requests it makes stop once `cancelled` is set. Runs in a worker thread."""
+    _cancelled.set(cancelled)
+    return function(*args)
+
+
+def describe_calls(calls: Calls) -> str:
+    return ", ".join(function_name for _, function_name, _ in calls)
+
+
+@dataclass
+class StartedCall:
+    """A tool call already running on another pool, such as one started while its arguments streamed in."""
+    future: Future
+    # Stops the call before its next upstream request
+    cancelled: threading.Event
+
+
+@dataclass
+class Job:
+    """The tool calls of one run step, executed on the job pool."""
+    job_id: str
+    thread_id: str
+    calls: Calls
+    started_at: float = field(default_factory=time.time)
+    progress: str = ""
+    # Set once the calls were slow enough to be tracked as a background job
+    background: bool = False
+    # Set if the run stopped waiting; the result then goes to the thread's next run
+    detached: bool = False
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    # Placeholder until submit() hands the calls to the pool
+    future: Future = field(default_factory=Future)
+    # Calls among `calls` that were already running when the job was submitted
+    started: Dict[str, StartedCall] = field(default_factory=dict)
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.started_at
+
+    @property
+    def status(self) -> str:
+        return f"{int(self.elapsed)}s elapsed" + (f" · {self.progress}" if self.progress else "")
+
+
+class JobManager:
+    """
+    Runs tool calls on a dedicated worker pool so a run can outlast them.
+
+    Every run step's calls are submitted here. Calls that finish within
+    JOB_AFTER_SECONDS look no different from before; slower ones are
+    recorded in the thread store as a background job, and the run streams
+    their progress while it waits. If the run goes away (the client left, or
+    the wait hit JOB_MAX_WAIT_SECONDS), the job keeps going and its finished
+    result is stored on the thread for the page and for the next run.
+    """
+
+    def __init__(self, store: ThreadStore, execute: Execute, workers: int = JOB_WORKERS):
+        self.store = store
+        self._execute = execute
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def _work(self, job: Job) -> Outcomes:
+        _current_job.set(job)
+        remaining = [call for call in job.calls if call[0] not in job.started]
+        outcomes = run_cancellable(job.cancelled, self._execute, remaining, job.thread_id, job.cancelled) if remaining else {}
+        for tool_call_id, started in job.started.items():
+            while not started.future.done():
+                if job.cancelled.is_set():
+                    started.cancelled.set()
+                wait([started.future], timeout=JOB_CANCEL_POLL_SECONDS)
+            try:
+                outcomes[tool_call_id] = started.future.result()
+            except Exception as e:
+                outcomes[tool_call_id] = e
+        return outcomes
+
+    def submit(self, thread_id: str, calls: Calls, started: Optional[Dict[str, StartedCall]] = None) -> Job:
+        """
+        Run a step's tool calls as one job.
+
+        Args:
+            thread_id: The thread the calls belong to
+            calls: (tool_call_id, function_name, args) for every call of the step
+            started: Calls that are already running, by tool_call_id; the job waits for them
+                instead of executing them, so they get the same progress, timeout and detach handling
+        """
+        job = Job(job_id=uuid.uuid4().hex[:12], thread_id=thread_id, calls=calls, started=dict(started or {}))
+        job.future = self._executor.submit(contextvars.copy_context().run, self._work, job)
+        with self._lock:
+            self._jobs[job.job_id] = job
+        job.future.add_done_callback(lambda _: self._forget(job))
+        return job
+
+    def _forget(self, job: Job) -> None:
+        if not job.detached:
+            with self._lock:
+                self._jobs.pop(job.job_id, None)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def promote(self, job: Job) -> None:
+        """Track a slow job in the thread store, so it is listed on the thread while it runs."""
+        job.background = True
+        self.store.save_job(job.job_id, job.thread_id, describe_calls(job.calls), job.started_at)
+        metrics.increment("jobs.background")
+
+    def finish(self, job: Job, output: str) -> None:
+        """Record a background job the run received the result of."""
+        if job.background:
+            self.store.finish_job(job.job_id, "done", output, "", delivered=True)
+
+    def detach(self, job: Job, render: Callable[[Job, Outcomes], Tuple[str, str]]) -> None:
+        """
+        Let a background job finish without its run.
+
+        Args:
+            job: The job
+            render: Turns the outcomes into (output for the model, widget HTML), in the job's worker thread
+        """
+        job.detached = True
+        metrics.increment("jobs.detached")
+
+        def store_result(future: Future) -> None:
+            try:
+                output, widget_html = render(job, future.result())
+                status = "done"
+            except Exception as e:
+                logger.error(f"Background job {job.job_id} failed: {e}")
+                output, status = f"Error executing function: {e}", "failed"
+                widget_html = f"<pre class='toolOutput error'>{html.escape(str(e))}</pre>"
+            self.store.finish_job(job.job_id, status, output, widget_html, delivered=False)
+            metrics.increment(f"jobs.{status}")
+            with self._lock:
+                self._jobs.pop(job.job_id, None)
+
+        job.future.add_done_callback(store_result)
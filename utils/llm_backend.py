@@ -0,0 +1,518 @@
+import abc
+import asyncio
+import json
+import logging
+import os
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Dict, List, Optional, Union, cast
+
+from openai import AsyncOpenAI
+from openai.lib.streaming._assistants import AsyncAssistantEventHandler
+from openai.resources.beta.threads.runs.runs import AsyncAssistantStreamManager
+from openai.types.beta.assistant_stream_event import (
+    ThreadMessageCreated, ThreadMessageDelta, ThreadRunCompleted, ThreadRunCreated,
+    ThreadRunRequiresAction, ThreadRunStepCompleted, ThreadRunStepCreated, ThreadRunStepDelta
+)
+from openai.types.beta.threads import TextDeltaBlock
+from openai.types.beta.threads.run_submit_tool_outputs_params import ToolOutput
+from openai.types.beta.threads.runs import (
+    CodeInterpreterLogs, CodeInterpreterOutputImage, CodeInterpreterToolCallDelta, FunctionToolCallDelta,
+    ToolCallDeltaObject
+)
+from openai.types.chat import ChatCompletionMessageParam, ChatCompletionToolParam
+
+from utils.metrics import metrics
+from utils.thread_store import ThreadStore, thread_store
+from utils.threads import thread_pool
+from utils.tool_router import ToolSelection, prompt_tokens
+from utils.schema_compaction import COMPACT_REQUEST_SCHEMAS, COMPACT_SYSTEM_PROMPT
+
+logger = logging.getLogger("uvicorn.error")
+
+# Which backend runs the assistant: "assistants" (OpenAI Assistants API), "chat" (a local
+# tool loop over chat completions) or "stub" (deterministic and offline, for tests and benchmarks)
+LLM_BACKEND: str = os.getenv("LLM_BACKEND", "assistants")
+CHAT_MODEL: str = os.getenv("CHAT_MODEL", "gpt-4o")
+
+# Instruction and tool tokens of a request offered the whole compacted configuration
+COMPACT_PROMPT_TOKENS: int = prompt_tokens(COMPACT_SYSTEM_PROMPT, COMPACT_REQUEST_SCHEMAS)
+# Instruction and tool tokens of each published assistant's own configuration, by assistant ID
+_assistant_prompt_tokens: Dict[str, int] = {}
+
+
+# Backend-neutral run events. A backend's stream ends with either RunCompleted or ToolCallsRequired.
+@dataclass
+class RunStarted:
+    run_id: str
+
+
+@dataclass
+class MessageStarted:
+    step_id: str
+
+
+@dataclass
+class TextDelta:
+    text: str
+
+
+@dataclass
+class ToolStepStarted:
+    step_id: str
+
+
+@dataclass
+class ToolCallDelta:
+    """A fragment of a streaming function call. `call_id` and `name` arrive with the first fragment."""
+    index: int
+    call_id: Optional[str]
+    name: Optional[str]
+    arguments: Optional[str]
+
+
+@dataclass
+class ToolStepOutput:
+    """Code interpreter input or output, shown in the tool step."""
+    text: str
+
+
+@dataclass
+class Usage:
+    """Tokens in the context after a model step."""
+    total_tokens: int
+
+
+@dataclass
+class ToolCall:
+    id: str
+    name: str
+    arguments: str
+
+
+@dataclass
+class ToolCallsRequired:
+    run_id: str
+    calls: List[ToolCall] = field(default_factory=list)
+
+
+@dataclass
+class RunCompleted:
+    pass
+
+
+BackendEvent = Union[
+    RunStarted, MessageStarted, TextDelta, ToolStepStarted, ToolCallDelta,
+    ToolStepOutput, Usage, ToolCallsRequired, RunCompleted
+]
+# Callers close a stream with aclose() when the client goes away mid-run
+BackendEvents = AsyncGenerator[BackendEvent, None]
+
+
+class LLMBackend(abc.ABC):
+    """
+    Runs the assistant on a thread as a stream of backend-neutral events.
+
+    A run streams until it completes or asks for tool calls. The caller then
+    executes the calls and continues the run with submit_tool_outputs, whose
+    stream ends the same way. A ToolSelection, when given, replaces the
+    assistant's tools and instructions for the whole run.
+    """
+    name: str = ""
+
+    @abc.abstractmethod
+    async def create_thread(self) -> str:
+        """Create a conversation thread and return its ID."""
+
+    @abc.abstractmethod
+    async def delete_thread(self, thread_id: str) -> None:
+        """Delete a thread and whatever the backend keeps for it."""
+
+    @abc.abstractmethod
+    async def add_message(self, thread_id: str, content: str) -> None:
+        """Add a user message to a thread."""
+
+    @abc.abstractmethod
+    def run(self, assistant_id: str, thread_id: str, selection: Optional[ToolSelection] = None) -> BackendEvents:
+        """Start a run on a thread and stream its events."""
+
+    @abc.abstractmethod
+    def submit_tool_outputs(
+        self,
+        thread_id: str,
+        run_id: str,
+        tool_outputs: List[Dict[str, str]],
+        selection: Optional[ToolSelection] = None
+    ) -> BackendEvents:
+        """Continue a run that asked for tool calls with their outputs, and stream its events."""
+
+    @abc.abstractmethod
+    async def cancel_run(self, thread_id: str, run_id: str) -> None:
+        """Stop a run that no client is reading."""
+
+
+class AssistantsBackend(LLMBackend):
+    """The OpenAI Assistants API: the thread and the run loop live on OpenAI's servers."""
+    name = "assistants"
+
+    def __init__(self, client: AsyncOpenAI):
+        self.client = client
+        # Instruction and tool tokens of the run on each thread, which every step of the run resends
+        self._run_prompt_tokens: Dict[str, int] = {}
+
+    async def create_thread(self) -> str:
+        return await thread_pool.acquire()
+
+    async def delete_thread(self, thread_id: str) -> None:
+        await self.client.beta.threads.delete(thread_id)
+
+    async def add_message(self, thread_id: str, content: str) -> None:
+        await self.client.beta.threads.messages.create(thread_id=thread_id, role="user", content=content)
+
+    async def run(self, assistant_id: str, thread_id: str, selection: Optional[ToolSelection] = None) -> BackendEvents:
+        metrics.increment("llm.requests")
+        tokens = selection.prompt_tokens if selection else await self._assistant_prompt_tokens(assistant_id)
+        if tokens is not None:
+            self._run_prompt_tokens[thread_id] = tokens
+            metrics.increment("llm.prompt_tokens", tokens)
+        # Run-level overrides apply to every step of the run, including those after tool outputs
+        overrides: Dict[str, Any] = {"instructions": selection.instructions, "tools": selection.tools} if selection else {}
+        async for event in self._events(self.client.beta.threads.runs.stream(
+            assistant_id=assistant_id,
+            thread_id=thread_id,
+            parallel_tool_calls=True,
+            **overrides
+        )):
+            yield event
+
+    def submit_tool_outputs(
+        self,
+        thread_id: str,
+        run_id: str,
+        tool_outputs: List[Dict[str, str]],
+        selection: Optional[ToolSelection] = None
+    ) -> BackendEvents:
+        metrics.increment("llm.requests")
+        if thread_id in self._run_prompt_tokens:
+            metrics.increment("llm.prompt_tokens", self._run_prompt_tokens[thread_id])
+        return self._events(self.client.beta.threads.runs.submit_tool_outputs_stream(
+            thread_id=thread_id,
+            run_id=run_id,
+            tool_outputs=[
+                ToolOutput(output=tool_output["output"], tool_call_id=tool_output["tool_call_id"])
+                for tool_output in tool_outputs
+            ]
+        ))
+
+    async def cancel_run(self, thread_id: str, run_id: str) -> None:
+        await self.client.beta.threads.runs.cancel(run_id=run_id, thread_id=thread_id)
+
+    async def _assistant_prompt_tokens(self, assistant_id: str) -> Optional[int]:
+        """Instruction and tool tokens of the assistant's own configuration, or None if it could not be fetched."""
+        if assistant_id not in _assistant_prompt_tokens:
+            try:
+                assistant = await self.client.beta.assistants.retrieve(assistant_id)
+            except Exception as e:
+                logger.warning(f"Could not fetch assistant {assistant_id} to count its prompt tokens: {e}")
+                return None
+            _assistant_prompt_tokens[assistant_id] = prompt_tokens(
+                assistant.instructions or "", [tool.model_dump(exclude_none=True) for tool in assistant.tools]
+            )
+        return _assistant_prompt_tokens[assistant_id]
+
+    async def _events(self, stream_manager: AsyncAssistantStreamManager) -> BackendEvents:
+        event_handler: AsyncAssistantEventHandler
+        async with stream_manager as event_handler:
+            async for event in event_handler:
+                if isinstance(event, ThreadRunCreated):
+                    yield RunStarted(event.data.id)
+
+                elif isinstance(event, ThreadMessageCreated):
+                    yield MessageStarted(event.data.id)
+
+                elif isinstance(event, ThreadMessageDelta):
+                    for block in event.data.delta.content or []:
+                        if isinstance(block, TextDeltaBlock) and block.text and block.text.value:
+                            yield TextDelta(block.text.value)
+
+                elif isinstance(event, ThreadRunStepCreated) and event.data.type == "tool_calls":
+                    yield ToolStepStarted(event.data.id)
+
+                elif isinstance(event, ThreadRunStepDelta) and isinstance(event.data.delta.step_details, ToolCallDeltaObject):
+                    for delta_call in event.data.delta.step_details.tool_calls or []:
+                        if isinstance(delta_call, FunctionToolCallDelta) and delta_call.function:
+                            yield ToolCallDelta(
+                                delta_call.index,
+                                delta_call.id,
+                                delta_call.function.name,
+                                delta_call.function.arguments
+                            )
+                        elif isinstance(delta_call, CodeInterpreterToolCallDelta) and delta_call.code_interpreter:
+                            if delta_call.code_interpreter.input:
+                                yield ToolStepOutput(delta_call.code_interpreter.input)
+                            for output in delta_call.code_interpreter.outputs or []:
+                                if isinstance(output, CodeInterpreterLogs) and output.logs:
+                                    yield ToolStepOutput(output.logs)
+                                elif isinstance(output, CodeInterpreterOutputImage) and output.image and output.image.file_id:
+                                    yield ToolStepOutput(output.image.file_id)
+
+                elif isinstance(event, ThreadRunStepCompleted) and event.data.usage:
+                    yield Usage(event.data.usage.total_tokens)
+
+                elif isinstance(event, ThreadRunRequiresAction) and event.data.required_action:
+                    yield ToolCallsRequired(event.data.id, [
+                        ToolCall(tool_call.id, tool_call.function.name, tool_call.function.arguments)
+                        for tool_call in event.data.required_action.submit_tool_outputs.tool_calls
+                        if tool_call.type == "function"
+                    ])
+                    return
+
+                elif isinstance(event, ThreadRunCompleted):
+                    yield RunCompleted()
+
+
+def answered_messages(messages: List[Dict]) -> List[Dict]:
+    """
+    Drop tool calls a cancelled run left without outputs, which the API would reject,
+    along with any outputs that were recorded for them.
+    """
+    answered: List[Dict] = []
+    index = 0
+    while index < len(messages):
+        message = messages[index]
+        if message["role"] == "assistant" and message.get("tool_calls"):
+            end = index + 1
+            while end < len(messages) and messages[end]["role"] == "tool":
+                end += 1
+            outputs = {output["tool_call_id"] for output in messages[index + 1:end]}
+            if all(tool_call["id"] in outputs for tool_call in message["tool_calls"]):
+                answered.extend(messages[index:end])
+            index = end
+        else:
+            if message["role"] != "tool":
+                answered.append(message)
+            index += 1
+    return answered
+
+
+class ChatCompletionsBackend(LLMBackend):
+    """
+    A tool loop over streaming chat completions, with the conversation kept in the thread store.
+
+    Each model step is one request carrying the whole conversation, so there is
+    no server-side thread to create and no extra round trip to hand over tool
+    outputs. Instructions, model and tools are the same as the assistant's.
+    """
+    name = "chat"
+
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        store: ThreadStore = thread_store,
+        model: str = CHAT_MODEL,
+        instructions: str = COMPACT_SYSTEM_PROMPT
+    ):
+        self.client = client
+        self.store = store
+        self.model = model
+        self.instructions = instructions
+        self._prompt_tokens = (
+            COMPACT_PROMPT_TOKENS if instructions == COMPACT_SYSTEM_PROMPT
+            else prompt_tokens(instructions, COMPACT_REQUEST_SCHEMAS)
+        )
+
+    async def create_thread(self) -> str:
+        return f"local_{uuid.uuid4().hex}"
+
+    async def delete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.store.delete_conversation, thread_id)
+
+    async def add_message(self, thread_id: str, content: str) -> None:
+        await asyncio.to_thread(self.store.append_messages, thread_id, [{"role": "user", "content": content}])
+
+    def run(self, assistant_id: str, thread_id: str, selection: Optional[ToolSelection] = None) -> BackendEvents:
+        return self._complete(thread_id, f"run_{uuid.uuid4().hex[:12]}", selection)
+
+    async def submit_tool_outputs(
+        self,
+        thread_id: str,
+        run_id: str,
+        tool_outputs: List[Dict[str, str]],
+        selection: Optional[ToolSelection] = None
+    ) -> BackendEvents:
+        await asyncio.to_thread(self.store.append_messages, thread_id, [
+            {"role": "tool", "tool_call_id": tool_output["tool_call_id"], "content": tool_output["output"]}
+            for tool_output in tool_outputs
+        ])
+        async for event in self._complete(thread_id, run_id, selection):
+            yield event
+
+    async def cancel_run(self, thread_id: str, run_id: str) -> None:
+        # Nothing runs upstream between requests; the streaming request closes with the run's task
+        pass
+
+    async def _complete(self, thread_id: str, run_id: str, selection: Optional[ToolSelection]) -> BackendEvents:
+        messages = await asyncio.to_thread(self.store.conversation, thread_id)
+        yield RunStarted(run_id)
+
+        metrics.increment("llm.requests")
+        metrics.increment("llm.prompt_tokens", selection.prompt_tokens if selection else self._prompt_tokens)
+        instructions = selection.instructions if selection else self.instructions
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=cast(List[ChatCompletionMessageParam], [{"role": "system", "content": instructions}] + answered_messages(messages)),
+            tools=cast(List[ChatCompletionToolParam], selection.tools if selection else COMPACT_REQUEST_SCHEMAS),
+            parallel_tool_calls=True,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+        text = ""
+        calls: Dict[int, Dict[str, str]] = {}
+        async with stream:
+            async for chunk in stream:
+                if chunk.usage:
+                    yield Usage(chunk.usage.total_tokens)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    if not text:
+                        yield MessageStarted(f"{chunk.id}_message")
+                    text += delta.content
+                    yield TextDelta(delta.content)
+                for delta_call in delta.tool_calls or []:
+                    if not calls:
+                        yield ToolStepStarted(f"{chunk.id}_tools")
+                    call = calls.setdefault(delta_call.index, {"id": "", "name": "", "arguments": ""})
+                    name = delta_call.function.name if delta_call.function else None
+                    arguments = delta_call.function.arguments if delta_call.function else None
+                    call["id"] += delta_call.id or ""
+                    call["name"] += name or ""
+                    call["arguments"] += arguments or ""
+                    yield ToolCallDelta(delta_call.index, delta_call.id, name, arguments)
+
+        message: Dict = {"role": "assistant", "content": text or None}
+        if calls:
+            message["tool_calls"] = [
+                {"id": call["id"], "type": "function", "function": {"name": call["name"], "arguments": call["arguments"]}}
+                for _, call in sorted(calls.items())
+            ]
+        await asyncio.to_thread(self.store.append_messages, thread_id, [message])
+
+        if calls:
+            yield ToolCallsRequired(run_id, [
+                ToolCall(call["id"], call["name"], call["arguments"]) for _, call in sorted(calls.items())
+            ])
+        else:
+            yield RunCompleted()
+
+
+class StubBackend(LLMBackend):
+    """
+    A deterministic backend for tests and benchmarks that never leaves the process.
+
+    Every user message gets one find_similar_tweets call on the message text
+    (if the run offers it), then a fixed reply giving the size of the tool
+    output. To stand in for a remote model, each model step waits `round_trip`
+    seconds and streamed chunks are `token_delay` apart. Prompt size has no
+    effect on its timing; it counts the instruction and tool tokens each step
+    would send, as the other backends do.
+    """
+    name = "stub"
+
+    def __init__(
+        self,
+        round_trip: float = 0.0,
+        token_delay: float = 0.0,
+        tool: Optional[str] = "find_similar_tweets"
+    ):
+        self.round_trip = round_trip
+        self.token_delay = token_delay
+        self.tool = tool
+        self.conversations: Dict[str, List[Dict]] = {}
+        self._calls = 0
+
+    async def create_thread(self) -> str:
+        return f"stub_{uuid.uuid4().hex[:12]}"
+
+    async def delete_thread(self, thread_id: str) -> None:
+        self.conversations.pop(thread_id, None)
+
+    async def add_message(self, thread_id: str, content: str) -> None:
+        self.conversations.setdefault(thread_id, []).append({"role": "user", "content": content})
+
+    async def _step(self, selection: Optional[ToolSelection]) -> None:
+        metrics.increment("llm.requests")
+        metrics.increment("llm.prompt_tokens", selection.prompt_tokens if selection else COMPACT_PROMPT_TOKENS)
+        await asyncio.sleep(self.round_trip)
+
+    async def _pause(self) -> None:
+        if self.token_delay:
+            await asyncio.sleep(self.token_delay)
+
+    async def run(self, assistant_id: str, thread_id: str, selection: Optional[ToolSelection] = None) -> BackendEvents:
+        run_id = f"run_{uuid.uuid4().hex[:12]}"
+        yield RunStarted(run_id)
+        await self._step(selection)
+        if not self.tool or (selection and self.tool not in selection.names):
+            async for event in self._reply(thread_id, "No tool was called."):
+                yield event
+            return
+
+        conversation = self.conversations.setdefault(thread_id, [])
+        question = next((message["content"] for message in reversed(conversation) if message["role"] == "user"), "")
+        self._calls += 1
+        call = ToolCall(f"call_{self._calls}", self.tool, json.dumps({"text": question.splitlines()[-1] if question else ""}))
+        conversation.append({"role": "assistant", "tool_calls": [call.id]})
+
+        yield ToolStepStarted(f"step_{call.id}")
+        yield ToolCallDelta(0, call.id, call.name, "")
+        for start in range(0, len(call.arguments), 16):
+            await self._pause()
+            yield ToolCallDelta(0, None, None, call.arguments[start:start + 16])
+        yield ToolCallsRequired(run_id, [call])
+
+    async def submit_tool_outputs(
+        self,
+        thread_id: str,
+        run_id: str,
+        tool_outputs: List[Dict[str, str]],
+        selection: Optional[ToolSelection] = None
+    ) -> BackendEvents:
+        conversation = self.conversations.setdefault(thread_id, [])
+        conversation.extend({"role": "tool", "content": tool_output["output"]} for tool_output in tool_outputs)
+        yield RunStarted(run_id)
+        await self._step(selection)
+        size = sum(len(tool_output["output"]) for tool_output in tool_outputs)
+        async for event in self._reply(thread_id, f"The tool returned {size} characters of output."):
+            yield event
+
+    async def _reply(self, thread_id: str, text: str) -> BackendEvents:
+        conversation = self.conversations.setdefault(thread_id, [])
+        yield MessageStarted(f"msg_{len(conversation)}")
+        for word in text.split(" "):
+            await self._pause()
+            yield TextDelta(word + " ")
+        conversation.append({"role": "assistant", "content": text})
+        yield Usage(sum(len(str(message.get("content", ""))) for message in conversation) // 4)
+        yield RunCompleted()
+
+    async def cancel_run(self, thread_id: str, run_id: str) -> None:
+        pass
+
+
+def get_backend(name: str = "") -> LLMBackend:
+    """Create the backend named by `name`, or by LLM_BACKEND."""
+    name = name or LLM_BACKEND
+    if name == "assistants":
+        return AssistantsBackend(AsyncOpenAI())
+    if name == "chat":
+        return ChatCompletionsBackend(AsyncOpenAI())
+    if name == "stub":
+        return _stub_backend
+    raise ValueError(f"Unknown LLM backend {name}; use assistants, chat or stub")
+
+
+# The stub keeps its conversations in memory, so every request shares one
+_stub_backend = StubBackend()
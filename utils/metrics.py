@@ -0,0 +1,35 @@
+import threading
+from typing import Dict, Union
+
+Number = Union[int, float]
+
+
+class Metrics:
+    """
+    Process-wide named counters.
+
+    Counters are plain dotted names (e.g. "query_cost.rule.missing_limit") so
+    that subsystems can record what they did without any shared registry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Number] = {}
+
+    def increment(self, name: str, amount: Number = 1) -> None:
+        """Add `amount` to the counter called `name`, creating it if needed."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def get(self, name: str) -> Number:
+        """Return the current value of a counter (0 if it was never touched)."""
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self) -> Dict[str, Number]:
+        """Return a sorted copy of all counters."""
+        with self._lock:
+            return dict(sorted(self._counters.items()))
+
+
+metrics = Metrics()
@@ -0,0 +1,163 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from utils.serialization import MAX_CELL_CHARS, flatten_row, format_cell, serialize_compact
+from utils.tokens import context_ledger, count_tokens
+from utils.tools import DEFAULT_OUTPUT_BUDGET, OUTPUT_BUDGETS
+
+# A tool output never gets less than this, however full the thread's context is
+MIN_OUTPUT_TOKENS = 200
+
+# Fraction of the thread's remaining context a single tool output may take
+CONTEXT_SHARE = 0.25
+
+# Columns are dropped before rows until at least this many rows fit
+MIN_ROWS = 10
+
+# Tokens set aside for the footer that summarises what was left out
+FOOTER_TOKENS = 80
+
+# Column names that are cheap to lose when space is short
+LOW_PRIORITY_SUFFIXES = ("_url", "archive_upload_id", "updated_at", "created_via")
+
+
+@dataclass
+class PackedOutput:
+    """A tool result serialized to fit a token budget, with an account of what was left out."""
+    text: str
+    tokens: int
+    budget: int
+    rows_included: int
+    columns_omitted: List[str] = field(default_factory=list)
+
+
+def resolve_budget(function_name: str, thread_id: Optional[str] = None) -> int:
+    """Return the token budget for a tool's output, shrunk if the thread is running out of context."""
+    budget = OUTPUT_BUDGETS.get(function_name, DEFAULT_OUTPUT_BUDGET)["max_tokens"]
+    if thread_id:
+        budget = min(budget, int(context_ledger.remaining(thread_id) * CONTEXT_SHARE))
+    return max(budget, MIN_OUTPUT_TOKENS)
+
+
+def rank_columns(columns: List[str], priority: List[str]) -> List[str]:
+    """Order columns from most to least important: configured priority, then the rest, then bulky ones."""
+    def rank(column: str):
+        if column in priority:
+            return (0, priority.index(column))
+        if column.endswith(LOW_PRIORITY_SUFFIXES):
+            return (2, columns.index(column))
+        return (1, columns.index(column))
+    return sorted(columns, key=rank)
+
+
+def pack_tool_output(
+    rows: Any,
+    function_name: str,
+    total_rows: Optional[int] = None,
+    thread_id: Optional[str] = None
+) -> PackedOutput:
+    """
+    Serialize a tool result as a compact table that fits the endpoint's token budget.
+
+    Low-priority columns are dropped until at least MIN_ROWS rows fit, then
+    whole rows are added in order until the budget is used up. A footer states
+    exactly which rows and columns were left out.
+
+    Args:
+        rows: The tool response rows (already cut to the widget limit, if any)
+        function_name: The tool that produced the rows, used to look up its budget
+        total_rows: The number of rows upstream returned, if `rows` was already cut down
+        thread_id: The thread the output is for, used to account for remaining context
+
+    Returns:
+        PackedOutput with the text to send to the model
+    """
+    budget = resolve_budget(function_name, thread_id)
+
+    if not isinstance(rows, list) or not rows or not all(isinstance(row, dict) for row in rows):
+        # Errors and scalar responses: fall back to a character cut of roughly the same size
+        text, _ = serialize_compact(rows, max_chars=budget * 4, total_rows=total_rows)
+        return PackedOutput(text=text, tokens=count_tokens(text), budget=budget, rows_included=0)
+
+    total_rows = len(rows) if total_rows is None else total_rows
+    flattened = [flatten_row(row) for row in rows]
+    columns = list(dict.fromkeys(column for row in flattened for column in row))
+
+    raw_cells = [{column: format_cell(row.get(column), max_chars=None) for column in columns} for row in flattened]
+    cells = [{column: format_cell(row.get(column)) for column in columns} for row in flattened]
+
+    empty_columns = [column for column in columns if not any(row[column] for row in cells)]
+    priority = OUTPUT_BUDGETS.get(function_name, DEFAULT_OUTPUT_BUDGET)["priority"]
+    kept = rank_columns([column for column in columns if column not in empty_columns], priority)
+
+    # Token cost of every cell and header, plus one token for each separator
+    cell_tokens = [{column: count_tokens(row[column]) + 1 for column in kept} for row in cells]
+    header_tokens = {column: count_tokens(column) + 1 for column in kept}
+
+    def rows_cost(columns: List[str], count: int) -> int:
+        return sum(header_tokens[column] for column in columns) + sum(
+            cell_tokens[index][column] for index in range(count) for column in columns
+        )
+
+    # Leave room for the summary footer
+    row_budget = budget - FOOTER_TOKENS
+
+    dropped: List[str] = []
+    target_rows = min(len(cells), MIN_ROWS)
+    while len(kept) > 1 and rows_cost(kept, target_rows) > row_budget:
+        dropped.insert(0, kept.pop())
+
+    # Bulky columns also go if dropping them lets more of the rows fit
+    while (
+        len(kept) > 1
+        and kept[-1] not in priority
+        and kept[-1].endswith(LOW_PRIORITY_SUFFIXES)
+        and rows_cost(kept, len(cells)) > row_budget
+    ):
+        dropped.insert(0, kept.pop())
+
+    # Restore the original column order for display
+    kept = [column for column in columns if column in kept]
+
+    used = sum(header_tokens[column] for column in kept)
+    lines = ["\t".join(kept)]
+    included = 0
+    abbreviated = 0
+    for index, row in enumerate(cells):
+        cost = sum(cell_tokens[index][column] for column in kept)
+        if included and used + cost > row_budget:
+            break
+        lines.append("\t".join(row[column] for column in kept))
+        abbreviated += sum(1 for column in kept if row[column] != raw_cells[index][column])
+        used += cost
+        included += 1
+
+    def render() -> str:
+        summary = [f"{included} of {total_rows} rows shown"]
+        if included < total_rows:
+            summary.append(f"rows {included + 1}-{total_rows} omitted")
+        if dropped:
+            summary.append(f"columns omitted to fit the token budget: {', '.join(dropped)}")
+        if empty_columns:
+            summary.append(f"columns empty in every row: {', '.join(empty_columns)}")
+        if abbreviated:
+            summary.append(f"{abbreviated} long text cells abbreviated to {MAX_CELL_CHARS} characters")
+        footer = [f"[{'; '.join(summary)}]"] if len(summary) > 1 else []
+        return "\n".join(lines[:included + 1] + footer)
+
+    # Per-cell counts are an estimate of the joined text; trim whole rows if it came out over
+    text = render()
+    while included > 1 and count_tokens(text) > budget:
+        included -= 1
+        abbreviated = sum(
+            1 for index in range(included) for column in kept if cells[index][column] != raw_cells[index][column]
+        )
+        text = render()
+
+    return PackedOutput(
+        text=text,
+        tokens=count_tokens(text),
+        budget=budget,
+        rows_included=included,
+        columns_omitted=dropped + empty_columns
+    )
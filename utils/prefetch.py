@@ -0,0 +1,200 @@
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+# How long prefetched account context stays usable, and how many handles one message may prefetch
+PREFETCH_TTL: float = float(os.getenv("PREFETCH_TTL", "120"))
+MAX_PREFETCH_HANDLES = 3
+
+# How long a tool call waits for its thread's prefetch that is still in flight before going upstream itself
+PREFETCH_WAIT = 5.0
+
+HANDLE_PATTERN = re.compile(r"(?<![\w@])@(\w{1,15})\b")
+
+# Params that do not change which single account row a lookup returns
+_NON_FILTER_PARAMS = {"select", "limit", "order"}
+
+
+def extract_handles(text: str) -> List[str]:
+    """Return the distinct @handles mentioned in a user message, in order of appearance."""
+    return list(dict.fromkeys(match.group(1) for match in HANDLE_PATTERN.finditer(text)))[:MAX_PREFETCH_HANDLES]
+
+
+@dataclass
+class AccountContext:
+    """Prefetched account and profile rows for one handle."""
+    username: str
+    thread_id: str
+    future: Future
+    expires_at: float = field(default_factory=lambda: time.time() + PREFETCH_TTL)
+    used: bool = False
+
+
+def project(row: Dict[str, Any], select: Any) -> Optional[Dict[str, Any]]:
+    """Apply a plain-column select to a row, or return None if the select is anything fancier."""
+    if select in (None, "", "*"):
+        return dict(row)
+    columns = [column.strip() for column in str(select).split(",")]
+    if not all(re.fullmatch(r"\w+", column) and column in row for column in columns):
+        return None
+    return {column: row[column] for column in columns}
+
+
+class AccountPrefetcher:
+    """
+    Speculatively fetches account and profile rows for handles named in a user message.
+
+    Most questions name an account, and the model's first tool call is nearly
+    always an account or profile lookup. Starting those lookups while the run
+    is being created lets the tool executor answer them from memory.
+
+    Contexts are kept by (thread, handle), and by (thread, account ID) once
+    fetched. A tool call only waits for a prefetch of its own thread that
+    matches it; anything else is answered from prefetches that have finished.
+    """
+
+    def __init__(self, request: Callable[[str, Dict[str, Any]], Any]):
+        self._request = request
+        self._lock = threading.Lock()
+        self._contexts: Dict[Tuple[str, str], AccountContext] = {}
+        # (thread, account ID) to the (thread, handle) key of the prefetch that found it
+        self._accounts: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+
+    def _fetch(self, thread_id: str, username: str) -> Dict[str, Any]:
+        # ilike without wildcards is a case-insensitive match; "_" is a wildcard, so check exactly afterwards
+        accounts = self._request("get_account_info", {"select": "*", "username": f"ilike.{username}", "limit": 5})
+        account = next(
+            (row for row in accounts if isinstance(row, dict) and str(row.get("username", "")).lower() == username.lower()),
+            None
+        )
+        profile = None
+        if account:
+            # Indexed before the result is set, so a profile lookup can find the prefetch as soon as it finishes
+            with self._lock:
+                self._accounts[(thread_id, str(account.get("account_id")))] = (thread_id, username.lower())
+            profiles = self._request(
+                "get_user_profiles", {"select": "*", "account_id": f"eq.{account['account_id']}", "limit": 1}
+            )
+            profile = profiles[0] if profiles else None
+        return {"account": account, "profile": profile}
+
+    def start(self, thread_id: str, text: str) -> None:
+        """Start prefetching every handle mentioned in `text`."""
+        self.expire()
+        for username in extract_handles(text):
+            key = (thread_id, username.lower())
+            with self._lock:
+                if key in self._contexts:
+                    continue
+                future = self._executor.submit(self._fetch, thread_id, username)
+                self._contexts[key] = AccountContext(username=username, thread_id=thread_id, future=future)
+            metrics.increment("prefetch.started")
+
+    def _result(self, context: Optional[AccountContext], wait: bool) -> Optional[Dict[str, Any]]:
+        if context is None or context.expires_at < time.time() or not (wait or context.future.done()):
+            return None
+        try:
+            result = context.future.result(timeout=PREFETCH_WAIT)
+        except Exception as e:
+            logger.debug(f"Prefetch for {context.username} unusable: {e}")
+            return None
+        context.used = True
+        return result
+
+    def _finished(self, username: str) -> Optional[AccountContext]:
+        """A finished prefetch of `username` by any thread."""
+        with self._lock:
+            contexts = [context for (_, key), context in self._contexts.items() if key == username]
+        return next((context for context in contexts if context.future.done()), None)
+
+    def answer(
+        self,
+        function_name: str,
+        params: Dict[str, Any],
+        thread_id: Optional[str] = None
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Answer a tool call from prefetched rows, or return None if it needs an upstream request.
+
+        Handles `get_account_info` filtered only by `username` (eq, or ilike without
+        wildcards) and `get_user_profiles` filtered only by `account_id=eq.`.
+
+        Args:
+            function_name: The tool called
+            params: Its arguments
+            thread_id: The thread making the call, whose in-flight prefetch of the account is waited for
+        """
+        filters = {key: value for key, value in params.items() if key not in _NON_FILTER_PARAMS}
+        if str(params.get("offset", 0)) not in ("0", "None"):
+            return None
+        filters.pop("offset", None)
+
+        row = None
+        if function_name == "get_account_info" and list(filters) == ["username"]:
+            operator, _, value = str(filters["username"]).partition(".")
+            if operator == "eq" or (operator == "ilike" and not re.search(r"[*%_]", value)):
+                with self._lock:
+                    own = self._contexts.get((thread_id, value.lower())) if thread_id else None
+                if own is not None:
+                    context = self._result(own, wait=True)
+                else:
+                    context = self._result(self._finished(value.lower()), wait=False)
+                account = context and context["account"]
+                if account and (operator == "ilike" or account.get("username") == value):
+                    row = account
+        elif function_name == "get_user_profiles" and list(filters) == ["account_id"]:
+            operator, _, value = str(filters["account_id"]).partition(".")
+            if operator == "eq":
+                with self._lock:
+                    own_key = self._accounts.get((thread_id, value)) if thread_id else None
+                    own = self._contexts.get(own_key) if own_key else None
+                    others = [
+                        self._contexts.get(key) for (other, account_id), key in self._accounts.items()
+                        if account_id == value and other != thread_id
+                    ]
+                if own is not None:
+                    context = self._result(own, wait=True)
+                else:
+                    finished = next((other for other in others if other and other.future.done()), None)
+                    context = self._result(finished, wait=False)
+                if context:
+                    row = context["profile"]
+
+        projected = project(row, params.get("select")) if row else None
+        if projected is None:
+            if function_name in ("get_account_info", "get_user_profiles"):
+                metrics.increment("prefetch.miss")
+            return None
+        metrics.increment("prefetch.hit")
+        return [projected]
+
+    def cancel(self, thread_id: str) -> None:
+        """Cancel prefetches for a thread that have not started yet, e.g. when its run ends."""
+        with self._lock:
+            for key, context in list(self._contexts.items()):
+                if context.thread_id == thread_id and context.future.cancel():
+                    del self._contexts[key]
+                    metrics.increment("prefetch.cancelled")
+
+    def expire(self) -> None:
+        """Drop prefetched context older than PREFETCH_TTL."""
+        now = time.time()
+        with self._lock:
+            for key, context in list(self._contexts.items()):
+                if context.expires_at < now:
+                    context.future.cancel()
+                    del self._contexts[key]
+                    metrics.increment("prefetch.expired_used" if context.used else "prefetch.expired_unused")
+            for account, key in list(self._accounts.items()):
+                if key not in self._contexts:
+                    del self._accounts[account]
@@ -0,0 +1,275 @@
+import re
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from utils.metrics import metrics
+from utils.tools import TABLE_COLUMNS
+
+# Hard ceilings the system prompt asks the model to respect
+MAX_LIMIT = 50
+MAX_OFFSET = 500
+MAX_EMBED_DEPTH = 2
+
+# Columns whose unanchored pattern matches force a sequential scan upstream
+TEXT_SEARCH_COLUMNS = {"full_text"}
+
+# Bulky columns that are rarely useful inside an embedded resource
+BULKY_COLUMNS = {"fts", "avatar_media_url", "header_media_url", "archive_upload_id", "updated_at", "data"}
+
+# Filters selective enough that a slow text pattern on top of them is acceptable
+SELECTIVE_FILTERS = {
+    "tweet_id", "account_id", "conversation_id", "reply_to_tweet_id",
+    "reply_to_user_id", "archive_upload_id", "id"
+}
+
+# Rules about page size and position, which do not apply to internal bulk fetches
+PAGING_RULES = ("missing_limit", "limit_clamp", "large_offset")
+
+SelectNode = Union[str, "EmbeddedResource"]
+
+
+class QueryRejected(ValueError):
+    """Raised when a query is too expensive to send upstream. The message is guidance for the model."""
+
+
+@dataclass
+class EmbeddedResource:
+    """An embedded resource in a PostgREST select, e.g. `account(username,profile(bio))`."""
+    name: str
+    children: List[SelectNode]
+
+    @property
+    def table(self) -> str:
+        # Strip aliases ("author:account"), spreads ("...account") and hints ("account!fk")
+        name = self.name.split(":")[-1].lstrip(".")
+        return name.split("!")[0]
+
+
+def parse_select(select: str) -> List[SelectNode]:
+    """Parse a PostgREST select string into a tree of column names and embedded resources."""
+    position = 0
+
+    def parse_list() -> List[SelectNode]:
+        nonlocal position
+        nodes: List[SelectNode] = []
+        token = ""
+        while position < len(select):
+            char = select[position]
+            position += 1
+            if char == "(":
+                nodes.append(EmbeddedResource(token.strip(), parse_list()))
+                token = ""
+            elif char == ")":
+                break
+            elif char == ",":
+                if token.strip():
+                    nodes.append(token.strip())
+                token = ""
+            else:
+                token += char
+        if token.strip():
+            nodes.append(token.strip())
+        return nodes
+
+    return parse_list()
+
+
+def format_select(nodes: List[SelectNode]) -> str:
+    """Inverse of `parse_select`."""
+    parts = []
+    for node in nodes:
+        if isinstance(node, EmbeddedResource):
+            parts.append(f"{node.name}({format_select(node.children)})")
+        else:
+            parts.append(node)
+    return ",".join(parts)
+
+
+def embedding_depth(nodes: List[SelectNode]) -> int:
+    """Return how many levels of embedded resources a select tree contains."""
+    depths = [1 + embedding_depth(node.children) for node in nodes if isinstance(node, EmbeddedResource)]
+    return max(depths, default=0)
+
+
+def endpoint_table(endpoint: Dict[str, Any]) -> str:
+    """Return the table or view name an endpoint schema points at."""
+    return str(endpoint.get("url", "")).rstrip("/").split("/")[-1]
+
+
+@dataclass
+class CostRule:
+    """
+    A single rule of the cost model.
+
+    `apply` inspects (and may rewrite in place) the request params. It returns a
+    short note describing a rewrite, None if the rule did not fire, or raises
+    QueryRejected if the query should not be sent at all.
+    """
+    name: str
+    action: str
+    description: str
+    apply: Callable[[Dict[str, Any], Dict[str, Any]], Optional[str]]
+
+
+def _parse_int(value: Any, name: str) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise QueryRejected(f"`{name}` must be an integer, got {value!r}.")
+
+
+def _missing_limit(endpoint: Dict[str, Any], params: Dict[str, Any]) -> Optional[str]:
+    if params.get("limit") in (None, ""):
+        params["limit"] = MAX_LIMIT
+        return f"No limit was given, so limit={MAX_LIMIT} was applied."
+    return None
+
+
+def _limit_clamp(endpoint: Dict[str, Any], params: Dict[str, Any]) -> Optional[str]:
+    limit = _parse_int(params["limit"], "limit")
+    if limit > MAX_LIMIT:
+        params["limit"] = MAX_LIMIT
+        return f"limit={limit} exceeds the maximum and was clamped to {MAX_LIMIT}."
+    return None
+
+
+def _large_offset(endpoint: Dict[str, Any], params: Dict[str, Any]) -> Optional[str]:
+    if params.get("offset") in (None, ""):
+        return None
+    offset = _parse_int(params["offset"], "offset")
+    if offset > MAX_OFFSET:
+        raise QueryRejected(
+            f"offset={offset} is too large (maximum {MAX_OFFSET}); deep offsets time out. "
+            "Paginate by filtering on the ordered column instead, e.g. order=created_at.desc "
+            "with created_at=lt.<last created_at you saw>."
+        )
+    return None
+
+
+def _unanchored_text_pattern(endpoint: Dict[str, Any], params: Dict[str, Any]) -> Optional[str]:
+    # Full-text search matches stemmed whole words, not substrings (handles, URLs, word fragments),
+    # so rewriting the pattern would change the answer. The model is asked to choose instead.
+    if SELECTIVE_FILTERS & set(params):
+        return None
+    for column in TEXT_SEARCH_COLUMNS:
+        value = params.get(column)
+        if isinstance(value, str) and re.fullmatch(r"(i?like)\.\*(.*)\*", value):
+            raise QueryRejected(
+                f"{column}={value} is an unanchored pattern match over every row and will time out. "
+                f"If you are looking for whole words, use full-text search ({column}=fts.word or "
+                f"{column}=phfts.some phrase); otherwise add a selective filter such as account_id=eq.<id>."
+            )
+    return None
+
+
+def _select_star_deep_embedding(endpoint: Dict[str, Any], params: Dict[str, Any]) -> Optional[str]:
+    select = params.get("select")
+    if not isinstance(select, str) or "(" not in select:
+        return None
+
+    nodes = parse_select(select)
+    depth = embedding_depth(nodes)
+    if depth > MAX_EMBED_DEPTH:
+        raise QueryRejected(
+            f"select={select} embeds resources {depth} levels deep (maximum {MAX_EMBED_DEPTH}). "
+            "Split the query into separate calls and join the results yourself."
+        )
+
+    def project(nodes: List[SelectNode], table: str) -> List[SelectNode]:
+        projected: List[SelectNode] = []
+        for node in nodes:
+            if isinstance(node, EmbeddedResource):
+                projected.append(EmbeddedResource(node.name, project(node.children, node.table)))
+            elif node == "*" and table in TABLE_COLUMNS:
+                projected.extend(column for column in TABLE_COLUMNS[table] if column not in BULKY_COLUMNS)
+            else:
+                projected.append(node)
+        return projected
+
+    rewritten = format_select(project(nodes, endpoint_table(endpoint)))
+    if rewritten != select:
+        params["select"] = rewritten
+        return f"`*` in a select with embedded resources was projected to explicit columns: select={rewritten}"
+    return None
+
+
+RULES: List[CostRule] = [
+    CostRule(
+        "missing_limit", "rewrite",
+        f"Requests without a limit get limit={MAX_LIMIT}.",
+        _missing_limit
+    ),
+    CostRule(
+        "limit_clamp", "rewrite",
+        f"Limits above {MAX_LIMIT} are clamped to {MAX_LIMIT}.",
+        _limit_clamp
+    ),
+    CostRule(
+        "large_offset", "reject",
+        f"Offsets above {MAX_OFFSET} are rejected in favour of keyset pagination.",
+        _large_offset
+    ),
+    CostRule(
+        "unanchored_text_pattern", "reject",
+        "Unanchored like/ilike patterns on full_text are rejected unless a selective filter is present, "
+        "with a hint to use full-text search for whole words.",
+        _unanchored_text_pattern
+    ),
+    CostRule(
+        "select_star_deep_embedding", "rewrite/reject",
+        f"Embeddings deeper than {MAX_EMBED_DEPTH} levels are rejected; `*` next to or inside "
+        "embedded resources is projected to explicit, non-bulky columns.",
+        _select_star_deep_embedding
+    ),
+]
+
+
+def apply_cost_rules(
+    endpoint: Dict[str, Any],
+    params: Dict[str, Any],
+    exclude: Tuple[str, ...] = ()
+) -> List[str]:
+    """
+    Run every cost rule over the request params, rewriting them in place.
+
+    Args:
+        endpoint: The endpoint schema the request is for
+        params: The request params from the model (mutated)
+        exclude: Names of rules to skip, e.g. the paging rules for internal bulk fetches
+
+    Returns:
+        Notes describing the rewrites that were applied, to be passed on to the model
+
+    Raises:
+        QueryRejected: If a rule decides the query should not be sent upstream
+    """
+    notes = []
+    for rule in RULES:
+        if rule.name in exclude:
+            continue
+        try:
+            note = rule.apply(endpoint, params)
+        except QueryRejected:
+            metrics.increment(f"query_cost.rule.{rule.name}")
+            metrics.increment("query_cost.rejected")
+            raise
+        if note:
+            metrics.increment(f"query_cost.rule.{rule.name}")
+            notes.append(note)
+
+    if notes:
+        metrics.increment("query_cost.rewritten")
+    return notes
+
+
+def describe_rules() -> List[Dict[str, Any]]:
+    """Return the cost rules together with how often each one has fired."""
+    return [
+        {
+            "name": rule.name,
+            "action": rule.action,
+            "description": rule.description,
+            "hits": metrics.get(f"query_cost.rule.{rule.name}")
+        }
+        for rule in RULES
+    ]
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+# Where evicted results are spilled to, and how much is kept in memory and on disk
+RESULT_STORE_DIR: str = os.getenv("RESULT_STORE_DIR", os.path.join(".cache", "results"))
+MAX_MEMORY_ROWS: int = int(os.getenv("RESULT_STORE_MAX_MEMORY_ROWS", "50000"))
+MAX_DISK_RESULTS: int = int(os.getenv("RESULT_STORE_MAX_DISK_RESULTS", "500"))
+
+
+@dataclass
+class StoredResult:
+    """The full rows of one tool call, plus the call that produced them and the thread it belongs to."""
+    tool_call_id: str
+    function_name: str
+    params: Dict[str, Any]
+    rows: List[Any]
+    thread_id: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+
+
+def sort_key(value: Any) -> Tuple[bool, Any]:
+    """Sort key that keeps numbers and strings apart so mixed columns still sort."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (False, value)
+    return (True, str(value))
+
+
+class ResultStore:
+    """
+    Holds complete tool results keyed by tool_call_id.
+
+    Recently used results live in memory, bounded by total row count. Results
+    evicted from memory are spilled to JSON files on disk, of which only the
+    newest MAX_DISK_RESULTS are kept. The lock only guards the in-memory
+    index; files are written and read outside it, so one large spill does not
+    hold up every other lookup. Async callers reach the store through
+    asyncio.to_thread.
+    """
+
+    def __init__(
+        self,
+        directory: str = RESULT_STORE_DIR,
+        max_memory_rows: int = MAX_MEMORY_ROWS,
+        max_disk_results: int = MAX_DISK_RESULTS
+    ):
+        self.directory = directory
+        self.max_memory_rows = max_memory_rows
+        self.max_disk_results = max_disk_results
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, StoredResult]" = OrderedDict()
+        self._memory_rows = 0
+        # Evicted results still being written out, so lookups meanwhile find them
+        self._spilling: Dict[str, StoredResult] = {}
+
+    def _path(self, tool_call_id: str) -> str:
+        # Tool call IDs are alphanumeric with underscores, but never trust a path component
+        safe_id = "".join(char for char in tool_call_id if char.isalnum() or char in "_-")
+        return os.path.join(self.directory, f"{safe_id}.json")
+
+    def put(
+        self,
+        tool_call_id: str,
+        function_name: str,
+        params: Dict[str, Any],
+        rows: List[Any],
+        thread_id: Optional[str] = None
+    ) -> None:
+        """Store the full result of a tool call made on a thread."""
+        result = StoredResult(tool_call_id, function_name, dict(params), list(rows), thread_id)
+        with self._lock:
+            evicted = self._insert(result)
+        for spilled in evicted:
+            self._spill(spilled)
+
+    def _insert(self, result: StoredResult) -> List[StoredResult]:
+        """Add a result to memory under the lock, returning the results evicted to make room, to be spilled."""
+        previous = self._memory.pop(result.tool_call_id, None)
+        if previous:
+            self._memory_rows -= len(previous.rows)
+        self._memory[result.tool_call_id] = result
+        self._memory_rows += len(result.rows)
+
+        evicted = []
+        while self._memory_rows > self.max_memory_rows and len(self._memory) > 1:
+            _, oldest = self._memory.popitem(last=False)
+            self._memory_rows -= len(oldest.rows)
+            self._spilling[oldest.tool_call_id] = oldest
+            evicted.append(oldest)
+        return evicted
+
+    def _spill(self, result: StoredResult) -> None:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(result.tool_call_id), "w") as file:
+                json.dump(asdict(result), file)
+            metrics.increment("result_store.spilled")
+            self._prune_disk()
+        except OSError as e:
+            logger.error(f"Failed to spill result {result.tool_call_id} to disk: {e}")
+        finally:
+            with self._lock:
+                if self._spilling.get(result.tool_call_id) is result:
+                    del self._spilling[result.tool_call_id]
+
+    def _prune_disk(self) -> None:
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".json")]
+        if len(paths) <= self.max_disk_results:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_disk_results]:
+            os.remove(path)
+
+    def get(self, tool_call_id: str, thread_id: Optional[str] = None) -> Optional[StoredResult]:
+        """
+        Return a stored result, loading it back into memory from disk if it was spilled.
+
+        Args:
+            tool_call_id: The tool call whose result to return
+            thread_id: If given, the thread the result must belong to; None is returned otherwise
+        """
+        result = self._load(tool_call_id)
+        if result is None or (thread_id is not None and result.thread_id != thread_id):
+            return None
+        return result
+
+    def _load(self, tool_call_id: str) -> Optional[StoredResult]:
+        with self._lock:
+            result = self._memory.get(tool_call_id)
+            if result:
+                self._memory.move_to_end(tool_call_id)
+                return result
+            if tool_call_id in self._spilling:
+                return self._spilling[tool_call_id]
+
+        path = self._path(tool_call_id)
+        try:
+            with open(path) as file:
+                result = StoredResult(**json.load(file))
+            os.remove(path)
+        except FileNotFoundError:
+            # Not spilled, pruned, or loaded back by a concurrent lookup
+            with self._lock:
+                return self._memory.get(tool_call_id)
+        with self._lock:
+            evicted = self._insert(result)
+        for spilled in evicted:
+            self._spill(spilled)
+        metrics.increment("result_store.loaded_from_disk")
+        return result
+
+    def page(
+        self,
+        tool_call_id: str,
+        page: int = 0,
+        page_size: int = 10,
+        sort: Optional[str] = None,
+        descending: bool = False,
+        thread_id: Optional[str] = None
+    ) -> Optional[Tuple[List[Any], int]]:
+        """
+        Return one page of a stored result, optionally sorted by a column.
+
+        Returns:
+            The rows on the page and the total number of rows, or None if the result is gone
+            or belongs to another thread
+        """
+        result = self.get(tool_call_id, thread_id)
+        if result is None:
+            return None
+
+        rows = result.rows
+        if sort:
+            def value(row: Any) -> Any:
+                return row.get(sort) if isinstance(row, dict) else None
+            # Missing values go last in either direction
+            present = sorted((row for row in rows if value(row) is not None), key=lambda row: sort_key(value(row)), reverse=descending)
+            rows = present + [row for row in rows if value(row) is None]
+        start = max(page, 0) * page_size
+        return rows[start:start + page_size], len(rows)
+
+
+result_store = ResultStore()
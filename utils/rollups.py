@@ -0,0 +1,274 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from utils.aggregate import Column, get_path, group_counts, group_sums, numeric_column, time_bucket
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+ROLLUP_DIR: str = os.getenv("ROLLUP_DIR", os.path.join(".cache", "rollups"))
+# Rollups older than this are brought up to date before they are served
+ROLLUP_REFRESH_SECONDS: float = float(os.getenv("ROLLUP_REFRESH_SECONDS", "3600"))
+ROLLUP_MAX_ROWS: int = int(os.getenv("ROLLUP_MAX_ROWS", "200000"))
+
+TOP_TWEETS = 10
+TOP_TEXT_CHARS = 200
+DEFAULT_MONTHS = 24
+DEFAULT_TOP = 5
+SECTIONS = ("monthly", "top_tweets", "reply_targets", "mentions", "media")
+
+FetchPages = Callable[[str, Dict[str, Any], int], Iterator[List[Dict[str, Any]]]]
+FetchRows = Callable[[str, Dict[str, Any]], Any]
+
+
+@dataclass
+class AccountRollup:
+    """
+    Precomputed activity summary for one account.
+
+    `monthly` maps YYYY-MM to [tweets, likes received, retweets received].
+    Counters are stored whole so incremental refreshes can add to them.
+    """
+    account_id: str
+    username: str
+    tweet_count: int = 0
+    monthly: Dict[str, List[int]] = field(default_factory=dict)
+    top_liked: List[Dict[str, Any]] = field(default_factory=list)
+    top_retweeted: List[Dict[str, Any]] = field(default_factory=list)
+    reply_targets: Dict[str, int] = field(default_factory=dict)
+    mentions: Dict[str, int] = field(default_factory=dict)
+    media: Dict[str, int] = field(default_factory=dict)
+    watermark: Optional[str] = None
+    built_at: float = 0.0
+
+
+def add_counts(target: Dict[str, int], labels: List[Any], counts: np.ndarray) -> None:
+    for label, count in zip(labels, counts.tolist()):
+        if label:
+            target[str(label)] = target.get(str(label), 0) + count
+
+
+class RollupBuilder:
+    """
+    Builds and incrementally refreshes per-account rollups from bulk fetches.
+
+    A refresh only reads tweets (and their mentions and media) created after
+    the rollup's watermark, and folds them into the stored counts with the
+    aggregate engine's dictionary-encoded grouping. Rollups are stored as one
+    gzipped JSON file per account.
+    """
+
+    def __init__(self, fetch_pages: FetchPages, fetch_rows: FetchRows, directory: str = ROLLUP_DIR):
+        self._fetch_pages = fetch_pages
+        self._fetch_rows = fetch_rows
+        self.directory = directory
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def _path(self, account_id: str) -> str:
+        return os.path.join(self.directory, f"{''.join(char for char in account_id if char.isalnum())}.json.gz")
+
+    def load(self, account_id: str) -> Optional[AccountRollup]:
+        try:
+            with gzip.open(self._path(account_id), "rt") as f:
+                return AccountRollup(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def save(self, rollup: AccountRollup) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(rollup.account_id)
+        with gzip.open(f"{path}.tmp", "wt") as f:
+            json.dump(asdict(rollup), f, separators=(",", ":"))
+        os.replace(f"{path}.tmp", path)
+
+    def _rows(self, function_name: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return [row for page in self._fetch_pages(function_name, params, ROLLUP_MAX_ROWS) for row in page]
+
+    def _top(self, account_id: str, column: str) -> List[Dict[str, Any]]:
+        rows = self._fetch_rows("get_tweets", {
+            "select": "tweet_id,created_at,full_text,favorite_count,retweet_count",
+            "account_id": f"eq.{account_id}",
+            "order": f"{column}.desc.nullslast",
+            "limit": TOP_TWEETS,
+        })
+        if not isinstance(rows, list):
+            raise ValueError(f"Could not fetch top tweets: {rows}")
+        for row in rows:
+            row["full_text"] = str(row.get("full_text") or "")[:TOP_TEXT_CHARS]
+        return rows
+
+    def refresh(self, account_id: str, username: str) -> AccountRollup:
+        """Build the rollup for an account, or fold in what was archived since the last refresh."""
+        with self._locks_lock:
+            lock = self._locks.setdefault(account_id, threading.Lock())
+        with lock:
+            rollup = self.load(account_id) or AccountRollup(account_id=account_id, username=username)
+            rollup.username = username or rollup.username
+            since = {"created_at": f"gt.{rollup.watermark}"} if rollup.watermark else {}
+            embedded_since = {"tweets.created_at": f"gt.{rollup.watermark}"} if rollup.watermark else {}
+
+            tweets = self._rows("get_tweets", {
+                "select": "tweet_id,created_at,favorite_count,retweet_count,reply_to_username",
+                "account_id": f"eq.{account_id}",
+                **since,
+            })
+            months = Column([time_bucket(row.get("created_at"), "month") for row in tweets])
+            tweet_counts = group_counts(months)
+            likes = group_sums(months, numeric_column([row.get("favorite_count") for row in tweets]))
+            retweets = group_sums(months, numeric_column([row.get("retweet_count") for row in tweets]))
+            for code, month in enumerate(months.labels):
+                if month:
+                    current = rollup.monthly.setdefault(month, [0, 0, 0])
+                    current[0] += int(tweet_counts[code])
+                    current[1] += int(likes[code])
+                    current[2] += int(retweets[code])
+            targets = Column([row.get("reply_to_username") for row in tweets])
+            add_counts(rollup.reply_targets, targets.labels, group_counts(targets))
+
+            mentions = self._rows("get_user_mentions", {
+                "select": "id,mentioned_users(screen_name),tweets!inner(account_id,created_at)",
+                "tweets.account_id": f"eq.{account_id}",
+                **embedded_since,
+            })
+            names = Column([get_path(row, "mentioned_users.screen_name") for row in mentions])
+            add_counts(rollup.mentions, names.labels, group_counts(names))
+
+            media = self._rows("get_tweet_media", {
+                "select": "media_id,media_type,tweets!inner(account_id,created_at)",
+                "tweets.account_id": f"eq.{account_id}",
+                **embedded_since,
+            })
+            types = Column([row.get("media_type") for row in media])
+            add_counts(rollup.media, types.labels, group_counts(types))
+
+            # Engagement on older tweets changes with new uploads, so the top lists are re-read whole
+            if tweets or not rollup.top_liked:
+                rollup.top_liked = self._top(account_id, "favorite_count")
+                rollup.top_retweeted = self._top(account_id, "retweet_count")
+
+            rollup.tweet_count += len(tweets)
+            rollup.watermark = max(
+                [rollup.watermark or ""] + [str(row["created_at"]) for row in tweets if row.get("created_at")]
+            ) or None
+            rollup.built_at = time.time()
+            self.save(rollup)
+            metrics.increment("rollups.refreshed")
+            metrics.increment("rollups.rows_fetched", len(tweets) + len(mentions) + len(media))
+            return rollup
+
+    def get(self, account_id: str, username: str) -> AccountRollup:
+        """Return an account's rollup, refreshing it first if it is missing or stale."""
+        rollup = self.load(account_id)
+        if rollup and time.time() - rollup.built_at < ROLLUP_REFRESH_SECONDS:
+            metrics.increment("rollups.hit")
+            return rollup
+        return self.refresh(account_id, username)
+
+
+def top_counts(counts: Dict[str, int], n: int) -> str:
+    return ", ".join(f"{label} {count}" for label, count in Counter(counts).most_common(n)) or "none"
+
+
+def format_rollup(rollup: AccountRollup, sections: List[str], months: int, top: int) -> str:
+    """Serialize a rollup as a few compact text sections."""
+    lines = [f"@{rollup.username} (account_id {rollup.account_id}): {rollup.tweet_count} archived tweets"]
+    if "monthly" in sections and rollup.monthly:
+        lines.append(f"Monthly (last {months} months with tweets): month tweets likes_received retweets_received")
+        for month in sorted(rollup.monthly)[-months:]:
+            count, likes, retweets = rollup.monthly[month]
+            lines.append(f"{month} {count} {likes} {retweets}")
+    if "top_tweets" in sections:
+        for title, tweets in (("Most liked", rollup.top_liked), ("Most retweeted", rollup.top_retweeted)):
+            lines.append(f"{title}:")
+            for tweet in tweets[:top]:
+                text = " ".join(str(tweet.get("full_text") or "").split())
+                lines.append(
+                    f"{tweet.get('tweet_id')} {str(tweet.get('created_at') or '')[:10]} "
+                    f"{tweet.get('favorite_count')}L {tweet.get('retweet_count')}RT: {text}"
+                )
+    if "reply_targets" in sections:
+        lines.append(f"Most replied to: {top_counts(rollup.reply_targets, top)}")
+    if "mentions" in sections:
+        lines.append(f"Most mentioned: {top_counts(rollup.mentions, top)}")
+    if "media" in sections:
+        lines.append(f"Media posted: {top_counts(rollup.media, top)}")
+    return "\n".join(lines)
+
+
+def run_rollup_tool(
+    args: Dict[str, Any],
+    builder: RollupBuilder,
+    resolve_account: Callable[[str], Optional[Tuple[str, str]]]
+) -> Tuple[List[Dict[str, Any]], List[str], str]:
+    """
+    Handle a `get_account_summary` tool call.
+
+    Args:
+        args: The tool call arguments
+        builder: Serves and refreshes rollups
+        resolve_account: Maps a username or account_id to (account_id, username)
+
+    Returns:
+        The monthly rows (for the widget), notes, and the summary text for the model
+    """
+    account = str(args.get("account") or "").lstrip("@").strip()
+    if not account:
+        raise ValueError("get_account_summary requires `account`, a username or account_id")
+    resolved = resolve_account(account)
+    if resolved is None:
+        raise ValueError(f"{account} is not an archived account")
+    account_id, username = resolved
+
+    sections = [section for section in (args.get("sections") or SECTIONS) if section in SECTIONS]
+    months = max(1, min(int(args.get("months") or DEFAULT_MONTHS), 240))
+    top = max(1, min(int(args.get("top") or DEFAULT_TOP), TOP_TWEETS))
+
+    rollup = builder.get(account_id, username)
+    rows = [
+        {"month": month, "tweets": counts[0], "likes_received": counts[1], "retweets_received": counts[2]}
+        for month, counts in sorted(rollup.monthly.items())
+    ]
+    updated = time.strftime("%Y-%m-%d %H:%M UTC", time.gmtime(rollup.built_at))
+    return rows, [f"Precomputed summary, updated {updated}."], format_rollup(rollup, sections, months, top)
+
+
+if __name__ == "__main__":
+    # Precompute rollups ahead of time: python -m utils.rollups [username ...]
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    from utils.tool_executor import fetch_endpoint_pages, request_endpoint, resolve_account
+
+    parser = argparse.ArgumentParser(description="Build or refresh per-account rollups.")
+    parser.add_argument("accounts", nargs="*", help="Usernames or account IDs (default: every archived account)")
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    builder = RollupBuilder(fetch_endpoint_pages, request_endpoint)
+    if options.accounts:
+        targets = [resolve_account(account) for account in options.accounts]
+    else:
+        targets = [
+            (str(row["account_id"]), row["username"])
+            for page in fetch_endpoint_pages("get_account_info", {"select": "account_id,username"}, ROLLUP_MAX_ROWS)
+            for row in page
+        ]
+    for target in targets:
+        if target is None:
+            continue
+        try:
+            rollup = builder.refresh(*target)
+            logger.info(f"@{rollup.username}: {rollup.tweet_count} tweets")
+        except Exception as e:
+            logger.error(f"Rollup for {target[1]} failed: {e}")
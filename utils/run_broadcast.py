@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from typing import AsyncGenerator, AsyncIterator, Deque, Dict, Optional, Tuple
+
+from utils.metrics import metrics
+from utils.sse import with_event_id
+
+logger = logging.getLogger("uvicorn.error")
+
+# Frames kept per run for replay, and how long a finished run stays replayable
+RUN_BUFFER_FRAMES: int = int(os.getenv("RUN_BUFFER_FRAMES", "5000"))
+RUN_REPLAY_TTL: float = float(os.getenv("RUN_REPLAY_TTL", "120"))
+# How long a run keeps going with no client attached before it is cancelled. Longer than EventSource's reconnect delay.
+RUN_DISCONNECT_GRACE: float = float(os.getenv("RUN_DISCONNECT_GRACE", "15"))
+
+
+@dataclass
+class Frame:
+    seq: int
+    text: str
+
+
+class RunBroadcast:
+    """
+    The SSE frames of one assistant run, produced once and read by any number of connections.
+
+    The run is driven by its own task, so it keeps going while the browser
+    reconnects. Frames get IDs of the form `<run key>:<sequence>`, and the
+    last RUN_BUFFER_FRAMES of them are kept so a reconnecting client can be
+    sent exactly the frames it missed. Once the last connection has been gone
+    for RUN_DISCONNECT_GRACE seconds, the run's task is cancelled and its
+    frames are dropped.
+    """
+
+    def __init__(
+        self,
+        thread_id: str,
+        slot: Optional[int] = None,
+        max_frames: int = RUN_BUFFER_FRAMES,
+        grace: float = RUN_DISCONNECT_GRACE
+    ):
+        self.key = uuid.uuid4().hex[:12]
+        self.thread_id = thread_id
+        self.slot = slot
+        self.frames: Deque[Frame] = deque(maxlen=max_frames)
+        self.last_seq = 0
+        self.done = False
+        self.cancelled = False
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+        self.grace = grace
+        self._abandon_timer: Optional[asyncio.TimerHandle] = None
+        self._changed = asyncio.Condition()
+
+    async def _publish(self, frame: str) -> None:
+        async with self._changed:
+            self.last_seq += 1
+            self.frames.append(Frame(self.last_seq, with_event_id(frame, f"{self.key}:{self.last_seq}")))
+            self._changed.notify_all()
+
+    async def run(self, source: AsyncIterator[str]) -> None:
+        try:
+            async for frame in source:
+                await self._publish(frame)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            self.frames.clear()
+            raise
+        except Exception as e:
+            logger.error(f"Run stream for thread {self.thread_id} failed: {e}")
+        finally:
+            async with self._changed:
+                self.done = True
+                self.finished_at = time.time()
+                self._changed.notify_all()
+
+    def _abandon(self) -> None:
+        self._abandon_timer = None
+        if self.subscribers == 0 and not self.done and self.task:
+            logger.info(f"No client is reading run {self.key} of thread {self.thread_id}; cancelling it")
+            self.task.cancel()
+
+    async def subscribe(self, after: int = 0) -> AsyncGenerator[str, None]:
+        """Yield every frame after sequence number `after`, then follow the run until it ends."""
+        seq = after
+        self.subscribers += 1
+        if self._abandon_timer:
+            self._abandon_timer.cancel()
+            self._abandon_timer = None
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: self.last_seq > seq or self.done)
+                    frames = [frame for frame in self.frames if frame.seq > seq]
+                    done = self.done
+                if frames and frames[0].seq > seq + 1:
+                    logger.warning(f"Frames {seq + 1}-{frames[0].seq - 1} of run {self.key} are no longer buffered")
+                    metrics.increment("sse.replay_gaps")
+                for frame in frames:
+                    seq = frame.seq
+                    yield frame.text
+                if done:
+                    return
+        finally:
+            # The client disconnected (or the run ended); give it time to reconnect before cancelling
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self._abandon_timer = asyncio.get_running_loop().call_later(self.grace, self._abandon)
+
+
+class RunBroadcaster:
+    """Registry of live and recently finished run broadcasts, by run key and by thread run slot."""
+
+    def __init__(self, ttl: float = RUN_REPLAY_TTL):
+        self.ttl = ttl
+        self._runs: Dict[str, RunBroadcast] = {}
+        self._slots: Dict[Tuple[str, int], RunBroadcast] = {}
+
+    def _sweep(self) -> None:
+        cutoff = time.time() - self.ttl
+        for key in [key for key, run in self._runs.items() if run.cancelled or (run.finished_at is not None and run.finished_at < cutoff)]:
+            run = self._runs.pop(key)
+            if run.slot is not None and self._slots.get((run.thread_id, run.slot)) is run:
+                del self._slots[(run.thread_id, run.slot)]
+
+    def start(self, thread_id: str, source: AsyncIterator[str], slot: Optional[int] = None) -> RunBroadcast:
+        """Drive `source` in a background task and register it for replay."""
+        self._sweep()
+        broadcast = RunBroadcast(thread_id, slot)
+        broadcast.task = asyncio.create_task(broadcast.run(source))
+        self._runs[broadcast.key] = broadcast
+        if slot is not None:
+            self._slots[(thread_id, slot)] = broadcast
+        metrics.increment("sse.runs")
+        return broadcast
+
+    def for_slot(self, thread_id: str, slot: int) -> Optional[RunBroadcast]:
+        """The broadcast already serving a thread's run slot in this process, if any."""
+        self._sweep()
+        return self._slots.get((thread_id, slot))
+
+    def resume(self, thread_id: str, last_event_id: str) -> Optional[Tuple[RunBroadcast, int]]:
+        """Find the run a Last-Event-ID belongs to, and the sequence number to replay after."""
+        self._sweep()
+        key, _, seq = last_event_id.partition(":")
+        broadcast = self._runs.get(key)
+        if broadcast is None or broadcast.thread_id != thread_id or not seq.isdigit():
+            metrics.increment("sse.resume_missed")
+            return None
+        metrics.increment("sse.resumed")
+        return broadcast, int(seq)
+
+    def __len__(self) -> int:
+        return len(self._runs)
+
+
+run_broadcaster = RunBroadcaster()
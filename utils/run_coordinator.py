@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import os
+import sys
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Dict, List, Tuple
+
+from utils.metrics import metrics
+from utils.run_broadcast import RunBroadcast, RunBroadcaster, run_broadcaster
+from utils.sse import sse_format
+from utils.thread_store import ThreadStore, thread_store
+
+if sys.platform != "win32":
+    import fcntl
+
+logger = logging.getLogger("uvicorn.error")
+
+RUN_LOCK_DIR: str = os.getenv("RUN_LOCK_DIR", os.path.join(".cache", "locks"))
+# How often a run waiting for its thread's lock checks again
+RUN_LOCK_POLL_SECONDS = 0.1
+# A message joins the messages queued before it only while their run could still be about to
+# connect; past this, the browser may never have opened it, so the message gets a run of its own
+RUN_SLOT_JOIN_SECONDS: float = float(os.getenv("RUN_SLOT_JOIN_SECONDS", "5"))
+
+StartStream = Callable[[List[str]], AsyncIterator[str]]
+
+
+class ThreadRunLock:
+    """
+    One lock file per thread, held with flock for the whole of a run.
+
+    flock locks belong to the open file, so they exclude other worker
+    processes on the host as well as other runs in this process. Waiting
+    polls rather than blocks, so it never ties up the event loop and can be
+    cancelled.
+    """
+
+    def __init__(self, directory: str = RUN_LOCK_DIR):
+        self.directory = directory
+        self._local: Dict[str, asyncio.Lock] = {}
+
+    def _path(self, thread_id: str) -> str:
+        return os.path.join(self.directory, f"{''.join(char for char in thread_id if char.isalnum() or char == '_')}.lock")
+
+    @asynccontextmanager
+    async def hold(self, thread_id: str):
+        if sys.platform == "win32":
+            # No flock on Windows: runs are only serialized within this process
+            async with self._local.setdefault(thread_id, asyncio.Lock()):
+                yield
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(self._path(thread_id), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            waited = False
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    waited = True
+                    await asyncio.sleep(RUN_LOCK_POLL_SECONDS)
+            if waited:
+                metrics.increment("runs.waited_for_lock")
+            yield
+        finally:
+            # Closing the file releases the lock
+            os.close(fd)
+
+
+class RunCoordinator:
+    """
+    Serializes the runs of each thread.
+
+    A message sent while a run is active is queued in the thread store under
+    the next run slot rather than posted, since OpenAI rejects messages and
+    runs on a thread with an active run. The slot's run waits for the
+    thread's lock, posts every queued message at once, and then streams.
+    Further /receive connections for a slot attach to the run already
+    serving it instead of starting another.
+    """
+
+    def __init__(self, store: ThreadStore, broadcaster: RunBroadcaster, lock: ThreadRunLock):
+        self.store = store
+        self.broadcaster = broadcaster
+        self.lock = lock
+
+    async def enqueue(self, thread_id: str, content: str) -> Tuple[int, bool]:
+        """
+        Queue a message. Returns its run slot, and whether it opened that slot.
+
+        The message joins the open slot if a run in this process is already serving it
+        (waiting for the thread's lock), or if the slot's messages were queued within
+        RUN_SLOT_JOIN_SECONDS. Otherwise it opens the next slot, so a slot whose /receive
+        never connected cannot leave the thread without a run.
+        """
+        open_slot = await asyncio.to_thread(self.store.open_slot, thread_id)
+        live = self.broadcaster.for_slot(thread_id, open_slot) is not None
+        slot, opened = await asyncio.to_thread(
+            self.store.enqueue_message, thread_id, content, None if live else RUN_SLOT_JOIN_SECONDS
+        )
+        if not opened:
+            metrics.increment("runs.merged_messages")
+        return slot, opened
+
+    async def _run(self, thread_id: str, slot: int, start_stream: StartStream) -> AsyncIterator[str]:
+        async with self.lock.hold(thread_id):
+            messages = await asyncio.to_thread(self.store.claim_slot, thread_id, slot)
+            if messages is None:
+                # Another process already ran this slot; its frames cannot be replayed from here
+                logger.info(f"Run slot {slot} of thread {thread_id} was already started elsewhere")
+                yield sse_format("endStream", "DONE")
+                return
+            async for frame in start_stream(messages):
+                yield frame
+
+    async def receive(self, thread_id: str, slot: int | None, start_stream: StartStream) -> RunBroadcast:
+        """
+        Return the broadcast for a thread's run slot, starting it if no connection has yet.
+
+        Args:
+            thread_id: The thread
+            slot: The run slot from the send that opened it; the thread's open slot if None
+            start_stream: Posts the slot's queued messages and streams the run's SSE frames
+        """
+        if slot is None:
+            slot = await asyncio.to_thread(self.store.open_slot, thread_id)
+        existing = self.broadcaster.for_slot(thread_id, slot)
+        if existing is not None:
+            metrics.increment("runs.attached")
+            return existing
+        return self.broadcaster.start(thread_id, self._run(thread_id, slot, start_stream), slot=slot)
+
+
+run_coordinator = RunCoordinator(thread_store, run_broadcaster, ThreadRunLock())
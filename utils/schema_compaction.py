@@ -0,0 +1,291 @@
+import argparse
+import copy
+import json
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from utils.tokens import count_tokens
+from utils.tools import (
+    DATABASE_SCHEMA, ENDPOINT_SCHEMAS, REQUEST_SCHEMAS, SYSTEM_PROMPT, SYSTEM_PROMPT_TEMPLATE
+)
+
+# Parameters whose description is identical on at least this many tools are described once, in the instructions
+SHARED_PARAMETER_MIN_TOOLS = 3
+
+# Said once in the instructions instead of in every endpoint tool and parameter
+OPERATOR_NOTE = (
+    "Filters on get_* endpoint tools take PostgREST operators: eq, neq, gt, gte, lt, lte, like and "
+    "ilike (* is the wildcard), fts, plfts and phfts (full-text search), in.(a,b) and is.null. "
+    "Timestamps are timestamptz."
+)
+# Short forms of the shared parameters' descriptions; others are stated as the tools describe them
+SHARED_PARAMETER_NOTES: Dict[str, str] = {
+    "select": "columns to return: * or a comma-separated list",
+    "order": "column.asc or column.desc, comma-separated",
+    "offset": "rows to skip",
+    "limit": "rows to return",
+}
+
+_FK_TAG = re.compile(r"<fk table='(\w+)' column='(\w+)'/>")
+_SCHEMA_FK = re.compile(r"FK -> (\w+)\.(\w+)")
+_OPERATOR = r"'(?:eq|neq|gt|gte|lt|lte|like|ilike|fts|plfts|phfts)'"
+_DESCRIPTION_RULES: List[Tuple[re.Pattern, str]] = [
+    # Primary and foreign key notes: keys are marked in the compact schema
+    (re.compile(r"\s*Note: This is a (?:Primary|Foreign) Key[^<]*<(?:pk|fk)[^>]*/>"), ""),
+    # Operator usage, covered by OPERATOR_NOTE
+    (re.compile(rf"\s*Use [^.]*{_OPERATOR}[^.]*\."), ""),
+    (re.compile(r"\s*\(e\.g\.,[^)]*\)"), ""),
+    (re.compile(r"\s*(?:It supports|It provides options for|It allows filtering by various attributes using|"
+                r"Must use|You must use|Use) [^.]*PostgREST (?:compatible )?operators[^.]*\."), ""),
+    (re.compile(r" PostgREST endpoint of the Twitter Community Archive(?: API)?"), " endpoint"),
+    (re.compile(r" PostgREST endpoint"), " endpoint"),
+    (re.compile(r"Format: timestamp with time zone\.?"), ""),
+    # "Filter tweets by a specific account ID." says no more than the parameter name
+    (re.compile(r"^(?:Filter|Retrieve) (?:[\w ]+? )?by (?:a |the )?(?:specific )?"), ""),
+    # Equality examples show nothing the operator note does not
+    (re.compile(r"\s*Example: \w+=eq\.\S+"), ""),
+    (re.compile(r"Example: \w+="), "e.g. "),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def compact_description(text: str) -> str:
+    """Strip the PostgREST boilerplate and key notes from a tool or parameter description."""
+    for pattern, replacement in _DESCRIPTION_RULES:
+        text = pattern.sub(replacement, text)
+    return text.strip(" .")
+
+
+def _restates_name(name: str, description: str) -> bool:
+    words = re.sub(r"[^a-z0-9 ]", "", description.lower()).split()
+    return not description or words == name.lower().split("_")
+
+
+def endpoint_tables() -> Dict[str, str]:
+    """The PostgREST resource each endpoint tool reads, e.g. tweets for get_tweets."""
+    return {endpoint["name"]: endpoint["url"].rstrip("/").rsplit("/", 1)[-1] for endpoint in ENDPOINT_SCHEMAS}
+
+
+def shared_parameters(schemas: Iterable[Dict] = REQUEST_SCHEMAS) -> Dict[str, str]:
+    """Parameters described identically on several tools, with that description."""
+    counts = Counter(
+        (name, prop.get("description", ""))
+        for schema in schemas
+        for name, prop in schema["function"]["parameters"].get("properties", {}).items()
+    )
+    return {
+        name: description for (name, description), count in counts.items()
+        if description and count >= SHARED_PARAMETER_MIN_TOOLS
+    }
+
+
+def relationships(tool_names: Optional[Iterable[str]] = None, tables: Optional[Iterable[str]] = None) -> List[Tuple[str, str]]:
+    """
+    Foreign keys as (referencing column, referenced column) pairs, from the `<fk>`
+    tags of the endpoint tools' parameters and the FK notes of DATABASE_SCHEMA.
+
+    Args:
+        tool_names: Only include the tags of these tools; all tools if None
+        tables: Only include the schema keys of these tables; all tables if None
+    """
+    pairs: List[Tuple[str, str]] = []
+    resources = endpoint_tables()
+    for schema in REQUEST_SCHEMAS:
+        name = schema["function"]["name"]
+        if name not in resources or (tool_names is not None and name not in tool_names):
+            continue
+        for parameter, prop in schema["function"]["parameters"]["properties"].items():
+            for table, column in _FK_TAG.findall(prop.get("description", "")):
+                pairs.append((f"{resources[name]}.{parameter}", f"{table}.{column}"))
+
+    table = None
+    for line in DATABASE_SCHEMA.splitlines():
+        if line.strip() and not line.startswith(" "):
+            table = line.strip()
+        elif table and (tables is None or table in tables):
+            for target_table, target_column in _SCHEMA_FK.findall(line):
+                pairs.append((f"{table}.{line.strip()[2:].split(' ')[0]}", f"{target_table}.{target_column}"))
+    return list(dict.fromkeys(pairs))
+
+
+def _primary_keys() -> Dict[str, str]:
+    """
+    The primary key of each table with a single-column one, from DATABASE_SCHEMA
+    and the `<pk/>` tags of the endpoint tools' parameters.
+    """
+    keys: Dict[str, List[str]] = {}
+    table = None
+    for line in DATABASE_SCHEMA.splitlines():
+        if line.strip() and not line.startswith(" "):
+            table = line.strip()
+            keys[table] = []
+        elif table and "(PK" in line:
+            keys[table].append(line.strip()[2:].split(" ")[0])
+    resources = endpoint_tables()
+    for schema in REQUEST_SCHEMAS:
+        name = schema["function"]["name"]
+        if name in resources and resources[name] not in keys:
+            keys[resources[name]] = [
+                parameter for parameter, prop in schema["function"]["parameters"]["properties"].items()
+                if "<pk/>" in prop.get("description", "")
+            ]
+    return {table: columns[0] for table, columns in keys.items() if len(columns) == 1}
+
+
+def _reference(column: str, targets: List[str], primary_keys: Dict[str, str]) -> str:
+    """`>table` for each referenced primary key and `>table.column` for any other referenced column."""
+    marks = []
+    for target in targets:
+        table, target_column = target.split(".")
+        marks.append(f">{table}" if primary_keys.get(table) == target_column else f">{target}")
+    return column + "".join(marks)
+
+
+def compact_schema(tables: Optional[Iterable[str]] = None, tool_names: Optional[Iterable[str]] = None) -> str:
+    """
+    One line per table, primary keys marked with * and foreign keys with `>` and
+    what they reference. Foreign keys the listed tables do not show, such as
+    those of the tweets table, follow on a line of their own.
+
+    Args:
+        tables: Only describe these tables; all tables if None
+        tool_names: Only include the foreign keys of these tools' parameters; all tools if None
+    """
+    tables = list(tables) if tables is not None else None
+    primary_keys = _primary_keys()
+    references: Dict[str, List[str]] = {}
+    for source, target in relationships(tool_names, tables):
+        references.setdefault(source, []).append(target)
+
+    lines = []
+    table = None
+    columns: Dict[str, List[str]] = {}
+    for line in DATABASE_SCHEMA.splitlines():
+        if line.strip() and not line.startswith(" "):
+            table = line.strip()
+            columns[table] = []
+        elif table and line.strip().startswith("- "):
+            column = line.strip()[2:]
+            name = column.split(" ")[0]
+            targets = references.pop(f"{table}.{name}", [])
+            columns[table].append(_reference(name + ("*" if "(PK" in column else ""), targets, primary_keys))
+    for table, names in columns.items():
+        if tables is None or table in tables:
+            lines.append(f"{table}: {', '.join(names)}")
+    if references:
+        lines.append("also: " + ", ".join(
+            _reference(source, targets, primary_keys) for source, targets in references.items()
+        ))
+    return "\n".join(lines)
+
+
+def compact_tool(schema: Dict, shared: Dict[str, str]) -> Dict:
+    """A tool schema with boilerplate stripped, shared parameter descriptions removed and the `optional` list dropped."""
+    schema = copy.deepcopy(schema)
+    function = schema["function"]
+    function["description"] = compact_description(function["description"])
+    parameters = function["parameters"]
+    parameters.pop("optional", None)
+    for name, prop in parameters.get("properties", {}).items():
+        if "description" not in prop:
+            continue
+        if shared.get(name) == prop["description"]:
+            del prop["description"]
+            continue
+        description = compact_description(prop["description"])
+        if _restates_name(name, description):
+            del prop["description"]
+        else:
+            prop["description"] = description
+    return schema
+
+
+def _paragraphs(text: str) -> str:
+    """Join hard-wrapped lines, keeping blank-line paragraph breaks."""
+    return "\n\n".join(" ".join(paragraph.split()) for paragraph in re.split(r"\n\s*\n", text.strip()))
+
+
+def shared_definitions(tool_names: Optional[Iterable[str]] = None) -> str:
+    """
+    OPERATOR_NOTE and the descriptions of the shared parameters, for the endpoint
+    tools among `tool_names` (all tools if None). Empty if none is offered.
+    """
+    resources = endpoint_tables()
+    offered = [
+        schema for schema in REQUEST_SCHEMAS
+        if schema["function"]["name"] in resources and (tool_names is None or schema["function"]["name"] in tool_names)
+    ]
+    if not offered:
+        return ""
+    used = {name for schema in offered for name in schema["function"]["parameters"].get("properties", {})}
+    shared = [
+        f"{name} ({SHARED_PARAMETER_NOTES.get(name, description)})"
+        for name, description in _SHARED_PARAMETERS.items() if name in used
+    ]
+    return f"{OPERATOR_NOTE}\nShared parameters: {', '.join(shared)}." if shared else OPERATOR_NOTE
+
+
+def compact_instructions(tables: Optional[Iterable[str]] = None, tool_names: Optional[Iterable[str]] = None) -> str:
+    """
+    The system prompt with the compact schema and the shared definitions of the offered tools.
+
+    Args:
+        tables: Only describe these tables; all tables if None
+        tool_names: Only include the foreign keys and shared definitions of these tools; all tools if None
+    """
+    tool_names = list(tool_names) if tool_names is not None else None
+    schema = "\n".join([
+        "In the schema, * marks a primary key and > the table (and column, if not its key) a foreign key references.",
+        compact_schema(tables, tool_names),
+    ])
+    guidance = _paragraphs(SYSTEM_PROMPT_TEMPLATE.replace("{DATABASE_SCHEMA}", "\0")).replace("\0", schema)
+    definitions = shared_definitions(tool_names)
+    return f"{guidance}\n\n{definitions}" if definitions else guidance
+
+
+_SHARED_PARAMETERS: Dict[str, str] = shared_parameters()
+COMPACT_REQUEST_SCHEMAS: List[Dict] = [compact_tool(schema, _SHARED_PARAMETERS) for schema in REQUEST_SCHEMAS]
+COMPACT_SYSTEM_PROMPT: str = compact_instructions()
+
+
+def token_report() -> str:
+    """Tokens of the verbose and compacted instructions, by section, and of every tool schema."""
+    sections = [
+        ("guidance", count_tokens(SYSTEM_PROMPT_TEMPLATE.replace("{DATABASE_SCHEMA}", "")),
+         count_tokens(_paragraphs(SYSTEM_PROMPT_TEMPLATE.replace("{DATABASE_SCHEMA}", "")))),
+        ("database schema", count_tokens(DATABASE_SCHEMA), count_tokens(compact_schema())),
+        ("shared definitions", 0, count_tokens(shared_definitions())),
+    ]
+    lines = [f"{'instructions':<24}{'verbose':>9}{'compact':>9}{'saved':>8}"]
+    for name, verbose, compact in sections:
+        lines.append(f"  {name:<22}{verbose:>9}{compact:>9}{verbose - compact:>8}")
+    verbose_total, compact_total = count_tokens(SYSTEM_PROMPT), count_tokens(COMPACT_SYSTEM_PROMPT)
+    lines.append(f"  {'total':<22}{verbose_total:>9}{compact_total:>9}{verbose_total - compact_total:>8}")
+
+    lines.append(f"{'tools':<24}{'verbose':>9}{'compact':>9}{'saved':>8}")
+    tool_verbose = tool_compact = 0
+    for verbose_schema, compact_schema_ in zip(REQUEST_SCHEMAS, COMPACT_REQUEST_SCHEMAS):
+        verbose, compact = count_tokens(json.dumps(verbose_schema)), count_tokens(json.dumps(compact_schema_))
+        tool_verbose += verbose
+        tool_compact += compact
+        lines.append(f"  {verbose_schema['function']['name']:<22}{verbose:>9}{compact:>9}{verbose - compact:>8}")
+    lines.append(f"  {'total':<22}{tool_verbose:>9}{tool_compact:>9}{tool_verbose - tool_compact:>8}")
+
+    verbose_all, compact_all = verbose_total + tool_verbose, compact_total + tool_compact
+    lines.append(f"{'per model request':<24}{verbose_all:>9}{compact_all:>9}{verbose_all - compact_all:>8}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    # Report what compaction saves, and optionally write out what setup publishes:
+    # python -m utils.schema_compaction [--write compact_tools.json]
+    parser = argparse.ArgumentParser(description="Compact the tool schemas and instructions and report their token counts.")
+    parser.add_argument("--write", metavar="PATH", help="Write the compacted instructions and tools to this JSON file")
+    options = parser.parse_args()
+
+    print(token_report())
+    if options.write:
+        with open(options.write, "w") as output:
+            json.dump({"instructions": COMPACT_SYSTEM_PROMPT, "tools": COMPACT_REQUEST_SCHEMAS}, output, indent=2)
+        print(f"Wrote {options.write}")
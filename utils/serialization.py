@@ -0,0 +1,100 @@
+import json
+from typing import Any, Dict, List, Tuple
+
+# Text cells longer than this are abbreviated in the model-facing output
+MAX_CELL_CHARS = 200
+
+# Separator used when a one-to-many embedding is flattened into a single cell
+LIST_SEPARATOR = " | "
+
+
+def flatten_row(row: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
+    """
+    Flatten nested embeddings into dotted column names.
+
+    `{"account": {"username": "foo"}}` becomes `{"account.username": "foo"}`. A
+    one-to-many embedding (a list of objects) becomes one column per key whose
+    cell joins the values of every object; lists of scalars are joined the same way.
+    """
+    flat: Dict[str, Any] = {}
+    for key, value in row.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten_row(value, prefix=f"{name}."))
+        elif isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+            flattened = [flatten_row(item) for item in value]
+            for column in dict.fromkeys(column for item in flattened for column in item):
+                flat[f"{name}.{column}"] = LIST_SEPARATOR.join(
+                    format_cell(item.get(column), max_chars=None) for item in flattened
+                )
+        elif isinstance(value, list):
+            flat[name] = LIST_SEPARATOR.join(format_cell(item, max_chars=None) for item in value)
+        else:
+            flat[name] = value
+    return flat
+
+
+def format_cell(value: Any, max_chars: int | None = MAX_CELL_CHARS) -> str:
+    """Render a single value as a tab- and newline-free cell, abbreviating long text."""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        text = "true" if value else "false"
+    elif isinstance(value, (dict, list)):
+        text = json.dumps(value, separators=(",", ":"))
+    else:
+        text = str(value)
+
+    text = text.replace("\t", " ").replace("\r", "").replace("\n", "\\n")
+    if max_chars is not None and len(text) > max_chars:
+        text = text[:max_chars - 1] + "…"
+    return text
+
+
+def to_table(rows: List[Dict[str, Any]]) -> Tuple[List[str], List[List[str]]]:
+    """Flatten rows and return a shared header plus one list of cells per row."""
+    flattened = [flatten_row(row) for row in rows]
+    columns = list(dict.fromkeys(column for row in flattened for column in row))
+    return columns, [[format_cell(row.get(column)) for column in columns] for row in flattened]
+
+
+def serialize_compact(rows: Any, max_chars: int, total_rows: int | None = None) -> Tuple[str, int]:
+    """
+    Serialize tool output as a tab-separated table with a single header row.
+
+    Only whole rows are emitted: rows are added until the next one would exceed
+    `max_chars`, and a footer says how many rows were left out.
+
+    Args:
+        rows: The tool response; anything other than a list of objects falls back to JSON
+        max_chars: Character budget for the serialized output
+        total_rows: The number of rows upstream returned, if `rows` was already cut down
+
+    Returns:
+        The serialized text and the number of rows it contains
+    """
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        text = rows if isinstance(rows, str) else json.dumps(rows)
+        if len(text) > max_chars:
+            text = text[:max_chars] + "..."
+        return text, 0
+
+    total_rows = len(rows) if total_rows is None else total_rows
+    if not rows:
+        return "(no rows)", 0
+
+    columns, table = to_table(rows)
+    lines = ["\t".join(columns)]
+    used = len(lines[0])
+    included = 0
+    for cells in table:
+        line = "\t".join(cells)
+        if included and used + 1 + len(line) > max_chars:
+            break
+        lines.append(line)
+        used += 1 + len(line)
+        included += 1
+
+    if included < total_rows:
+        lines.append(f"[{included} of {total_rows} rows shown]")
+    return "\n".join(lines), included
@@ -0,0 +1,352 @@
+import argparse
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from array import array
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+SIMILARITY_INDEX_DIR: str = os.getenv("SIMILARITY_INDEX_DIR", os.path.join(".cache", "similarity"))
+SIMILARITY_MAX_TWEETS: int = int(os.getenv("SIMILARITY_MAX_TWEETS", "2000000"))
+
+# Hashed feature space for TF-IDF vectors
+DIMENSIONS = 1 << 20
+
+# MinHash LSH: BANDS bands of ROWS hashes each. Tweets sharing any band are candidates.
+BANDS = 4
+ROWS = 4
+NUM_HASHES = BANDS * ROWS
+_HASH_SEEDS = [zlib.crc32(f"minhash-{seed}".encode()) for seed in range(NUM_HASHES)]
+_MASK = (1 << 32) - 1
+
+# Postings longer than this belong to terms too common to find candidates with
+MAX_POSTING_LENGTH = 5000
+# Rarest query terms whose postings are added to the LSH candidates
+POSTING_TERMS = 4
+MAX_CANDIDATES = 5000
+
+SNIPPET_CHARS = 160
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9][a-z0-9']+")
+URL_PATTERN = re.compile(r"https?://\S+")
+STOPWORDS = frozenset(
+    "the and for are but not you all any can had her was one our out his has have this that with from they "
+    "will would there their what about which when your just like into than then them these some its it's "
+    "also been were more very i'm don't dont rt amp".split()
+)
+
+SNAPSHOT_ARRAYS = {
+    "tweet_ids": "q", "account_ids": "q", "created": "q",
+    "offsets": "Q", "features": "I", "weights": "f", "signatures": "I",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased words without URLs and stopwords, plus adjacent word pairs."""
+    words = [word for word in TOKEN_PATTERN.findall(URL_PATTERN.sub(" ", text.lower())) if word not in STOPWORDS]
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+
+def feature(token: str) -> int:
+    return zlib.crc32(token.encode()) % DIMENSIONS
+
+
+def minhash(features: Iterable[int]) -> List[int]:
+    """MinHash signature of a feature set, using XOR-seeded multiplicative hashes."""
+    features = list(features)
+    if not features:
+        return [_MASK] * NUM_HASHES
+    return [min(((value ^ seed) * 2654435761) & _MASK for value in features) for seed in _HASH_SEEDS]
+
+
+def to_epoch(value: Any) -> int:
+    """ISO timestamp or date to Unix seconds; 0 if missing or unparseable."""
+    if not value:
+        return 0
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return 0
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+class SimilarityIndex:
+    """
+    Approximate nearest-neighbour search over tweet text, entirely in process.
+
+    Each tweet becomes an L2-normalised TF-IDF vector over hashed word and
+    word-pair features, stored in flat arrays (CSR style). Candidates come from
+    MinHash LSH buckets over the feature set plus the postings of the query's
+    rarest features, and are ranked by cosine similarity. Tweets can be added
+    at any time; IDF is taken from the document frequencies at insert time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.tweet_ids = array("q")
+        self.account_ids = array("q")
+        self.created = array("q")
+        self.offsets = array("Q", [0])
+        self.features = array("I")
+        self.weights = array("f")
+        self.signatures = array("I")
+        self.snippets: List[str] = []
+        self.document_frequency = array("I", bytes(4 * DIMENSIONS))
+        self._positions: Dict[int, int] = {}
+        self._buckets: List[Dict[Tuple[int, ...], array]] = [{} for _ in range(BANDS)]
+        self._postings: Dict[int, array] = {}
+        # Tweets added since the index was last saved
+        self.unsaved = 0
+
+    def __len__(self) -> int:
+        return len(self.tweet_ids)
+
+    def _idf(self, feature_id: int) -> float:
+        return math.log((1 + len(self.tweet_ids)) / (1 + self.document_frequency[feature_id])) + 1
+
+    def vectorize(self, text: str, update_frequencies: bool = False) -> Dict[int, float]:
+        counts: Dict[int, int] = {}
+        for token in tokenize(text):
+            feature_id = feature(token)
+            counts[feature_id] = counts.get(feature_id, 0) + 1
+        if update_frequencies:
+            for feature_id in counts:
+                self.document_frequency[feature_id] += 1
+        vector = {feature_id: (1 + math.log(count)) * self._idf(feature_id) for feature_id, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {feature_id: weight / norm for feature_id, weight in vector.items()}
+
+    def _index_position(self, position: int) -> None:
+        start, end = self.offsets[position], self.offsets[position + 1]
+        for feature_id in self.features[start:end]:
+            posting = self._postings.setdefault(feature_id, array("I"))
+            if len(posting) < MAX_POSTING_LENGTH:
+                posting.append(position)
+        signature = tuple(self.signatures[position * NUM_HASHES:(position + 1) * NUM_HASHES])
+        for band in range(BANDS):
+            key = signature[band * ROWS:(band + 1) * ROWS]
+            self._buckets[band].setdefault(key, array("I")).append(position)
+
+    def add(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Insert tweets that have tweet_id and full_text and are not indexed yet. Returns how many were added."""
+        added = 0
+        with self._lock:
+            for row in rows:
+                try:
+                    tweet_id = int(row["tweet_id"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                text = row.get("full_text")
+                if not text or tweet_id in self._positions or len(self.tweet_ids) >= SIMILARITY_MAX_TWEETS:
+                    continue
+                vector = self.vectorize(text, update_frequencies=True)
+                if not vector:
+                    continue
+
+                position = len(self.tweet_ids)
+                self._positions[tweet_id] = position
+                self.tweet_ids.append(tweet_id)
+                try:
+                    self.account_ids.append(int(row.get("account_id") or 0))
+                except (TypeError, ValueError):
+                    self.account_ids.append(0)
+                self.created.append(to_epoch(row.get("created_at")))
+                self.features.extend(vector.keys())
+                self.weights.extend(vector.values())
+                self.offsets.append(len(self.features))
+                self.signatures.extend(minhash(vector.keys()))
+                self.snippets.append(" ".join(text.split())[:SNIPPET_CHARS])
+                self._index_position(position)
+                added += 1
+        if added:
+            self.unsaved += added
+            metrics.increment("similarity.inserted", added)
+        return added
+
+    def _stored_vector(self, position: int) -> Dict[int, float]:
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return dict(zip(self.features[start:end], self.weights[start:end]))
+
+    def search(
+        self,
+        text: Optional[str] = None,
+        tweet_id: Optional[str] = None,
+        account_id: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        limit: int = DEFAULT_LIMIT
+    ) -> List[Dict[str, Any]]:
+        """Return the most similar indexed tweets to a text or an indexed tweet, best first."""
+        exclude = None
+        if tweet_id is not None:
+            exclude = self._positions.get(int(tweet_id))
+            if exclude is None:
+                raise ValueError(f"Tweet {tweet_id} is not in the similarity index; pass its text instead")
+            query = self._stored_vector(exclude)
+        else:
+            query = self.vectorize(text or "")
+        if not query:
+            raise ValueError("The query has no searchable words")
+
+        # A candidate's overlap is the number of LSH bands and top-term postings it shares with the query
+        signature = minhash(query.keys())
+        overlap: Counter = Counter()
+        for band in range(BANDS):
+            overlap.update(self._buckets[band].get(tuple(signature[band * ROWS:(band + 1) * ROWS]), ()))
+        for feature_id in heapq.nlargest(POSTING_TERMS, query, key=lambda feature_id: query[feature_id]):
+            overlap.update(self._postings.get(feature_id, ())[:MAX_CANDIDATES])
+        if exclude is not None:
+            del overlap[exclude]
+
+        account = int(account_id) if account_id else None
+        start, end = to_epoch(since), to_epoch(until)
+        eligible = Counter({
+            position: count for position, count in overlap.items()
+            if (account is None or self.account_ids[position] == account)
+            and not (start and self.created[position] < start)
+            and not (end and self.created[position] > end)
+        })
+        # Only the candidates with the most overlap are scored
+        scored = []
+        for position, _ in eligible.most_common(MAX_CANDIDATES):
+            low, high = self.offsets[position], self.offsets[position + 1]
+            score = sum(query.get(feature_id, 0.0) * weight for feature_id, weight in zip(self.features[low:high], self.weights[low:high]))
+            if score > 0:
+                scored.append((score, position))
+
+        return [
+            {
+                "tweet_id": str(self.tweet_ids[position]),
+                "account_id": str(self.account_ids[position]),
+                "created_at": time.strftime("%Y-%m-%d", time.gmtime(self.created[position])) if self.created[position] else None,
+                "similarity": round(score, 3),
+                "full_text": self.snippets[position],
+            }
+            for score, position in heapq.nlargest(limit, scored)
+        ]
+
+    def save(self, directory: str = SIMILARITY_INDEX_DIR) -> None:
+        """Write the index arrays to disk; buckets and postings are rebuilt on load."""
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            for name in SNAPSHOT_ARRAYS:
+                with open(os.path.join(directory, f"{name}.bin"), "wb") as f:
+                    getattr(self, name).tofile(f)
+            with open(os.path.join(directory, "document_frequency.bin"), "wb") as f:
+                self.document_frequency.tofile(f)
+            with open(os.path.join(directory, "snippets.json"), "w") as f:
+                json.dump(self.snippets, f)
+            self.unsaved = 0
+
+    def load(self, directory: str = SIMILARITY_INDEX_DIR) -> bool:
+        """Load a saved index. Returns False if there is none."""
+        try:
+            loaded = {}
+            for name, typecode in {**SNAPSHOT_ARRAYS, "document_frequency": "I"}.items():
+                values = array(typecode)
+                with open(os.path.join(directory, f"{name}.bin"), "rb") as f:
+                    values.frombytes(f.read())
+                loaded[name] = values
+            with open(os.path.join(directory, "snippets.json")) as f:
+                snippets = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.info(f"No similarity index loaded: {e}")
+            return False
+
+        with self._lock:
+            for name, values in loaded.items():
+                setattr(self, name, values)
+            self.snippets = snippets
+            self._positions = {tweet_id: position for position, tweet_id in enumerate(self.tweet_ids)}
+            self._buckets = [{} for _ in range(BANDS)]
+            self._postings = {}
+            for position in range(len(self.tweet_ids)):
+                self._index_position(position)
+        logger.info(f"Similarity index loaded: {len(self.tweet_ids)} tweets")
+        return True
+
+
+def run_similarity_tool(
+    args: Dict[str, Any],
+    index: SimilarityIndex,
+    resolve_account: Callable[[str], Optional[Tuple[str, str]]],
+    username_for: Callable[[Any], Optional[str]]
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Handle a `find_similar_tweets` tool call."""
+    if not len(index):
+        raise ValueError(
+            "The similarity index is empty. Use get_tweets with a full_text filter instead "
+            "(the index is built with `python -m utils.similarity`)."
+        )
+    if not args.get("text") and not args.get("tweet_id"):
+        raise ValueError("Pass `text` or `tweet_id`")
+
+    account_id = None
+    if args.get("account"):
+        resolved = resolve_account(str(args["account"]))
+        if resolved is None:
+            raise ValueError(f"{args['account']} is not an archived account")
+        account_id = resolved[0]
+
+    started = time.perf_counter()
+    rows = index.search(
+        text=args.get("text"),
+        tweet_id=args.get("tweet_id"),
+        account_id=account_id,
+        since=args.get("since"),
+        until=args.get("until"),
+        limit=max(1, min(int(args.get("limit") or DEFAULT_LIMIT), MAX_LIMIT)),
+    )
+    metrics.increment("similarity.searches")
+    metrics.increment("similarity.search_ms", int((time.perf_counter() - started) * 1000))
+    for row in rows:
+        row["username"] = username_for(row["account_id"])
+    return rows, [f"Searched {len(index)} locally indexed tweets; text is truncated to {SNIPPET_CHARS} characters."]
+
+
+if __name__ == "__main__":
+    # Build the index offline: python -m utils.similarity [--account USERNAME ...] [--max-tweets N]
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    from utils.tool_executor import fetch_endpoint_pages, resolve_account
+
+    parser = argparse.ArgumentParser(description="Build or extend the local tweet similarity index.")
+    parser.add_argument("--account", action="append", default=[], help="Only index this account (repeatable)")
+    parser.add_argument("--max-tweets", type=int, default=SIMILARITY_MAX_TWEETS)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    similarity_index = SimilarityIndex()
+    similarity_index.load()
+    filters: List[Dict[str, Any]] = [{}]
+    if options.account:
+        filters = []
+        for account in options.account:
+            resolved = resolve_account(account)
+            if resolved is None:
+                raise SystemExit(f"{account} is not an archived account")
+            filters.append({"account_id": f"eq.{resolved[0]}"})
+
+    for extra in filters:
+        params: Dict[str, Any] = {"select": "tweet_id,account_id,created_at,full_text", **extra}
+        pages: Iterator[List[Dict[str, Any]]] = fetch_endpoint_pages("get_tweets", params, options.max_tweets)
+        for page in pages:
+            similarity_index.add(page)
+            logger.info(f"{len(similarity_index)} tweets indexed")
+    similarity_index.save()
@@ -0,0 +1,434 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+# Building the graph downloads the whole followers and following tables, so it is opt-in:
+# turn it on against your own mirror, or with a snapshot in SOCIAL_GRAPH_SNAPSHOT_DIR
+SOCIAL_GRAPH_ENABLED: bool = os.getenv("SOCIAL_GRAPH_ENABLED", "false").lower() == "true"
+SOCIAL_GRAPH_REFRESH_SECONDS: float = float(os.getenv("SOCIAL_GRAPH_REFRESH_SECONDS", "86400"))
+SOCIAL_GRAPH_MAX_EDGES: int = int(os.getenv("SOCIAL_GRAPH_MAX_EDGES", "50000000"))
+# First wait before retrying a failed build; it doubles on each failure, up to the refresh interval
+SOCIAL_GRAPH_RETRY_SECONDS: float = 60.0
+SOCIAL_GRAPH_SNAPSHOT_DIR: str = os.getenv("SOCIAL_GRAPH_SNAPSHOT_DIR", os.path.join(".cache", "graph"))
+
+MAX_HOPS = 3
+MAX_LIMIT = 100
+
+# Caps on how much of the graph one similarity query may touch
+MAX_SIMILARITY_CANDIDATES = 500
+
+# Edges are mapped to node numbers this many at a time, which bounds the int64 temporaries
+NODE_MAPPING_CHUNK = 1 << 20
+
+GRAPH_OPERATIONS = (
+    "mutuals", "common_followers", "common_following", "followers_follow",
+    "k_hop", "top_accounts", "similarity", "similar_accounts",
+)
+
+SNAPSHOT_ARRAYS = ("ids", "out_offsets", "out_targets", "in_offsets", "in_targets")
+
+FetchPages = Callable[[str, Dict[str, Any], int], Iterator[List[Dict[str, Any]]]]
+
+
+class CSR:
+    """
+    Compressed sparse row adjacency: the neighbours of node n are
+    targets[offsets[n]:offsets[n + 1]], sorted and without duplicates.
+    """
+
+    def __init__(self, offsets: np.ndarray, targets: np.ndarray):
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def from_keys(cls, keys: np.ndarray, num_nodes: int) -> "CSR":
+        """
+        Build from edges packed as `source << 32 | target` in a uint64 array,
+        sorted and deduplicated.
+        """
+        targets = (keys & 0xFFFFFFFF).astype(np.uint32)
+        counts = np.bincount((keys >> 32).astype(np.int64), minlength=num_nodes)
+        offsets = np.zeros(num_nodes + 1, dtype=np.uint64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(offsets, targets)
+
+    def neighbors(self, node: int) -> np.ndarray:
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def degree(self, node: int) -> int:
+        return int(self.offsets[node + 1] - self.offsets[node])
+
+    def degrees(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+
+def pack_edges(sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """Sorted, deduplicated `source << 32 | target` keys; the same edge can appear in both tables."""
+    keys = (sources.astype(np.uint64) << np.uint64(32)) | targets.astype(np.uint64)
+    keys.sort()
+    if len(keys):
+        keep = np.empty(len(keys), dtype=bool)
+        keep[0] = True
+        np.not_equal(keys[1:], keys[:-1], out=keep[1:])
+        keys = keys[keep]
+    return keys
+
+
+def reverse_edges(keys: np.ndarray) -> np.ndarray:
+    """The same edges, packed and sorted by target instead of source."""
+    reversed_keys = (keys << np.uint64(32)) | (keys >> np.uint64(32))
+    reversed_keys.sort()
+    return reversed_keys
+
+
+def page_column(page: List[Dict[str, Any]], column: str) -> np.ndarray:
+    """A column of account IDs from one page of rows, with -1 for missing or malformed values."""
+    def value(row: Dict[str, Any]) -> int:
+        try:
+            return int(row[column])
+        except (KeyError, TypeError, ValueError):
+            return -1
+    return np.fromiter((value(row) for row in page), dtype=np.int64, count=len(page))
+
+
+def jaccard(a: np.ndarray, b: np.ndarray) -> float:
+    """Jaccard similarity of two sorted arrays of distinct node numbers."""
+    common = len(np.intersect1d(a, b, assume_unique=True))
+    union = len(a) + len(b) - common
+    return common / union if union else 0.0
+
+
+class SocialGraph:
+    """
+    The archive's follow graph held in memory as numpy arrays.
+
+    Account IDs are mapped to dense node numbers (their rank in the sorted
+    `ids` array, so the mapping itself needs no dict), and edges "u follows v"
+    are stored twice in CSR form: `out` lists whom each node follows and `inn`
+    lists each node's followers.
+
+    Memory: a built graph takes 8 bytes per edge (a uint32 target in each
+    direction) plus 24 bytes per account (its int64 ID and a uint64 offset
+    per direction), so 50M follow edges between 2M accounts fit in about
+    450 MB. See `memory_bytes`. The build peaks at about 32 bytes per edge:
+    the downloaded int64 ID pairs, then the packed and sorted uint64 edge
+    keys. No Python object is held per edge or per account.
+    """
+
+    def __init__(self):
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.out = CSR(np.zeros(1, dtype=np.uint64), np.zeros(0, dtype=np.uint32))
+        self.inn = CSR(np.zeros(1, dtype=np.uint64), np.zeros(0, dtype=np.uint32))
+        self.built_at: Optional[float] = None
+        self.loaded = False
+        # Set while refresh_forever runs, so tool calls can tell "still loading" from "not enabled"
+        self.loading = False
+        self.edges_loaded = 0
+        self._lock = threading.Lock()
+
+    # Construction
+
+    def build(self, fetch_pages: FetchPages) -> None:
+        """Download the followers and following tables and swap in a freshly built graph."""
+        with self._lock:
+            source_chunks: List[np.ndarray] = []
+            target_chunks: List[np.ndarray] = []
+            self.edges_loaded = 0
+            tables = (
+                ("get_followers", "follower_account_id", "account_id"),
+                ("get_following_accounts", "account_id", "following_account_id"),
+            )
+            for function_name, source_column, target_column in tables:
+                params = {"select": f"{source_column},{target_column}"}
+                for page in fetch_pages(function_name, params, SOCIAL_GRAPH_MAX_EDGES):
+                    sources, targets = page_column(page, source_column), page_column(page, target_column)
+                    valid = (sources >= 0) & (targets >= 0)
+                    source_chunks.append(sources[valid])
+                    target_chunks.append(targets[valid])
+                    self.edges_loaded += int(valid.sum())
+
+            raw_sources = np.concatenate(source_chunks) if source_chunks else np.zeros(0, dtype=np.int64)
+            del source_chunks
+            raw_targets = np.concatenate(target_chunks) if target_chunks else np.zeros(0, dtype=np.int64)
+            del target_chunks
+
+            ids = np.union1d(np.unique(raw_sources), np.unique(raw_targets))
+            sources = np.empty(len(raw_sources), dtype=np.uint32)
+            targets = np.empty(len(raw_targets), dtype=np.uint32)
+            for start in range(0, len(raw_sources), NODE_MAPPING_CHUNK):
+                end = start + NODE_MAPPING_CHUNK
+                sources[start:end] = np.searchsorted(ids, raw_sources[start:end])
+                targets[start:end] = np.searchsorted(ids, raw_targets[start:end])
+            del raw_sources, raw_targets
+
+            keys = pack_edges(sources, targets)
+            del sources, targets
+            out = CSR.from_keys(keys, len(ids))
+            keys = reverse_edges(keys)
+            inn = CSR.from_keys(keys, len(ids))
+            del keys
+
+            self.ids, self.out, self.inn = ids, out, inn
+            self.built_at = time.time()
+            self.loaded = True
+            metrics.increment("social_graph.builds")
+            logger.info(
+                f"Social graph built: {len(ids)} accounts, {len(out)} follow edges, "
+                f"{self.memory_bytes() / 1e6:.0f} MB"
+            )
+
+    def memory_bytes(self) -> int:
+        """Bytes held by the graph's arrays."""
+        return sum(values.nbytes for values in (
+            self.ids, self.out.offsets, self.out.targets, self.inn.offsets, self.inn.targets
+        ))
+
+    def save(self, directory: str = SOCIAL_GRAPH_SNAPSHOT_DIR) -> None:
+        """Write the graph arrays to disk so a restart does not have to download it again."""
+        os.makedirs(directory, exist_ok=True)
+        arrays = {
+            "ids": self.ids,
+            "out_offsets": self.out.offsets, "out_targets": self.out.targets,
+            "in_offsets": self.inn.offsets, "in_targets": self.inn.targets,
+        }
+        for name, values in arrays.items():
+            np.save(os.path.join(directory, f"{name}.npy"), values)
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"built_at": self.built_at}, f)
+
+    def load_snapshot(self, directory: str = SOCIAL_GRAPH_SNAPSHOT_DIR) -> bool:
+        """
+        Load a snapshot written by save(), memory-mapped so the operating system pages
+        it in as queries touch it. Returns False if there is none or it is unreadable.
+        """
+        try:
+            with open(os.path.join(directory, "meta.json")) as f:
+                meta = json.load(f)
+            arrays = {
+                name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                for name in SNAPSHOT_ARRAYS
+            }
+        except (OSError, ValueError, KeyError) as e:
+            logger.info(f"No usable social graph snapshot: {e}")
+            return False
+
+        with self._lock:
+            self.ids = arrays["ids"]
+            self.out = CSR(arrays["out_offsets"], arrays["out_targets"])
+            self.inn = CSR(arrays["in_offsets"], arrays["in_targets"])
+            self.built_at = meta["built_at"]
+            self.edges_loaded = len(self.out)
+            self.loaded = True
+        logger.info(f"Social graph loaded from snapshot: {len(self.ids)} accounts, {len(self.out)} follow edges")
+        return True
+
+    async def refresh_forever(self, fetch_pages: FetchPages, interval: float = SOCIAL_GRAPH_REFRESH_SECONDS) -> None:
+        """
+        Load the snapshot if there is one, then rebuild whenever the graph is older than `interval`.
+        A failed build is retried after SOCIAL_GRAPH_RETRY_SECONDS, doubling after each failure.
+        """
+        self.loading = True
+        retry = SOCIAL_GRAPH_RETRY_SECONDS
+        try:
+            await asyncio.to_thread(self.load_snapshot)
+            while True:
+                age = time.time() - self.built_at if self.built_at else None
+                if age is None or age >= interval:
+                    try:
+                        await asyncio.to_thread(self.build, fetch_pages)
+                        await asyncio.to_thread(self.save)
+                    except Exception as e:
+                        logger.error(f"Social graph build failed, retrying in {retry:.0f}s: {e}")
+                        await asyncio.sleep(retry)
+                        retry = min(retry * 2, interval)
+                        continue
+                    retry = SOCIAL_GRAPH_RETRY_SECONDS
+                    age = 0
+                await asyncio.sleep(max(interval - age, 60))
+        finally:
+            self.loading = False
+
+    # Queries
+
+    def node(self, account_id: Any) -> Optional[int]:
+        """Map an account_id to its node number."""
+        try:
+            account_id = int(account_id)
+        except (TypeError, ValueError):
+            return None
+        position = int(np.searchsorted(self.ids, account_id))
+        if position < len(self.ids) and self.ids[position] == account_id:
+            return position
+        return None
+
+    def followers(self, node: int) -> np.ndarray:
+        return self.inn.neighbors(node)
+
+    def following(self, node: int) -> np.ndarray:
+        return self.out.neighbors(node)
+
+    def mutuals(self, node: int) -> List[int]:
+        return np.intersect1d(self.following(node), self.followers(node), assume_unique=True).tolist()
+
+    def common_followers(self, a: int, b: int) -> List[int]:
+        return np.intersect1d(self.followers(a), self.followers(b), assume_unique=True).tolist()
+
+    def common_following(self, a: int, b: int) -> List[int]:
+        return np.intersect1d(self.following(a), self.following(b), assume_unique=True).tolist()
+
+    def followers_follow(self, node: int) -> Counter:
+        """For each account, how many of this node's followers follow it."""
+        followed = [self.following(follower) for follower in self.followers(node)]
+        if not followed:
+            return Counter()
+        accounts, counts = np.unique(np.concatenate(followed), return_counts=True)
+        result = Counter(dict(zip(accounts.tolist(), counts.tolist())))
+        result.pop(node, None)
+        return result
+
+    def k_hop(self, node: int, hops: int, direction: str = "following") -> Dict[int, int]:
+        """Breadth-first search up to `hops` steps. Returns node -> hop distance."""
+        csr = self.out if direction == "following" else self.inn
+        seen = np.zeros(len(self.ids), dtype=bool)
+        seen[node] = True
+        frontier = np.array([node], dtype=np.int64)
+        distance: Dict[int, int] = {}
+        for hop in range(1, hops + 1):
+            if not len(frontier):
+                break
+            reached = np.unique(np.concatenate([csr.neighbors(current) for current in frontier]))
+            frontier = reached[~seen[reached]].astype(np.int64)
+            seen[frontier] = True
+            distance.update(dict.fromkeys(frontier.tolist(), hop))
+        return distance
+
+    def top_by_degree(self, limit: int, direction: str = "followers", among: Optional[Iterable[int]] = None) -> List[int]:
+        degrees = (self.inn if direction == "followers" else self.out).degrees()
+        nodes = np.arange(len(self.ids)) if among is None else np.fromiter(among, dtype=np.int64)
+        if len(nodes) > limit:
+            nodes = nodes[np.argpartition(-degrees[nodes].astype(np.int64), limit)[:limit]]
+        return sorted(nodes.tolist(), key=lambda node: -int(degrees[node]))
+
+    def similarity(self, a: int, b: int) -> Dict[str, float]:
+        return {
+            "followers_jaccard": jaccard(self.followers(a), self.followers(b)),
+            "following_jaccard": jaccard(self.following(a), self.following(b)),
+        }
+
+    def similar_accounts(self, node: int, limit: int) -> List[Tuple[int, float]]:
+        """Accounts whose followers overlap most with this node's, by Jaccard similarity."""
+        followers = self.followers(node)
+        co_followed = self.followers_follow(node)
+        candidates = [candidate for candidate, _ in co_followed.most_common(MAX_SIMILARITY_CANDIDATES)]
+        scored = [(candidate, jaccard(followers, self.followers(candidate))) for candidate in candidates]
+        return sorted(scored, key=lambda item: item[1], reverse=True)[:limit]
+
+
+def run_graph_tool(
+    args: Dict[str, Any],
+    graph: SocialGraph,
+    resolve_username: Callable[[str], Optional[str]],
+    username_for: Callable[[Any], Optional[str]]
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Handle an `analyze_social_graph` tool call.
+
+    Args:
+        args: The tool call arguments
+        graph: The loaded social graph
+        resolve_username: Maps a username to an account_id
+        username_for: Maps an account_id to a username, for labelling results
+
+    Returns:
+        The result rows and notes for the model
+    """
+    if not graph.loaded and not graph.loading:
+        raise ValueError(
+            "The follow graph is not enabled on this server. "
+            "Use get_followers / get_following_accounts for a single account."
+        )
+    if not graph.loaded:
+        raise ValueError(
+            f"The social graph is still loading ({graph.edges_loaded} follow edges so far). "
+            "Try again shortly, or use get_followers / get_following_accounts for a single account."
+        )
+
+    operation = args.get("operation")
+    if operation not in GRAPH_OPERATIONS:
+        raise ValueError(f"operation must be one of {', '.join(GRAPH_OPERATIONS)}")
+    limit = max(1, min(int(args.get("limit") or 20), MAX_LIMIT))
+    direction = "followers" if args.get("direction") == "followers" else "following"
+
+    def to_node(account: Any, argument: str) -> int:
+        if account in (None, ""):
+            raise ValueError(f"{operation} needs `{argument}`")
+        account = str(account).lstrip("@")
+        account_id = account if account.isdigit() else resolve_username(account)
+        node = graph.node(account_id) if account_id else None
+        if node is None:
+            raise ValueError(f"{account} is not in the follow graph. Only archived accounts' follow lists are loaded.")
+        return node
+
+    def row(node: int, **extra: Any) -> Dict[str, Any]:
+        account_id = str(graph.ids[node])
+        return {
+            "account_id": account_id,
+            "username": username_for(account_id),
+            "followers_in_archive": graph.inn.degree(node),
+            **extra
+        }
+
+    def ranked(nodes: List[int]) -> Tuple[List[Dict[str, Any]], List[str]]:
+        top = graph.top_by_degree(limit, "followers", among=nodes)
+        return [row(node) for node in top], [f"{len(nodes)} accounts in total; showing the {len(top)} most followed."]
+
+    metrics.increment(f"social_graph.{operation}")
+
+    if operation == "top_accounts":
+        ranking = "following" if args.get("direction") == "following" else "followers"
+        return [row(node, following_in_archive=graph.out.degree(node)) for node in graph.top_by_degree(limit, ranking)], []
+
+    node = to_node(args.get("account"), "account")
+    if operation == "mutuals":
+        return ranked(graph.mutuals(node))
+    if operation == "followers_follow":
+        counts = graph.followers_follow(node)
+        return [row(other, followed_by_followers=count) for other, count in counts.most_common(limit)], [
+            f"Counts are of the {graph.inn.degree(node)} followers of this account found in the archive."
+        ]
+    if operation == "k_hop":
+        hops = max(1, min(int(args.get("hops") or 2), MAX_HOPS))
+        distance = graph.k_hop(node, hops, direction)
+        per_hop = Counter(distance.values())
+        summary = ", ".join(f"hop {hop}: {per_hop[hop]}" for hop in sorted(per_hop))
+        top = graph.top_by_degree(limit, "followers", among=distance)
+        return [row(other, hop=distance[other]) for other in top], [
+            f"{len(distance)} accounts reachable via {direction} within {hops} hops ({summary})."
+        ]
+    if operation == "similar_accounts":
+        return [row(other, followers_jaccard=round(score, 4)) for other, score in graph.similar_accounts(node, limit)], []
+
+    other = to_node(args.get("other_account"), "other_account")
+    if operation == "common_followers":
+        return ranked(graph.common_followers(node, other))
+    if operation == "common_following":
+        return ranked(graph.common_following(node, other))
+    scores = {name: round(score, 4) for name, score in graph.similarity(node, other).items()}
+    return [{"account": row(node)["username"], "other_account": row(other)["username"], **scores}], []
+
+
+social_graph = SocialGraph()
@@ -0,0 +1,168 @@
+import contextvars
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional
+
+from utils.jobs import StartedCall, ToolCallCancelled, run_cancellable
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+# Runs tool calls started before their run reached requires_action
+_speculation_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="speculation")
+
+
+@dataclass
+class PartialToolCall:
+    """A function tool call whose arguments are still streaming in."""
+    id: Optional[str] = None
+    name: Optional[str] = None
+    arguments: str = ""
+    # Incremental JSON scanner state
+    depth: int = 0
+    in_string: bool = False
+    escaped: bool = False
+    complete: bool = False
+
+
+class ToolCallAssembler:
+    """
+    Reassembles function tool calls from streamed run step deltas.
+
+    Deltas are keyed by the tool call's index in the step; a delta bringing a
+    new tool call ID at an index starts a new call there, since every tool
+    step of a run numbers its calls from 0. Argument fragments
+    are scanned as they arrive, tracking brace depth outside of strings, so
+    completeness is detected without re-parsing the whole string per fragment.
+    """
+
+    def __init__(self):
+        self._calls: Dict[int, PartialToolCall] = {}
+
+    def feed(
+        self,
+        index: int,
+        tool_call_id: Optional[str],
+        name: Optional[str],
+        arguments: Optional[str]
+    ) -> Optional[PartialToolCall]:
+        """
+        Add one delta. Returns the call the first time its arguments form a complete JSON object.
+        """
+        call = self._calls.get(index)
+        if call is None or (tool_call_id and tool_call_id != call.id):
+            call = self._calls[index] = PartialToolCall(id=tool_call_id)
+        call.name = name or call.name
+        if not arguments or call.complete:
+            return None
+
+        call.arguments += arguments
+        for char in arguments:
+            if call.in_string:
+                if call.escaped:
+                    call.escaped = False
+                elif char == "\\":
+                    call.escaped = True
+                elif char == '"':
+                    call.in_string = False
+            elif char == '"':
+                call.in_string = True
+            elif char == "{":
+                call.depth += 1
+            elif char == "}":
+                call.depth -= 1
+                if call.depth == 0:
+                    call.complete = True
+
+        return call if call.complete and call.id and call.name else None
+
+
+class ToolCallSpeculator:
+    """
+    Starts tool calls as soon as their streamed arguments are complete.
+
+    The model keeps generating (and the run has to reach requires_action)
+    after the arguments are final, so the archive request overlaps with that
+    tail. The requires_action handler then claims the running call and hands it
+    to the step's job instead of starting the request from scratch.
+
+    Calls that `batchable` accepts are left alone: started one by one they would
+    each make their own request, where at requires_action they can be merged
+    with the step's other lookups into one.
+    """
+
+    def __init__(
+        self,
+        execute: Callable[[str, Dict[str, Any]], Any],
+        batchable: Callable[[str, Dict[str, Any]], bool] = lambda name, args: False
+    ):
+        self._execute = execute
+        self._batchable = batchable
+        self._assembler = ToolCallAssembler()
+        self._calls: Dict[str, StartedCall] = {}
+        self._arguments: Dict[str, Dict[str, Any]] = {}
+
+    def feed(self, index: int, tool_call_id: Optional[str], name: Optional[str], arguments: Optional[str]) -> None:
+        """Feed a function tool call delta, starting execution once its arguments are complete."""
+        call = self._assembler.feed(index, tool_call_id, name, arguments)
+        # Without an ID the call could never be claimed, and without a name it cannot run
+        if call is None or not call.id or not call.name or call.id in self._calls:
+            return
+        try:
+            args = json.loads(call.arguments)
+        except json.JSONDecodeError:
+            return
+        if self._batchable(call.name, args):
+            metrics.increment("speculation.left_for_batching")
+            return
+
+        self._arguments[call.id] = args
+        # A running call can only be stopped between requests, so each gets an event it checks
+        cancelled = threading.Event()
+        future = _speculation_executor.submit(contextvars.copy_context().run, self._run, cancelled, call.name, args)
+        self._calls[call.id] = StartedCall(future, cancelled)
+        metrics.increment("speculation.started")
+        logger.debug(f"Speculatively executing {call.name} for {call.id}")
+
+    def _run(self, cancelled: threading.Event, name: str, args: Dict[str, Any]) -> Any:
+        try:
+            return run_cancellable(cancelled, self._execute, name, args)
+        except ToolCallCancelled:
+            # Only calls that were stopped before finishing count as cancelled
+            metrics.increment("runs.cancelled_tool_calls")
+            raise
+
+    def _stop(self, tool_call_id: str) -> None:
+        call = self._calls.pop(tool_call_id)
+        call.cancelled.set()
+        call.future.cancel()
+
+    def claim(self, tool_call_id: str, args: Dict[str, Any]) -> Optional[StartedCall]:
+        """
+        Take the speculative call for a tool call if it ran with the final arguments.
+
+        A call that ran with different arguments is stopped and None is returned.
+        """
+        speculated_args = self._arguments.pop(tool_call_id, None)
+        if tool_call_id not in self._calls:
+            return None
+        if speculated_args != args:
+            self._stop(tool_call_id)
+            metrics.increment("speculation.miss")
+            return None
+        metrics.increment("speculation.hit")
+        return self._calls.pop(tool_call_id)
+
+    def cancel_all(self) -> None:
+        """
+        Stop speculative work that was never claimed. A call in the middle of a request
+        finishes that request, then stops before its next one.
+        """
+        if self._calls:
+            metrics.increment("speculation.unclaimed", len(self._calls))
+        for tool_call_id in list(self._calls):
+            self._stop(tool_call_id)
+        self._arguments.clear()
@@ -1,4 +1,4 @@
-def sse_format(event: str, data: str, retry: int | None = None) -> str:
+def sse_format(event: str, data: str, retry: int | None = None, id: str | None = None) -> str:
     """
     Helper function to format a Server-Sent Event (SSE) message.
 
@@ -6,15 +6,24 @@ def sse_format(event: str, data: str, retry: int | None = None) -> str:
         event: The name/type of the event.
         data: The data payload as a string.
         retry: Optional retry timeout in milliseconds.
+        id: Optional event ID, which the browser sends back as Last-Event-ID when it reconnects.
 
     Returns:
         A formatted SSE message string.
     """
-    output = f"event: {event}\n"
+    output = ""
+    if id is not None:
+        output += f"id: {id}\n"
+    output += f"event: {event}\n"
     if retry is not None:
         output += f"retry: {retry}\n"
     # Ensure each line of data is prefixed with "data: "
     for line in data.splitlines():
         output += f"data: {line}\n"
     output += "\n"  # An extra newline indicates the end of the message.
-    return output 
\ No newline at end of file
+    return output
+
+
+def with_event_id(frame: str, id: str) -> str:
+    """Give an already formatted SSE message an event ID."""
+    return f"id: {id}\n{frame}"
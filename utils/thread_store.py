@@ -0,0 +1,434 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from utils.metrics import metrics
+
+logger = logging.getLogger("uvicorn.error")
+
+THREAD_STORE_PATH: str = os.getenv("THREAD_STORE_PATH", os.path.join(".cache", "threads.sqlite3"))
+
+TURNS_PER_PAGE = 20
+TITLE_CHARS = 80
+SNIPPET_TOKENS = 12
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    thread_id TEXT PRIMARY KEY,
+    assistant_id TEXT NOT NULL,
+    title TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS turns (
+    turn_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    thread_id TEXT NOT NULL REFERENCES threads(thread_id) ON DELETE CASCADE,
+    role TEXT NOT NULL,
+    html TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS turns_by_thread ON turns(thread_id, turn_id);
+CREATE INDEX IF NOT EXISTS threads_by_update ON threads(updated_at);
+CREATE TABLE IF NOT EXISTS run_slots (
+    thread_id TEXT PRIMARY KEY,
+    next_slot INTEGER NOT NULL,
+    started_slot INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pending_messages (
+    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    thread_id TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pending_by_thread ON pending_messages(thread_id, slot);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    thread_id TEXT NOT NULL,
+    description TEXT NOT NULL,
+    status TEXT NOT NULL,
+    output TEXT,
+    html TEXT,
+    delivered INTEGER NOT NULL DEFAULT 0,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_thread ON jobs(thread_id, status);
+CREATE TABLE IF NOT EXISTS conversation_messages (
+    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    thread_id TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversation_by_thread ON conversation_messages(thread_id, message_id);
+"""
+
+# External-content full-text index over turn text, kept in sync by triggers
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5(text, content='turns', content_rowid='turn_id');
+CREATE TRIGGER IF NOT EXISTS turns_fts_insert AFTER INSERT ON turns BEGIN
+    INSERT INTO turns_fts(rowid, text) VALUES (new.turn_id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS turns_fts_delete AFTER DELETE ON turns BEGIN
+    INSERT INTO turns_fts(turns_fts, rowid, text) VALUES ('delete', old.turn_id, old.text);
+END;
+"""
+
+
+@dataclass
+class Turn:
+    """One rendered exchange step: a user message, or everything an assistant run displayed."""
+    turn_id: int
+    thread_id: str
+    role: str
+    html: str
+
+
+@dataclass
+class JobRecord:
+    """A background tool job. `output` is what the model is sent; `html` is the finished widgets."""
+    job_id: str
+    thread_id: str
+    description: str
+    status: str
+    output: Optional[str]
+    html: Optional[str]
+    started_at: float
+    finished_at: Optional[float]
+
+
+@dataclass
+class ThreadSummary:
+    thread_id: str
+    assistant_id: str
+    title: str
+    updated_at: float
+    snippet: Optional[str] = None
+
+
+class ThreadStore:
+    """
+    Local record of chat threads and their rendered turns, in SQLite.
+
+    Turns are stored as the HTML the chat displayed, so reopening a thread is
+    one indexed query rather than a re-listing of its messages from OpenAI.
+    Turn text is indexed with FTS5 for search across threads, falling back to
+    LIKE where SQLite was built without it.
+
+    The store also holds each thread's run slots: messages wait in numbered
+    slots until the run that answers them starts, so every worker process on
+    the host agrees on which messages go into which run. Background tool jobs
+    are recorded here too, so their results outlive the run that started them.
+    Backends that keep the conversation locally store its messages here as well.
+    """
+
+    def __init__(self, path: str = THREAD_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self.full_text = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            connection.execute("PRAGMA busy_timeout=5000")
+            connection.executescript(SCHEMA)
+            try:
+                connection.executescript(FTS_SCHEMA)
+                self.full_text = True
+            except sqlite3.OperationalError as e:
+                logger.warning(f"SQLite has no FTS5 ({e}); thread search will use LIKE")
+            self._connection = connection
+        return self._connection
+
+    def add_turn(self, thread_id: str, assistant_id: str, role: str, html: str, text: str) -> int:
+        """Append a turn, registering the thread if needed. The first user turn becomes the title."""
+        now = time.time()
+        title = " ".join(text.split())[:TITLE_CHARS] if role == "user" else None
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN")
+            try:
+                connection.execute(
+                    "INSERT INTO threads (thread_id, assistant_id, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(thread_id) DO UPDATE SET updated_at = excluded.updated_at, "
+                    "title = COALESCE(threads.title, excluded.title)",
+                    (thread_id, assistant_id, title, now, now)
+                )
+                turn_id = connection.execute(
+                    "INSERT INTO turns (thread_id, role, html, text, created_at) VALUES (?, ?, ?, ?, ?) RETURNING turn_id",
+                    (thread_id, role, html, text, now)
+                ).fetchone()[0]
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        metrics.increment("thread_store.turns_written")
+        return turn_id
+
+    def turns(self, thread_id: str, before: Optional[int] = None, limit: int = TURNS_PER_PAGE) -> Tuple[List[Turn], bool]:
+        """
+        Return up to `limit` turns older than `before` (newest page if None), oldest first.
+
+        Returns:
+            The turns, and whether older ones remain
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT turn_id, thread_id, role, html FROM turns WHERE thread_id = ? AND turn_id < ? "
+                "ORDER BY turn_id DESC LIMIT ?",
+                (thread_id, before if before is not None else 2 ** 63 - 1, limit + 1)
+            ).fetchall()
+        metrics.increment("thread_store.pages_read")
+        return [Turn(*row) for row in reversed(rows[:limit])], len(rows) > limit
+
+    def threads(self, limit: int = 20) -> List[ThreadSummary]:
+        """The most recently active threads that have at least one turn."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT thread_id, assistant_id, title, updated_at FROM threads WHERE title IS NOT NULL "
+                "ORDER BY updated_at DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [ThreadSummary(*row) for row in rows]
+
+    def search(self, query: str, limit: int = 20) -> List[ThreadSummary]:
+        """Threads whose turns match `query`, best match first, with a highlighted snippet."""
+        terms = [term.replace('"', '') for term in query.split() if term.replace('"', '')]
+        if not terms:
+            return []
+        with self._lock:
+            connection = self._connect()
+            if self.full_text:
+                # Quote each term so user input is never parsed as FTS syntax
+                match = " ".join(f'"{term}"' for term in terms)
+                rows = connection.execute(
+                    "SELECT threads.thread_id, threads.assistant_id, threads.title, threads.updated_at, "
+                    f"snippet(turns_fts, 0, '[', ']', '…', {SNIPPET_TOKENS}) "
+                    "FROM turns_fts JOIN turns ON turns.turn_id = turns_fts.rowid "
+                    "JOIN threads ON threads.thread_id = turns.thread_id "
+                    "WHERE turns_fts MATCH ? ORDER BY bm25(turns_fts)",
+                    (match,)
+                ).fetchall()
+            else:
+                clauses = " AND ".join("turns.text LIKE ?" for _ in terms)
+                rows = connection.execute(
+                    "SELECT threads.thread_id, threads.assistant_id, threads.title, threads.updated_at, "
+                    "substr(turns.text, 1, 120) FROM turns JOIN threads ON threads.thread_id = turns.thread_id "
+                    f"WHERE {clauses} ORDER BY threads.updated_at DESC",
+                    [f"%{term}%" for term in terms]
+                ).fetchall()
+        metrics.increment("thread_store.searches")
+
+        results: Dict[str, ThreadSummary] = {}
+        for row in rows:
+            if row[0] not in results:
+                results[row[0]] = ThreadSummary(*row)
+            if len(results) >= limit:
+                break
+        return list(results.values())
+
+    def delete(self, thread_id: str) -> None:
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM turns WHERE thread_id = ?", (thread_id,))
+            connection.execute("DELETE FROM threads WHERE thread_id = ?", (thread_id,))
+            connection.execute("DELETE FROM pending_messages WHERE thread_id = ?", (thread_id,))
+            connection.execute("DELETE FROM run_slots WHERE thread_id = ?", (thread_id,))
+            connection.execute("DELETE FROM jobs WHERE thread_id = ?", (thread_id,))
+            connection.execute("DELETE FROM conversation_messages WHERE thread_id = ?", (thread_id,))
+
+    def delete_conversation(self, thread_id: str) -> None:
+        """Drop a locally kept conversation, leaving the thread's turns."""
+        with self._lock:
+            self._connect().execute("DELETE FROM conversation_messages WHERE thread_id = ?", (thread_id,))
+
+    def append_messages(self, thread_id: str, messages: List[Dict]) -> None:
+        """Add chat messages to a locally kept conversation."""
+        with self._lock:
+            self._connect().executemany(
+                "INSERT INTO conversation_messages (thread_id, message) VALUES (?, ?)",
+                [(thread_id, json.dumps(message)) for message in messages]
+            )
+
+    def conversation(self, thread_id: str) -> List[Dict]:
+        """The messages of a locally kept conversation, oldest first."""
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT message FROM conversation_messages WHERE thread_id = ? ORDER BY message_id", (thread_id,)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def save_job(self, job_id: str, thread_id: str, description: str, started_at: float) -> None:
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR IGNORE INTO jobs (job_id, thread_id, description, status, started_at) VALUES (?, ?, ?, 'running', ?)",
+                (job_id, thread_id, description, started_at)
+            )
+
+    def finish_job(self, job_id: str, status: str, output: str, html: str, delivered: bool) -> None:
+        with self._lock:
+            self._connect().execute(
+                "UPDATE jobs SET status = ?, output = ?, html = ?, delivered = ?, finished_at = ? WHERE job_id = ?",
+                (status, output, html, int(delivered), time.time(), job_id)
+            )
+
+    def job(self, job_id: str) -> Optional[JobRecord]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT job_id, thread_id, description, status, output, html, started_at, finished_at FROM jobs WHERE job_id = ?",
+                (job_id,)
+            ).fetchone()
+        return JobRecord(*row) if row else None
+
+    def take_undelivered_jobs(self, thread_id: str) -> List[JobRecord]:
+        """Return finished jobs whose results the model has not been sent yet, marking them as sent."""
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = connection.execute(
+                    "SELECT job_id, thread_id, description, status, output, html, started_at, finished_at FROM jobs "
+                    "WHERE thread_id = ? AND status != 'running' AND delivered = 0 ORDER BY finished_at",
+                    (thread_id,)
+                ).fetchall()
+                connection.execute(
+                    "UPDATE jobs SET delivered = 1 WHERE thread_id = ? AND status != 'running' AND delivered = 0", (thread_id,)
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return [JobRecord(*row) for row in rows]
+
+    def _slots(self, connection: sqlite3.Connection, thread_id: str) -> Tuple[int, int]:
+        row = connection.execute(
+            "SELECT next_slot, started_slot FROM run_slots WHERE thread_id = ?", (thread_id,)
+        ).fetchone()
+        if row is None:
+            connection.execute("INSERT INTO run_slots (thread_id, next_slot, started_slot) VALUES (?, 1, 0)", (thread_id,))
+            return 1, 0
+        return row
+
+    def open_slot(self, thread_id: str) -> int:
+        """The slot that the next message sent to the thread will join."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT next_slot FROM run_slots WHERE thread_id = ?", (thread_id,)
+            ).fetchone()
+        return row[0] if row else 1
+
+    def enqueue_message(self, thread_id: str, content: str, max_wait: Optional[float] = None) -> Tuple[int, bool]:
+        """
+        Queue a user message for the next run that has not started yet.
+
+        Args:
+            thread_id: The thread
+            content: The message
+            max_wait: Join the open slot only if its queued messages are newer than this many
+                seconds; otherwise open the next slot, whose run takes them too. Always join if None.
+
+        Returns:
+            The run slot, and whether this message opened it (False if it joins earlier queued messages)
+        """
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                slot, _ = self._slots(connection, thread_id)
+                oldest = connection.execute(
+                    "SELECT MIN(created_at) FROM pending_messages WHERE thread_id = ? AND slot = ?", (thread_id, slot)
+                ).fetchone()[0]
+                opened = oldest is None
+                if not opened and max_wait is not None and time.time() - oldest >= max_wait:
+                    # Nothing started the slot's run in time; open another, which claims the waiting messages as well
+                    slot += 1
+                    opened = True
+                    connection.execute("UPDATE run_slots SET next_slot = ? WHERE thread_id = ?", (slot, thread_id))
+                connection.execute(
+                    "INSERT INTO pending_messages (thread_id, slot, content, created_at) VALUES (?, ?, ?, ?)",
+                    (thread_id, slot, content, time.time())
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return slot, opened
+
+    def claim_slot(self, thread_id: str, slot: int) -> Optional[List[str]]:
+        """
+        Mark a slot's run as started and take the messages queued for it (and any earlier slot
+        whose run never started). Returns None if the slot's run was already started.
+        """
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                next_slot, started_slot = self._slots(connection, thread_id)
+                if started_slot >= slot:
+                    connection.execute("COMMIT")
+                    return None
+                rows = connection.execute(
+                    "SELECT message_id, content FROM pending_messages WHERE thread_id = ? AND slot <= ? ORDER BY message_id",
+                    (thread_id, slot)
+                ).fetchall()
+                connection.execute("DELETE FROM pending_messages WHERE thread_id = ? AND slot <= ?", (thread_id, slot))
+                connection.execute(
+                    "UPDATE run_slots SET started_slot = ?, next_slot = ? WHERE thread_id = ?",
+                    (slot, max(next_slot, slot + 1), thread_id)
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return [content for _, content in rows]
+
+
+class TurnRecorder:
+    """
+    Collects what an assistant run streams to the page, so the finished turn
+    can be stored as static HTML: message text, tool call arguments, and the
+    first page of each tool output widget.
+    """
+
+    def __init__(self):
+        self._steps: List[List[str]] = []
+
+    def start_step(self, step_type: str) -> None:
+        self._steps.append([step_type, ""])
+
+    def append(self, text: str) -> None:
+        if not self._steps:
+            self.start_step("assistantMessage")
+        self._steps[-1][1] += text
+
+    def output(self, widget_html: str) -> None:
+        self._steps.append(["toolOutput", widget_html])
+
+    def __bool__(self) -> bool:
+        return bool(self._steps)
+
+    def html(self) -> str:
+        parts = []
+        for step_type, content in self._steps:
+            if step_type == "toolOutput":
+                parts.append(content)
+            else:
+                parts.append(f'<div class="{step_type}">{content}</div>')
+        return f'<div class="assistant-run">{"".join(parts)}</div>'
+
+    def text(self) -> str:
+        """The run's message text, for search."""
+        return "\n".join(content for step_type, content in self._steps if step_type == "assistantMessage")
+
+
+thread_store = ThreadStore()
@@ -1,9 +1,23 @@
+import asyncio
 import logging
+import os
+import time
+from typing import List, Optional, Tuple
 from openai import AsyncOpenAI
 from openai.types.beta import Thread
 
+from utils.metrics import metrics
+
 logger = logging.getLogger("uvicorn.error")
 
+# Placeholder thread ID for a conversation whose thread is created on its first message
+NEW_THREAD = "new"
+
+# Pre-created threads kept ready for first messages, and how long an unused one is kept
+THREAD_POOL_SIZE: int = int(os.getenv("THREAD_POOL_SIZE", "2"))
+THREAD_POOL_MAX_AGE: float = float(os.getenv("THREAD_POOL_MAX_AGE", "3600"))
+THREAD_POOL_CHECK_SECONDS: float = 60.0
+
 async def create_thread() -> str:
     """Create a new assistant chat thread using OpenAI's API and return the thread ID."""
     try:
@@ -13,3 +27,84 @@ async def create_thread() -> str:
     except Exception as e:
         logger.error(f"Error creating assistant chat thread: {e}")
         return ""
+
+async def delete_thread(thread_id: str) -> None:
+    """Delete an assistant chat thread, logging rather than raising on failure."""
+    try:
+        openai_client: AsyncOpenAI = AsyncOpenAI()
+        await openai_client.beta.threads.delete(thread_id)
+    except Exception as e:
+        logger.warning(f"Error deleting assistant chat thread {thread_id}: {e}")
+
+
+class ThreadPool:
+    """
+    A small pool of empty threads created ahead of time, so a conversation's
+    first message does not wait on a thread round trip.
+
+    Threads are only taken from the pool when a message is sent, and the pool
+    is refilled in the background. Threads left unused for THREAD_POOL_MAX_AGE
+    are deleted and replaced, and whatever is left is deleted on shutdown.
+    """
+
+    def __init__(self, size: int = THREAD_POOL_SIZE, max_age: float = THREAD_POOL_MAX_AGE):
+        self.size = size
+        self.max_age = max_age
+        self._threads: List[Tuple[str, float]] = []
+        self._wake = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._threads)
+
+    async def acquire(self) -> str:
+        """Take a fresh pooled thread, or create one if the pool is empty. Returns "" on failure."""
+        # The newest thread is last; if it has expired, so have the rest, and the refill loop deletes them
+        if self._threads and self._threads[-1][1] >= time.time() - self.max_age:
+            thread_id, _ = self._threads.pop()
+            metrics.increment("thread_pool.hit")
+            self._wake.set()
+            return thread_id
+        metrics.increment("thread_pool.miss")
+        self._wake.set()
+        return await create_thread()
+
+    async def _expire(self) -> None:
+        cutoff = time.time() - self.max_age
+        expired = [thread_id for thread_id, created_at in self._threads if created_at < cutoff]
+        self._threads = [(thread_id, created_at) for thread_id, created_at in self._threads if created_at >= cutoff]
+        for thread_id in expired:
+            await delete_thread(thread_id)
+            metrics.increment("thread_pool.expired")
+
+    async def _refill(self) -> None:
+        while len(self._threads) < self.size:
+            thread_id = await create_thread()
+            if not thread_id:
+                break
+            self._threads.append((thread_id, time.time()))
+            metrics.increment("thread_pool.created")
+
+    async def run_forever(self) -> None:
+        """Keep the pool full and fresh until cancelled, then delete the threads still in it."""
+        if self.size <= 0:
+            return
+        try:
+            while True:
+                # The API key may only be set later, from the setup page
+                if os.getenv("OPENAI_API_KEY"):
+                    await self._expire()
+                    await self._refill()
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=THREAD_POOL_CHECK_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        threads, self._threads = self._threads, []
+        await asyncio.gather(*(delete_thread(thread_id) for thread_id, _ in threads))
+
+
+thread_pool = ThreadPool()
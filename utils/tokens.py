@@ -0,0 +1,64 @@
+import logging
+import os
+import re
+import threading
+from typing import Dict, Optional
+
+import tiktoken
+
+logger = logging.getLogger("uvicorn.error")
+
+_encoding: Optional[tiktoken.Encoding]
+try:
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception as e:
+    # tiktoken downloads the encoding on first use, which fails without network access
+    logger.warning(f"Could not load the o200k_base tokenizer, so token budgets are approximate: {e}")
+    _encoding = None
+
+# Size of the model's context window, used to work out how much room a thread has left
+CONTEXT_WINDOW_TOKENS: int = int(os.getenv("CONTEXT_WINDOW_TOKENS", "128000"))
+
+# Approximates BPE: words split into ~4 character pieces, punctuation and whitespace runs as their own tokens
+_TOKEN_PATTERN = re.compile(r"\w{1,4}|[^\w\s]|\s+")
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens in `text` with the model's tokenizer.
+
+    Uses tiktoken's o200k_base encoding (gpt-4o), or a regex approximation
+    that slightly overestimates BPE counts if the encoding could not be loaded.
+    """
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(_TOKEN_PATTERN.findall(text))
+
+
+class ContextLedger:
+    """
+    Tracks how many tokens each thread's context currently holds.
+
+    The size is taken from the usage the Assistants API reports for each run
+    step, which covers the full prompt the model saw plus what it generated.
+    """
+
+    def __init__(self, context_window: int = CONTEXT_WINDOW_TOKENS):
+        self.context_window = context_window
+        self._lock = threading.Lock()
+        self._used: Dict[str, int] = {}
+
+    def record(self, thread_id: str, tokens: int) -> None:
+        """Record the latest known context size for a thread."""
+        with self._lock:
+            self._used[thread_id] = max(tokens, 0)
+
+    def remaining(self, thread_id: str) -> int:
+        """Return how many tokens of context the thread has left."""
+        with self._lock:
+            return max(self.context_window - self._used.get(thread_id, 0), 0)
+
+
+context_ledger = ContextLedger()
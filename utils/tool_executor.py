@@ -0,0 +1,386 @@
+import contextvars
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from utils.account_index import account_index, run_lookup_tool
+from utils.aggregate import run_aggregate_tool
+from utils.batching import PreparedCall, batch_key, merge_params, plan_batches, split_rows
+from utils.conversation import ConversationBuilder, run_conversation_tool
+from utils.custom_functions import fetch_all, make_request
+from utils.jobs import JobManager, ToolCallCancelled, report_progress
+from utils.metrics import metrics
+from utils.prefetch import AccountPrefetcher
+from utils.query_cost import PAGING_RULES, apply_cost_rules
+from utils.similarity import SimilarityIndex, run_similarity_tool
+from utils.social_graph import run_graph_tool, social_graph
+from utils.thread_store import thread_store
+from utils.result_store import result_store
+from utils.rollups import RollupBuilder, run_rollup_tool
+from utils.tools import COMMUNITY_ARCHIVE_URL, ENDPOINT_SCHEMAS, TOOLS
+from utils.working_set import WorkingSets, run_working_set_tool
+
+logger = logging.getLogger("uvicorn.error")
+
+# Runs the requests for one run's parallel tool calls concurrently
+_tool_call_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tool-call")
+# How often waiting tool calls check whether their run was cancelled
+CANCEL_POLL_SECONDS = 0.25
+
+
+@dataclass
+class ToolResult:
+    """The rows returned by a tool call plus any notes the model should see alongside them."""
+    rows: Any
+    notes: List[str] = field(default_factory=list)
+    # Output already serialized for the model, used instead of packing the rows
+    text: Optional[str] = None
+
+
+def get_endpoint(function_name: str) -> Dict[str, Any]:
+    """Look up the endpoint schema for a tool by name."""
+    endpoint = next((item for item in ENDPOINT_SCHEMAS if item["name"] == function_name), None)
+    if not endpoint:
+        logger.error(f"Endpoint {function_name} not found")
+        raise ValueError(f"Endpoint {function_name} not found")
+    return endpoint
+
+
+def fetch_all_rows(function_name: str, params: Dict[str, Any], max_rows: int) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Fetch every row matching `params` from a tool's endpoint, up to `max_rows`.
+
+    Used by local tools that need more rows than the model may page through.
+    The cost rules other than the paging rules still apply.
+
+    Returns:
+        The rows and whether `max_rows` was reached
+    """
+    endpoint = get_endpoint(function_name)
+    params = dict(params)
+    apply_cost_rules(endpoint, params, exclude=PAGING_RULES)
+
+    rows: List[Dict[str, Any]] = []
+    for page in fetch_all(endpoint, params, max_rows=max_rows):
+        rows.extend(page)
+        report_progress(f"{len(rows)} rows fetched from {function_name}")
+    metrics.increment("bulk_fetch.rows", len(rows))
+    return rows, len(rows) >= max_rows
+
+
+def request_endpoint(function_name: str, params: Dict[str, Any]) -> Any:
+    """Send a request the server built itself straight to a tool's endpoint."""
+    return make_request(endpoint=get_endpoint(function_name), params=dict(params))
+
+
+def fetch_endpoint_pages(function_name: str, params: Dict[str, Any], max_rows: int) -> Iterator[List[Dict[str, Any]]]:
+    """Page through a tool's endpoint for a bulk load the server runs itself, without the cost rules."""
+    return fetch_all(get_endpoint(function_name), params, max_rows=max_rows)
+
+
+def table_endpoint(table: str, primary_key: str) -> Dict[str, Any]:
+    """Build an endpoint for a table that has no tool of its own, such as all_account."""
+    return {
+        **get_endpoint("get_account_info"),
+        "name": table,
+        "url": f"{COMMUNITY_ARCHIVE_URL}/rest/v1/{table}",
+        "primary_key": primary_key,
+    }
+
+
+def fetch_table_pages(table: str, params: Dict[str, Any]) -> Iterator[List[Dict[str, Any]]]:
+    """Page through an account table that has no tool of its own, such as all_account."""
+    return fetch_all(table_endpoint(table, "account_id"), params, max_rows=1000000)
+
+
+def fetch_conversation_root(conversation_id: str) -> Optional[str]:
+    """Return the earliest tweet recorded for a conversation, which is the tweet that started it."""
+    rows = make_request(endpoint=table_endpoint("conversations", "tweet_id"), params={
+        "select": "tweet_id", "conversation_id": f"eq.{conversation_id}", "order": "tweet_id.asc", "limit": 1
+    })
+    return str(rows[0]["tweet_id"]) if isinstance(rows, list) and rows else None
+
+
+# Tools whose endpoint can be filtered by account_id, so a username filter can be resolved locally
+ACCOUNT_ID_TOOLS = {tool["name"] for tool in TOOLS if "account_id" in tool["parameters"]["properties"]}
+
+
+def resolve_username_filter(function_name: str, params: Dict[str, Any]) -> None:
+    """
+    Rewrite a `username=eq.<name>` filter into the indexed `account_id=eq.<id>` in place,
+    when the account index knows the username.
+    """
+    if function_name not in ACCOUNT_ID_TOOLS or "account_id" in params:
+        return
+    operator, _, username = str(params.get("username", "")).partition(".")
+    if operator != "eq":
+        return
+    account_id = account_index.resolve(username)
+    if account_id is None:
+        return
+    del params["username"]
+    params["account_id"] = f"eq.{account_id}"
+    metrics.increment("account_index.rewrite")
+
+
+def resolve_account(account: str) -> Optional[Tuple[str, str]]:
+    """Map a username (any case) or account_id to (account_id, username), from the index or upstream."""
+    account = account.lstrip("@")
+    if account.isdigit():
+        username = account_index.username_for(account)
+        if username:
+            return account, username
+        params = {"select": "account_id,username", "account_id": f"eq.{account}", "limit": 1}
+    else:
+        found = account_index.lookup(account)
+        if found:
+            return found["account_id"], found["username"]
+        params = {"select": "account_id,username", "username": f"ilike.{account}", "limit": 5}
+    rows = request_endpoint("get_account_info", params)
+    for row in rows if isinstance(rows, list) else []:
+        if account.isdigit() or str(row.get("username", "")).lower() == account.lower():
+            return str(row["account_id"]), row["username"]
+    return None
+
+
+# Account context fetched ahead of time for handles named in user messages
+account_prefetcher = AccountPrefetcher(request_endpoint)
+
+# Earlier results of each thread under short handles, for query_working_set
+working_sets = WorkingSets(result_store)
+
+# Per-account activity rollups, precomputed on disk
+rollup_builder = RollupBuilder(fetch_endpoint_pages, request_endpoint)
+
+# Local nearest-neighbour index over tweet text, extended with every tweet a tool call returns
+similarity_index = SimilarityIndex()
+
+# Reply trees, with a local parent -> children index shared across threads
+conversation_builder = ConversationBuilder(request_endpoint)
+
+
+def _aggregate_archive(args: Dict[str, Any], thread_id: Optional[str]) -> ToolResult:
+    rows, notes = run_aggregate_tool(args, fetch_all_rows)
+    return ToolResult(rows=rows, notes=notes)
+
+
+def _lookup_accounts(args: Dict[str, Any], thread_id: Optional[str]) -> ToolResult:
+    rows, notes = run_lookup_tool(args, account_index, lambda params: request_endpoint("get_account_info", params))
+    return ToolResult(rows=rows, notes=notes)
+
+
+def _analyze_social_graph(args: Dict[str, Any], thread_id: Optional[str]) -> ToolResult:
+    rows, notes = run_graph_tool(args, social_graph, account_index.resolve_any, account_index.username_for)
+    return ToolResult(rows=rows, notes=notes)
+
+
+def _get_conversation_tree(args: Dict[str, Any], thread_id: Optional[str]) -> ToolResult:
+    rows, notes, text = run_conversation_tool(args, conversation_builder, fetch_conversation_root)
+    return ToolResult(rows=rows, notes=notes, text=text)
+
+
+def _get_account_summary(args: Dict[str, Any], thread_id: Optional[str]) -> ToolResult:
+    rows, notes, text = run_rollup_tool(args, rollup_builder, resolve_account)
+    return ToolResult(rows=rows, notes=notes, text=text)
+
+
+def _find_similar_tweets(args: Dict[str, Any], thread_id: Optional[str]) -> ToolResult:
+    rows, notes = run_similarity_tool(args, similarity_index, resolve_account, account_index.username_for)
+    return ToolResult(rows=rows, notes=notes)
+
+
+def _query_working_set(args: Dict[str, Any], thread_id: Optional[str]) -> ToolResult:
+    rows, notes = run_working_set_tool(args, working_sets, thread_id)
+    return ToolResult(rows=rows, notes=notes)
+
+
+# Tools from utils.tools.LOCAL_TOOLS and the functions that answer them
+LOCAL_TOOL_HANDLERS: Dict[str, Callable[[Dict[str, Any], Optional[str]], ToolResult]] = {
+    "aggregate_archive": _aggregate_archive,
+    "lookup_accounts": _lookup_accounts,
+    "analyze_social_graph": _analyze_social_graph,
+    "get_conversation_tree": _get_conversation_tree,
+    "query_working_set": _query_working_set,
+    "get_account_summary": _get_account_summary,
+    "find_similar_tweets": _find_similar_tweets,
+}
+
+
+def execute_tool_call(function_name: str, args: Dict[str, Any], thread_id: Optional[str] = None) -> ToolResult:
+    """
+    Execute a function tool call requested by the assistant.
+
+    Local tools are dispatched to their handlers. For endpoint tools,
+    username filters are resolved to account IDs from the local index and the
+    request params are checked against the query cost model, so expensive
+    queries are rewritten or rejected before anything goes upstream.
+
+    Args:
+        function_name: The name of the tool the assistant called
+        args: The parsed tool call arguments
+        thread_id: The thread the call belongs to, for tools that work on its earlier results
+
+    Returns:
+        ToolResult with the response rows and any notes
+
+    Raises:
+        QueryRejected: If the cost model refuses to run the query
+    """
+    if function_name in LOCAL_TOOL_HANDLERS:
+        metrics.increment(f"local_tool.{function_name}")
+        return LOCAL_TOOL_HANDLERS[function_name](dict(args or {}), thread_id)
+
+    endpoint = get_endpoint(function_name)
+    params = dict(args or {})
+
+    prefetched = account_prefetcher.answer(function_name, params, thread_id)
+    if prefetched is not None:
+        return ToolResult(rows=prefetched)
+
+    resolve_username_filter(function_name, params)
+    notes = apply_cost_rules(endpoint, params)
+
+    rows = make_request(endpoint=endpoint, params=params)
+    index_tweets(function_name, rows)
+    return ToolResult(rows=rows, notes=notes)
+
+
+def index_tweets(function_name: str, rows: Any) -> None:
+    """Add tweets returned by get_tweets to the similarity index."""
+    if function_name == "get_tweets" and isinstance(rows, list):
+        similarity_index.add(row for row in rows if isinstance(row, dict))
+
+
+def prepare_call(tool_call_id: str, function_name: str, args: Dict[str, Any]) -> PreparedCall:
+    """
+    Resolve an endpoint call's username filter and apply the cost rules to its params.
+
+    Raises:
+        QueryRejected: If the cost model refuses to run the query
+    """
+    endpoint = get_endpoint(function_name)
+    params = dict(args or {})
+    resolve_username_filter(function_name, params)
+    notes = apply_cost_rules(endpoint, params)
+    return PreparedCall(tool_call_id, function_name, endpoint, params, notes)
+
+
+def batchable(function_name: str, args: Dict[str, Any]) -> bool:
+    """
+    Whether an endpoint call is a key lookup that execute_tool_calls could merge with
+    others from the same step. Such calls are not speculated, so the batch planner sees them.
+    """
+    if function_name in LOCAL_TOOL_HANDLERS:
+        return False
+    try:
+        return batch_key(prepare_call("", function_name, args)) is not None
+    except Exception:
+        return False
+
+
+def _run_single(call: PreparedCall) -> Dict[str, Union[ToolResult, Exception]]:
+    rows = make_request(endpoint=call.endpoint, params=call.params)
+    return {call.tool_call_id: ToolResult(rows=rows, notes=call.notes)}
+
+
+def _run_batch(column: str, calls: List[PreparedCall]) -> Dict[str, Union[ToolResult, Exception]]:
+    params, added = merge_params(calls, column)
+    rows = make_request(endpoint=calls[0].endpoint, params=params)
+    if not isinstance(rows, list):
+        # Let each call report the upstream error as it would have alone
+        return {call.tool_call_id: ToolResult(rows=rows, notes=call.notes) for call in calls}
+    metrics.increment("batching.requests")
+    metrics.increment("batching.requests_saved", len(calls) - 1)
+    split = split_rows(rows, calls, column, added)
+    return {call.tool_call_id: ToolResult(rows=split[call.tool_call_id], notes=call.notes) for call in calls}
+
+
+def execute_tool_calls(
+    calls: List[Tuple[str, str, Dict[str, Any]]],
+    thread_id: Optional[str] = None,
+    cancelled: Optional[threading.Event] = None
+) -> Dict[str, Union[ToolResult, Exception]]:
+    """
+    Execute the parallel tool calls of one run step.
+
+    Endpoint calls that differ only in an `eq.` lookup on a unique key are
+    merged into a single `in.(...)` request and the rows are split back out
+    per call. All requests, batched or not, run concurrently.
+
+    Args:
+        calls: (tool_call_id, function_name, args) for each call
+        thread_id: The thread the calls belong to
+        cancelled: Once set, calls that have not started yet are skipped, and running
+            ones stop before their next upstream request
+
+    Returns:
+        A ToolResult, or the exception the call raised, for each tool_call_id
+    """
+    outcomes: Dict[str, Union[ToolResult, Exception]] = {}
+    prepared: List[PreparedCall] = []
+    deferred: List[Tuple[str, str, Dict[str, Any]]] = []
+    for tool_call_id, function_name, args in calls:
+        if function_name in LOCAL_TOOL_HANDLERS:
+            deferred.append((tool_call_id, function_name, args))
+            continue
+        try:
+            prefetched = account_prefetcher.answer(function_name, dict(args or {}))
+            if prefetched is not None:
+                outcomes[tool_call_id] = ToolResult(rows=prefetched)
+                continue
+            prepared.append(prepare_call(tool_call_id, function_name, args))
+        except Exception as e:
+            outcomes[tool_call_id] = e
+
+    batches, singles = plan_batches(prepared)
+    futures = {}
+
+    def submit(function: Callable[..., Dict[str, Any]], *args: Any) -> Any:
+        # Copy the context so progress reports reach the job these calls belong to
+        return _tool_call_executor.submit(contextvars.copy_context().run, function, *args)
+
+    for column, batch in batches:
+        futures[submit(_run_batch, column, batch)] = [call.tool_call_id for call in batch]
+    for call in singles:
+        futures[submit(_run_single, call)] = [call.tool_call_id]
+    for tool_call_id, function_name, args in deferred:
+        future = submit(
+            lambda call_id, name, call_args: {call_id: execute_tool_call(name, call_args, thread_id)},
+            tool_call_id, function_name, args
+        )
+        futures[future] = [tool_call_id]
+
+    pending = set(futures)
+    while pending:
+        _, pending = wait(pending, timeout=CANCEL_POLL_SECONDS, return_when=FIRST_COMPLETED)
+        if len(futures) > 1 and pending:
+            report_progress(f"{len(futures) - len(pending)} of {len(futures)} requests finished")
+        if cancelled is not None and cancelled.is_set():
+            skipped = [future for future in pending if future.cancel()]
+            metrics.increment("runs.cancelled_tool_calls", sum(len(futures[future]) for future in skipped))
+            break
+
+    for future, tool_call_ids in futures.items():
+        if future.cancelled():
+            outcomes.update({tool_call_id: RuntimeError("The run was cancelled") for tool_call_id in tool_call_ids})
+            continue
+        try:
+            outcomes.update(future.result())
+        except ToolCallCancelled as e:
+            # Stopped between requests after the run was cancelled
+            metrics.increment("runs.cancelled_tool_calls", len(tool_call_ids))
+            outcomes.update({tool_call_id: e for tool_call_id in tool_call_ids})
+        except Exception as e:
+            outcomes.update({tool_call_id: e for tool_call_id in tool_call_ids})
+
+    for call in prepared:
+        outcome = outcomes.get(call.tool_call_id)
+        if isinstance(outcome, ToolResult):
+            index_tweets(call.function_name, outcome.rows)
+    return outcomes
+
+
+# Runs each run step's tool calls, keeping slow ones going as background jobs
+job_manager = JobManager(thread_store, execute_tool_calls)
@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+from utils.metrics import metrics
+from utils.tokens import count_tokens
+from utils.schema_compaction import COMPACT_REQUEST_SCHEMAS, compact_instructions
+from utils.tools import CORE_TOOLS, DATABASE_SCHEMA, TABLE_COLUMNS, TOOL_ROUTES
+
+logger = logging.getLogger("uvicorn.error")
+
+TOOL_ROUTING_ENABLED: bool = os.getenv("TOOL_ROUTING_ENABLED", "true").lower() == "true"
+# Threads whose last selection is remembered, so a follow-up message keeps the tools it builds on
+TOOL_ROUTING_THREADS: int = 1000
+
+_WORD_PATTERN = re.compile(r"[a-z]+")
+_FOREIGN_KEY_PATTERN = re.compile(r"FK -> (\w+)\.")
+
+
+@dataclass
+class ToolSelection:
+    """The tools and instructions offered to the model for one run."""
+    names: List[str]
+    tables: List[str]
+    tools: List[Dict]
+    instructions: str
+    prompt_tokens: int
+
+
+def prompt_tokens(instructions: str, tools: List[Dict]) -> int:
+    """Tokens the instructions and tool definitions add to every model request."""
+    return count_tokens(instructions) + count_tokens(json.dumps(tools))
+
+
+def foreign_keys() -> Dict[str, Set[str]]:
+    """The tables each table of DATABASE_SCHEMA references."""
+    references: Dict[str, Set[str]] = {}
+    table = None
+    for line in DATABASE_SCHEMA.splitlines():
+        if line.strip() and not line.startswith(" "):
+            table = line.strip()
+            references[table] = set()
+        elif table:
+            references[table].update(_FOREIGN_KEY_PATTERN.findall(line))
+    return references
+
+
+class ToolRouter:
+    """
+    Picks the tools and schema sections relevant to a run's messages.
+
+    Every tool and the whole database schema cost prompt tokens on every model
+    request. The router matches the words of the
+    messages against each tool's keywords (TOOL_ROUTES) and the distinctive
+    words of its name. It offers the matching tools, CORE_TOOLS, and the tools
+    the previous message on the thread matched, and cuts the schema down to
+    the tables those tools query and the tables they reference. The selection is passed to the
+    backend as run-level overrides of the assistant's tools and instructions.
+    """
+
+    def __init__(self, enabled: bool = TOOL_ROUTING_ENABLED):
+        self.enabled = enabled
+        self._schemas = {schema["function"]["name"]: schema for schema in COMPACT_REQUEST_SCHEMAS}
+        # Name words shared by several tools ("get", "tweets") say nothing about which one is wanted
+        name_words = [word for name in self._schemas for word in set(name.split("_"))]
+        self._keywords = {
+            name: set(TOOL_ROUTES.get(name, {}).get("keywords", [])) | {
+                word for word in name.split("_") if name_words.count(word) == 1
+            }
+            for name in self._schemas
+        }
+        self._references = foreign_keys()
+        self._previous: OrderedDict[str, List[str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _tables(self, names: List[str]) -> List[str]:
+        tables = {table for name in names for table in TOOL_ROUTES.get(name, {}).get("tables", [])}
+        tables |= {reference for table in tables for reference in self._references.get(table, set())}
+        return [table for table in TABLE_COLUMNS if table in tables]
+
+    def select(self, thread_id: str, messages: List[str]) -> Optional[ToolSelection]:
+        """
+        Choose the tools for a run. Returns None when routing is disabled, so the
+        assistant's own tools and instructions are used.
+
+        Args:
+            thread_id: The thread, whose previous selection is kept on
+            messages: The user messages the run answers
+        """
+        if not self.enabled:
+            return None
+
+        words = set(_WORD_PATTERN.findall(" ".join(messages).lower()))
+        with self._lock:
+            previous = self._previous.get(thread_id, [])
+        matched = {name for name, keywords in self._keywords.items() if keywords & words}
+        chosen = set(CORE_TOOLS) | matched | set(previous)
+        names = [name for name in self._schemas if name in chosen]
+        with self._lock:
+            self._previous[thread_id] = sorted(matched)
+            self._previous.move_to_end(thread_id)
+            while len(self._previous) > TOOL_ROUTING_THREADS:
+                self._previous.popitem(last=False)
+
+        tables = self._tables(names)
+        tools = [self._schemas[name] for name in names]
+        instructions = compact_instructions(tables, names)
+        selection = ToolSelection(names, tables, tools, instructions, prompt_tokens(instructions, tools))
+
+        metrics.increment("tool_router.runs")
+        metrics.increment("tool_router.tools", len(names))
+        metrics.increment("tool_router.prompt_tokens", selection.prompt_tokens)
+        logger.debug(f"Offering {len(names)} of {len(self._schemas)} tools on thread {thread_id}: {', '.join(names)}")
+        return selection
+
+
+tool_router = ToolRouter()
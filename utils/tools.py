@@ -1,5 +1,6 @@
 from dotenv import load_dotenv
 import os
+from typing import Any, Dict, List
 
 load_dotenv(override=True)
 
@@ -38,6 +39,10 @@ def split_tool_schemas(tool_schemas):
     
     for item in tool_schemas:
         endpoint = {key: item[key] for key in item if key not in ['description', 'parameters', 'additionalProperties']}
+        endpoint["primary_key"] = next(
+            (name for name, prop in item["parameters"]["properties"].items() if "<pk/>" in prop.get("description", "")),
+            None
+        )
         schema = wrap_tool_schema({key: item[key] for key in item if key in ['name', 'description', 'parameters', 'additionalProperties']})
 
         endpoints.append(endpoint)
@@ -46,6 +51,28 @@ def split_tool_schemas(tool_schemas):
     return endpoints, requests
 
 
+def parse_database_schema(schema):
+    """
+    Parses the indented DATABASE_SCHEMA text into a mapping of table names to column names.
+
+    Args:
+        schema: The schema text, with unindented table names followed by "  - column" lines.
+    """
+    tables = {}
+    current = None
+
+    for line in schema.splitlines():
+        if not line.strip():
+            continue
+        if not line.startswith(" "):
+            current = line.strip()
+            tables[current] = []
+        elif current and line.strip().startswith("- "):
+            tables[current].append(line.strip()[2:].split(" ")[0])
+
+    return tables
+
+
 DATABASE_SCHEMA = """
 account
   - account_id (PK)
@@ -180,7 +207,7 @@ tweet_media
 
 
 # Set system prompt
-SYSTEM_PROMPT = ("""
+SYSTEM_PROMPT_TEMPLATE = ("""
 Users will ask you questions about activity on Twitter, as represented
 in data voluntarily uploaded to the Twitter Community Archive. You
 have no access to Twitter itself and cannot answer questions about
@@ -200,7 +227,15 @@ You may use nested resource embedding or include logical operator keys
 in your request parameters to construct complex user queries. Always
 use the `limit` parameter to paginate results! Requesting more than 50
 results at a time is abusive of the Twitter Community Archive API.
-Please do not abuse our tools!
+Please do not abuse our tools! For counts, sums, rankings and time
+histograms, use `aggregate_archive` instead of paging through raw rows.
+To find an account_id from a username, use `lookup_accounts`. For an
+overview of one account's activity, use `get_account_summary`. To show
+a reply thread, use `get_conversation_tree`. To find tweets about a
+topic or worded like a given tweet, try `find_similar_tweets` first.
+Every tool result is kept under a handle such as r1; to filter, sort or
+join rows you have already fetched, use `query_working_set` instead of
+fetching them again.
 
 When constructing nested queries, you should pay close attention to
 foreign key relationships and endpoint names specified in the schema.
@@ -220,9 +255,17 @@ Function outputs will be rendered as a widget in the UI. When you receive
 the results, you should either run another function call or merely
 reflect on the results in a comment. If you can provide some analysis or
 insights, that would be much better than a mere summary. Be opinionated!
-""").format(DATABASE_SCHEMA=DATABASE_SCHEMA)
+""")
+SYSTEM_PROMPT = SYSTEM_PROMPT_TEMPLATE.format(DATABASE_SCHEMA=DATABASE_SCHEMA)
+
+TABLE_COLUMNS = parse_database_schema(DATABASE_SCHEMA)
+# The tweets table is served by get_tweets but not listed in DATABASE_SCHEMA; these are the columns get_tweets documents
+TABLE_COLUMNS["tweets"] = [
+    "tweet_id", "account_id", "created_at", "full_text", "retweet_count", "favorite_count",
+    "reply_to_tweet_id", "reply_to_user_id", "reply_to_username", "archive_upload_id"
+]
 
-TOOLS = [
+TOOLS: List[Dict[str, Any]] = [
     {
         "name": "get_tweet_urls",
         "url": f"{COMMUNITY_ARCHIVE_URL}/rest/v1/tweet_urls",
@@ -969,4 +1012,285 @@ TOOLS = [
     },
 ]
 
+# Tools answered locally by utils.tool_executor rather than by a single PostgREST request
+LOCAL_TOOLS = [
+    {
+        "name": "aggregate_archive",
+        "description": "Computes counts, sums, top-k rankings, time histograms or distinct counts over ALL rows of another tool's endpoint matching the given filters, and returns only the aggregate. Use this instead of paging through raw rows for questions like 'how many tweets per month' or 'top 10 accounts this user replies to'.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "source": {
+                    "type": "string",
+                    "description": "Name of the tool whose rows to aggregate. Example: get_tweets"
+                },
+                "filters": {
+                    "type": "object",
+                    "description": "PostgREST filters for the source endpoint, as you would pass them to the source tool, without select/limit/offset/order. Example: {\"account_id\": \"eq.12345\"}",
+                    "additionalProperties": True
+                },
+                "operation": {
+                    "type": "string",
+                    "enum": ["count", "sum", "top_k", "histogram", "distinct_count"],
+                    "description": "count: rows per group_by value. sum: total of value_column per group_by value. top_k: the k rows with the largest value_column, labelled by group_by. histogram: rows (or sum of value_column) per time bucket of the timestamp column in group_by. distinct_count: distinct value_column values per group_by value."
+                },
+                "group_by": {
+                    "type": "string",
+                    "description": "Column to group by, or the timestamp column for histogram. Embedded columns use dots. Example: reply_to_username"
+                },
+                "value_column": {
+                    "type": "string",
+                    "description": "Column to sum, rank by or count distinct values of. Example: favorite_count"
+                },
+                "bucket": {
+                    "type": "string",
+                    "enum": ["day", "week", "month", "year"],
+                    "description": "Time bucket size for histogram. Defaults to month."
+                },
+                "k": {
+                    "type": "integer",
+                    "description": "Maximum number of groups or rows to return (default 10, max 100)."
+                }
+            },
+            "required": ["source", "operation"]
+        }
+    },
+    {
+        "name": "lookup_accounts",
+        "description": "Looks up archived accounts by username (case-insensitive) or username prefix, instantly when the local account index is loaded. Returns account_id, username, display name and tweet/follower/following/like counts. Use this to turn usernames into account_ids before querying other tools, or to find an account when you only know part of the handle.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "usernames": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Usernames to look up, with or without the leading @. Example: [\"DefenderOfBasic\", \"visakanv\"]"
+                },
+                "prefix": {
+                    "type": "string",
+                    "description": "Return accounts whose username starts with this prefix, most followed first. Example: visa"
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": "Maximum number of prefix matches to return (default 10, max 50)."
+                }
+            }
+        }
+    },
+    {
+        "name": "analyze_social_graph",
+        "description": "Answers follower/following graph questions in one call from an in-memory copy of the archive's follow graph, instead of paging through get_followers / get_following_accounts. Only follow lists of archived accounts are known, so counts are lower bounds.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "operation": {
+                    "type": "string",
+                    "enum": ["mutuals", "common_followers", "common_following", "followers_follow", "k_hop", "top_accounts", "similarity", "similar_accounts"],
+                    "description": "mutuals: accounts that follow `account` and that it follows back. common_followers / common_following: overlap between `account` and `other_account`. followers_follow: the accounts most followed by `account`'s followers. k_hop: accounts reachable from `account` within `hops` steps along `direction`. top_accounts: the most followed (or, with direction=following, most following) accounts. similarity: Jaccard overlap of the followers and following of `account` and `other_account`. similar_accounts: accounts whose followers overlap most with `account`'s."
+                },
+                "account": {
+                    "type": "string",
+                    "description": "Username or account_id of the account the question is about. Example: visakanv"
+                },
+                "other_account": {
+                    "type": "string",
+                    "description": "Username or account_id of the second account, for common_followers, common_following and similarity."
+                },
+                "direction": {
+                    "type": "string",
+                    "enum": ["following", "followers"],
+                    "description": "Edge direction for k_hop and top_accounts. Defaults to following for k_hop and followers for top_accounts."
+                },
+                "hops": {
+                    "type": "integer",
+                    "description": "Number of steps for k_hop (default 2, max 3)."
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": "Maximum number of accounts to return (default 20, max 100)."
+                }
+            },
+            "required": ["operation"]
+        }
+    },
+    {
+        "name": "get_conversation_tree",
+        "description": "Returns a whole reply thread in one call, as an indented outline with one line per tweet (tweet_id, @username, date, likes, text). Use this instead of walking reply_to_tweet_id with get_tweets. The most liked replies are shown first; cut-off replies are counted.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "tweet_id": {
+                    "type": "string",
+                    "description": "Any tweet in the thread. The tree starts from the first tweet of the thread and marks this one with *. Example: 1234567890"
+                },
+                "conversation_id": {
+                    "type": "string",
+                    "description": "A conversation_id, as an alternative to tweet_id."
+                },
+                "whole_thread": {
+                    "type": "boolean",
+                    "description": "If false, show only the replies below tweet_id instead of the whole thread. Defaults to true."
+                },
+                "max_depth": {
+                    "type": "integer",
+                    "description": "Maximum reply depth below the first tweet (default 10, max 50)."
+                },
+                "max_breadth": {
+                    "type": "integer",
+                    "description": "Maximum replies shown under each tweet (default 10, max 50)."
+                }
+            }
+        }
+    },
+    {
+        "name": "query_working_set",
+        "description": "Filters, joins, sorts and projects the full rows of earlier tool results in this conversation, without a new archive request. Every tool result is stored under a handle (r1, r2, ...) given in its output. Call with no `from` to list the handles and their columns. Embedded columns use dots, e.g. account.username.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "from": {
+                    "type": "string",
+                    "description": "Handle of the result to query. Example: r2"
+                },
+                "filters": {
+                    "type": "object",
+                    "description": "PostgREST-style filters by column: eq, neq, gt, gte, lt, lte, like, ilike, in, is, optionally prefixed with not. Example: {\"favorite_count\": \"gte.100\", \"full_text\": \"ilike.*ai*\"}",
+                    "additionalProperties": True
+                },
+                "join": {
+                    "type": "object",
+                    "description": "Inner join with another handle. `on` is a column present in both, or left_column=right_column. Example: {\"handle\": \"r1\", \"on\": \"account_id\"}",
+                    "properties": {
+                        "handle": {"type": "string"},
+                        "on": {"type": "string"}
+                    }
+                },
+                "order": {
+                    "type": "string",
+                    "description": "Sort order, as column.asc or column.desc, comma-separated. Example: favorite_count.desc"
+                },
+                "select": {
+                    "type": "string",
+                    "description": "Comma-separated columns to return. Defaults to all."
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": "Maximum rows to return (default 50, max 200)."
+                },
+                "offset": {
+                    "type": "integer",
+                    "description": "Rows to skip before returning results."
+                }
+            }
+        }
+    },
+    {
+        "name": "get_account_summary",
+        "description": "Returns a precomputed activity summary of one account in a single call: tweets, likes and retweets received per month, most liked and most retweeted tweets, most replied-to users, most mentioned users and media posted. Use this first for 'summarize @user' or profile-style questions.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "account": {
+                    "type": "string",
+                    "description": "Username or account_id. Example: visakanv"
+                },
+                "sections": {
+                    "type": "array",
+                    "items": {"type": "string", "enum": ["monthly", "top_tweets", "reply_targets", "mentions", "media"]},
+                    "description": "Sections to include. Defaults to all."
+                },
+                "months": {
+                    "type": "integer",
+                    "description": "Number of most recent months to list (default 24)."
+                },
+                "top": {
+                    "type": "integer",
+                    "description": "Entries per ranking (default 5, max 10)."
+                }
+            },
+            "required": ["account"]
+        }
+    },
+    {
+        "name": "find_similar_tweets",
+        "description": "Finds archived tweets similar in wording to a piece of text or to a given tweet, using a local index. Much faster than full_text filters on get_tweets, and matches on shared words and phrases rather than an exact pattern. Only covers tweets that have been indexed.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "text": {
+                    "type": "string",
+                    "description": "Text to find similar tweets to."
+                },
+                "tweet_id": {
+                    "type": "string",
+                    "description": "Find tweets similar to this tweet instead of to `text`."
+                },
+                "account": {
+                    "type": "string",
+                    "description": "Only return tweets by this username or account_id."
+                },
+                "since": {
+                    "type": "string",
+                    "description": "Only return tweets created on or after this date (YYYY-MM-DD)."
+                },
+                "until": {
+                    "type": "string",
+                    "description": "Only return tweets created on or before this date (YYYY-MM-DD)."
+                },
+                "limit": {
+                    "type": "integer",
+                    "description": "Number of tweets to return (default 10, max 50)."
+                }
+            }
+        }
+    },
+]
+
 ENDPOINT_SCHEMAS, REQUEST_SCHEMAS = split_tool_schemas(TOOLS)
+REQUEST_SCHEMAS += [wrap_tool_schema(tool) for tool in LOCAL_TOOLS]
+
+# Token budget and column priority for each tool's output as it is sent back to
+# the model. When a result does not fit, listed columns are the last to be dropped.
+DEFAULT_OUTPUT_BUDGET: Dict[str, Any] = {"max_tokens": 1000, "priority": []}
+OUTPUT_BUDGETS: Dict[str, Dict[str, Any]] = {
+    "get_tweets": {
+        "max_tokens": 1500,
+        "priority": ["tweet_id", "created_at", "full_text", "favorite_count", "retweet_count", "reply_to_username"]
+    },
+    "get_liked_tweets": {"max_tokens": 1500, "priority": ["tweet_id", "full_text"]},
+    "get_account_info": {
+        "max_tokens": 800,
+        "priority": ["account_id", "username", "account_display_name", "num_tweets", "num_followers", "num_following"]
+    },
+    "get_user_profiles": {"max_tokens": 800, "priority": ["account_id", "bio", "website", "location"]},
+    "get_followers": {"max_tokens": 800, "priority": ["account_id", "follower_account_id"]},
+    "get_following_accounts": {"max_tokens": 800, "priority": ["account_id", "following_account_id"]},
+}
+
+# Words in a user message that make each tool worth offering for it, and the
+# tables of DATABASE_SCHEMA its queries use. A tool is also offered when a word
+# found only in its name appears in the message.
+TOOL_ROUTES: Dict[str, Dict[str, List[str]]] = {
+    "get_tweet_urls": {"keywords": ["url", "urls", "link", "links", "website", "domain"], "tables": ["enriched_tweets"]},
+    "get_mentioned_users": {"keywords": ["mention", "mentions", "mentioned", "tagged"], "tables": ["mentioned_users"]},
+    "get_followers": {"keywords": ["follower", "followers", "follows", "audience"], "tables": ["followers", "account"]},
+    "get_archive_uploads": {"keywords": ["upload", "uploads", "uploaded", "archive", "archives"], "tables": ["archive_upload"]},
+    "get_liked_tweets": {"keywords": ["liked", "likes", "like", "favorite", "favorites"], "tables": ["liked_tweets"]},
+    "get_following_accounts": {"keywords": ["following", "follow", "follows", "followed"], "tables": ["following", "account"]},
+    "get_tweet_media": {"keywords": ["media", "image", "images", "photo", "photos", "video", "videos", "picture", "pictures"], "tables": ["tweet_media"]},
+    "get_account_info": {"keywords": ["account", "accounts", "joined", "display"], "tables": ["account", "all_account"]},
+    "get_user_profiles": {"keywords": ["bio", "bios", "profile", "profiles", "location", "website", "avatar"], "tables": ["profile", "all_profile"]},
+    "get_tweets": {"keywords": ["tweet", "tweets", "tweeted", "posted", "wrote", "said", "say", "reply", "replies", "quote", "quotes"], "tables": ["enriched_tweets", "quote_tweets"]},
+    "get_likes": {"keywords": ["liked", "likes", "like"], "tables": ["likes", "liked_tweets"]},
+    "get_user_mentions": {"keywords": ["mention", "mentions", "mentioned", "tagged"], "tables": ["mentioned_users", "enriched_tweets"]},
+    "aggregate_archive": {"keywords": ["many", "count", "number", "most", "top", "total", "monthly", "month", "year", "yearly", "trend", "ranking", "average"], "tables": []},
+    "lookup_accounts": {"keywords": [], "tables": ["account"]},
+    "analyze_social_graph": {"keywords": ["follower", "followers", "following", "follow", "mutual", "mutuals", "network", "graph", "common"], "tables": []},
+    "get_conversation_tree": {"keywords": ["thread", "threads", "conversation", "conversations", "reply", "replies", "discussion"], "tables": ["conversations"]},
+    "query_working_set": {"keywords": [], "tables": []},
+    "get_account_summary": {"keywords": ["summary", "summarize", "overview", "activity", "stats", "statistics"], "tables": []},
+    "find_similar_tweets": {"keywords": ["similar", "like", "about", "topic", "topics", "discuss", "discussed", "talk", "talks", "theme"], "tables": []},
+}
+
+# Offered for every message: resolving usernames, reading tweets, and reworking earlier results
+CORE_TOOLS = ["lookup_accounts", "get_tweets", "query_working_set"]
@@ -0,0 +1,241 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils.metrics import metrics
+from utils.result_store import ResultStore, sort_key
+from utils.serialization import flatten_row
+
+logger = logging.getLogger("uvicorn.error")
+
+# Per-thread bounds, and how long an untouched thread keeps its working set
+WORKING_SET_MAX_HANDLES: int = int(os.getenv("WORKING_SET_MAX_HANDLES", "30"))
+WORKING_SET_MAX_ROWS: int = int(os.getenv("WORKING_SET_MAX_ROWS", "20000"))
+WORKING_SET_IDLE_SECONDS: float = float(os.getenv("WORKING_SET_IDLE_SECONDS", "1800"))
+
+DEFAULT_QUERY_LIMIT = 50
+MAX_QUERY_LIMIT = 200
+
+COMPARISON_OPERATORS = {"eq", "neq", "gt", "gte", "lt", "lte"}
+PATTERN_OPERATORS = {"like", "ilike"}
+
+
+@dataclass
+class Handle:
+    """A tool result kept in a thread's working set. The rows live in the result store."""
+    name: str
+    tool_call_id: str
+    function_name: str
+    params: Dict[str, Any]
+    row_count: int
+    columns: List[str]
+
+
+@dataclass
+class ThreadWorkingSet:
+    handles: "OrderedDict[str, Handle]" = field(default_factory=OrderedDict)
+    next_number: int = 1
+    rows: int = 0
+    last_used: float = field(default_factory=time.time)
+
+
+class WorkingSets:
+    """
+    Short handles (r1, r2, ...) for the tool results of each thread.
+
+    The rows themselves stay in the result store, which bounds memory across
+    all threads; each thread additionally keeps at most
+    WORKING_SET_MAX_HANDLES handles covering WORKING_SET_MAX_ROWS rows, dropping
+    its oldest first. Threads idle for WORKING_SET_IDLE_SECONDS are forgotten.
+    """
+
+    def __init__(self, store: ResultStore):
+        self._store = store
+        self._lock = threading.Lock()
+        self._threads: Dict[str, ThreadWorkingSet] = {}
+
+    def add(self, thread_id: str, tool_call_id: str, function_name: str, params: Dict[str, Any], rows: List[Any]) -> str:
+        """Register a stored tool result and return its handle."""
+        self.expire()
+        columns = list(dict.fromkeys(column for row in rows[:50] if isinstance(row, dict) for column in flatten_row(row)))
+        with self._lock:
+            working_set = self._threads.setdefault(thread_id, ThreadWorkingSet())
+            name = f"r{working_set.next_number}"
+            working_set.next_number += 1
+            working_set.handles[name] = Handle(name, tool_call_id, function_name, dict(params), len(rows), columns)
+            working_set.rows += len(rows)
+            working_set.last_used = time.time()
+            while len(working_set.handles) > 1 and (
+                len(working_set.handles) > WORKING_SET_MAX_HANDLES or working_set.rows > WORKING_SET_MAX_ROWS
+            ):
+                _, dropped = working_set.handles.popitem(last=False)
+                working_set.rows -= dropped.row_count
+                metrics.increment("working_set.dropped")
+        return name
+
+    def handles(self, thread_id: str) -> List[Handle]:
+        with self._lock:
+            working_set = self._threads.get(thread_id)
+            if working_set is None:
+                return []
+            working_set.last_used = time.time()
+            return list(working_set.handles.values())
+
+    def rows(self, thread_id: str, name: str) -> List[Dict[str, Any]]:
+        """Return a handle's rows, flattened to dotted columns."""
+        with self._lock:
+            working_set = self._threads.get(thread_id)
+            handle = working_set.handles.get(name) if working_set else None
+            if working_set:
+                working_set.last_used = time.time()
+        if handle is None:
+            raise ValueError(f"Unknown handle {name}. Call query_working_set without `from` to list this thread's handles.")
+        result = self._store.get(handle.tool_call_id)
+        if result is None:
+            raise ValueError(f"The rows for {name} are no longer cached. Re-run the {handle.function_name} call.")
+        return [flatten_row(row) for row in result.rows if isinstance(row, dict)]
+
+    def expire(self) -> None:
+        cutoff = time.time() - WORKING_SET_IDLE_SECONDS
+        with self._lock:
+            for thread_id in [thread_id for thread_id, ws in self._threads.items() if ws.last_used < cutoff]:
+                del self._threads[thread_id]
+                metrics.increment("working_set.expired_threads")
+
+
+def _coerce(value: Any) -> Any:
+    """Compare numbers (ints and floats alike) as floats and everything else, including ISO timestamps, as strings."""
+    if isinstance(value, bool):
+        return str(value).lower()
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _compare(operator: str, cell: Any, value: str) -> bool:
+    left, right = _coerce(cell), _coerce(value)
+    if type(left) is not type(right):
+        left, right = left if isinstance(left, str) else str(cell), value
+    return {
+        "eq": left == right, "neq": left != right,
+        "gt": left > right, "gte": left >= right,
+        "lt": left < right, "lte": left <= right,
+    }[operator]
+
+
+def parse_filter(column: str, expression: str) -> Callable[[Dict[str, Any]], bool]:
+    """
+    Compile a PostgREST-style filter (`gt.10`, `ilike.*foo*`, `in.(a,b)`, `is.null`,
+    optionally prefixed with `not.`) into a predicate over flattened rows.
+    """
+    expression = str(expression)
+    negate = expression.startswith("not.")
+    if negate:
+        expression = expression[len("not."):]
+    operator, _, value = expression.partition(".")
+
+    if operator in COMPARISON_OPERATORS:
+        def test(cell: Any) -> bool:
+            return cell is not None and _compare(operator, cell, value)
+    elif operator in PATTERN_OPERATORS:
+        pattern = re.compile(
+            "".join(".*" if char in "*%" else re.escape(char) for char in value) + r"\Z",
+            re.IGNORECASE if operator == "ilike" else 0
+        )
+
+        def test(cell: Any) -> bool:
+            return cell is not None and bool(pattern.match(str(cell)))
+    elif operator == "in":
+        options = [option.strip().strip('"') for option in value.strip("()").split(",")]
+
+        def test(cell: Any) -> bool:
+            return cell is not None and any(_compare("eq", cell, option) for option in options)
+    elif operator == "is":
+        expected = {"null": None, "true": True, "false": False}.get(value.lower(), value)
+
+        def test(cell: Any) -> bool:
+            return cell is expected or cell == expected
+    else:
+        raise ValueError(f"Unsupported filter operator `{operator}` on {column}")
+
+    return lambda row: test(row.get(column)) != negate
+
+
+def join_rows(
+    left: List[Dict[str, Any]],
+    right: List[Dict[str, Any]],
+    on: str,
+    right_name: str
+) -> List[Dict[str, Any]]:
+    """
+    Inner join on `on` ("column" or "left_column=right_column") with a hash of the right side.
+    Right-hand columns that collide with left-hand ones are prefixed with the right handle's name.
+    """
+    left_column, _, right_column = on.partition("=")
+    right_column = right_column or left_column
+    index: Dict[str, List[Dict[str, Any]]] = {}
+    for row in right:
+        if row.get(right_column) is not None:
+            index.setdefault(str(row[right_column]), []).append(row)
+
+    joined = []
+    for row in left:
+        for match in index.get(str(row.get(left_column)), []):
+            combined = dict(row)
+            for column, value in match.items():
+                if column == right_column:
+                    continue
+                combined[f"{right_name}.{column}" if column in row else column] = value
+            joined.append(combined)
+    return joined
+
+
+def run_working_set_tool(args: Dict[str, Any], working_sets: WorkingSets, thread_id: Optional[str]) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Handle a `query_working_set` tool call."""
+    if not thread_id:
+        raise ValueError("query_working_set is only available inside a conversation thread")
+
+    source = args.get("from")
+    if not source:
+        listing = [
+            {"handle": handle.name, "tool": handle.function_name, "rows": handle.row_count, "columns": ", ".join(handle.columns)}
+            for handle in working_sets.handles(thread_id)
+        ]
+        return listing, [] if listing else ["No results are stored for this thread yet."]
+
+    rows = working_sets.rows(thread_id, source)
+    join = args.get("join") or {}
+    if join:
+        if not join.get("handle") or not join.get("on"):
+            raise ValueError("join needs `handle` and `on`")
+        rows = join_rows(rows, working_sets.rows(thread_id, join["handle"]), join["on"], join["handle"])
+
+    for column, expression in (args.get("filters") or {}).items():
+        predicate = parse_filter(column, expression)
+        rows = [row for row in rows if predicate(row)]
+
+    if args.get("order"):
+        for term in reversed(str(args["order"]).split(",")):
+            column, _, direction = term.strip().partition(".")
+            present = [row for row in rows if row.get(column) is not None]
+            missing = [row for row in rows if row.get(column) is None]
+            present.sort(key=lambda row: sort_key(row[column]), reverse=direction == "desc")
+            rows = present + missing
+
+    total = len(rows)
+    offset = max(int(args.get("offset") or 0), 0)
+    limit = max(1, min(int(args.get("limit") or DEFAULT_QUERY_LIMIT), MAX_QUERY_LIMIT))
+    rows = rows[offset:offset + limit]
+
+    if args.get("select"):
+        columns = [column.strip() for column in str(args["select"]).split(",") if column.strip()]
+        rows = [{column: row.get(column) for column in columns} for row in rows]
+
+    metrics.increment("working_set.queries")
+    return rows, [f"{total} rows matched; returned {len(rows)} starting at offset {offset}."]